@@ -0,0 +1,830 @@
+"""
+Benchmark of OLXRadar against local stand-ins of the services it uses: an
+OLX site serving the recorded pages of the 'fixtures' directory, with a
+configurable latency and error rate, an SMTP server and the Telegram API,
+and, with --proxies, HTTP proxies forwarding the requests to the OLX site.
+
+Each scenario runs in its own process, inside a scratch copy of the app, so
+the real database, cache and log files are never touched and the peak memory
+of each scenario is measured separately. The results are printed as JSON,
+which can be saved and compared between versions:
+    python benchmark.py --searches 1 50 500 --output results.json
+
+Scenarios:
+    cycle       two runs of main.main(): a cold one, where all the ads are
+                new, and a warm one, where all the ads are known.
+    scraper     OlxScraper.scrape_ads_urls() and get_ad_data(), sequentially.
+    database    DatabaseManager lookups and inserts.
+    parse       CPU time needed to parse a page, for each extractor.
+    search      indexing and searching of synthetic ads in the full-text index.
+    startup     cold start: 'import main' and 'main.py --check' with nothing
+                due, in new interpreters, and the heavy modules they load.
+                Fails when 'import main' takes more than --startup-budget.
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the peak memory is not reported there
+    resource = None
+
+APP_DIR = os.path.realpath(os.path.dirname(__file__))
+FIXTURES_DIR = os.path.join(APP_DIR, "fixtures")
+SCENARIOS = ("cycle", "scraper", "database", "parse", "search", "startup")
+# Number of times each page is parsed by the 'parse' scenario
+PARSE_REPEAT = 50
+# Maximum number of single URL lookups made by the 'database' scenario
+DB_LOOKUPS = 1000
+# Number of synthetic ads indexed by the 'search' scenario
+SEARCH_ADS = 50000
+# Queries of the 'search' scenario: keywords and filters
+SEARCH_QUERIES = (
+    ("rare_keywords", {"query": "raspberry pi"}),
+    ("rare_keywords_price", {"query": "raspberry pi", "max_price": 1000}),
+    ("prefix", {"query": "bicicl*"}),
+    ("common_keyword", {"query": "w0"}),
+    ("price_range", {"min_price": 100, "max_price": 200}),
+    ("last_day", {"since_days": 1})
+)
+# Number of interpreters started for each measure of the 'startup' scenario
+STARTUP_REPEAT = 7
+# Default maximum time of 'import main' in a new interpreter, in milliseconds
+STARTUP_BUDGET_MS = 100
+# Modules which 'import main' must not load: only the stages need them
+HEAVY_MODULES = ("bs4", "lxml", "requests", "urllib3", "asyncio",
+                 "concurrent.futures", "http.server", "dotenv")
+
+# Patterns used to turn the recorded pages into the pages of many searches
+AD_TOKEN_PATTERN = re.compile(r"-ID([0-9A-Za-z]+)\.html")
+STATE_ID_PATTERN = re.compile(r'(\\?"id\\?":\s*)(\d+)')
+TOTAL_PAGES_PATTERN = re.compile(r'(\\?"totalPages\\?":\s*)\d+')
+PAGINATION_PATTERN = re.compile(r"(<ul[^>]*pagination-list[^>]*>).*?(</ul>)", re.S)
+TITLE_PATTERN = re.compile(r"(<h1[^>]*>|\\\"title\\\":\s*\\\")")
+
+
+class StandInStats():
+    """Thread-safe counters shared by the stand-in servers."""
+
+    def __init__(self) -> None:
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str) -> None:
+        """
+        Increments a counter.
+
+        Args:
+            name (str): the name of the counter.
+        """
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def get(self) -> dict:
+        """
+        Returns:
+            dict: the current value of each counter.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+class OlxStandInHandler(BaseHTTPRequestHandler):
+    """Request handler of the OLX stand-in."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately: don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: str,
+              content_type: str = "text/html; charset=utf-8") -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        server = self.server
+        path, _, query = self.path.partition("?")
+        if path == "/__stats":
+            self._send(200, json.dumps(server.stats.get()), "application/json")
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        if random.random() < server.error_rate:
+            server.stats.count("errors")
+            self._send(503, "Service Unavailable")
+            return
+        match = AD_TOKEN_PATTERN.search(path)
+        if match:
+            server.stats.count("ad_pages")
+            self._send(200, server.render_ad(match.group(1)))
+            return
+        match = re.search(r"/q-bench-(\d+)", path)
+        if match:
+            page = re.search(r"page=(\d+)", query)
+            server.stats.count("listing_pages")
+            self._send(200, server.render_listing(
+                int(match.group(1)), int(page.group(1)) if page else 1))
+            return
+        self._send(404, "Not Found")
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if re.fullmatch(r"/bot[^/]*/sendMessage", self.path):
+            self.server.stats.count("telegram_messages")
+            self._send(200, json.dumps({"ok": True, "result": {}}), "application/json")
+            return
+        self._send(404, "Not Found")
+
+
+class OlxStandIn(ThreadingHTTPServer):
+    """
+    Local stand-in of an OLX site and of the Telegram API. Every search
+    'q-bench-<n>' has its own ads, built from the recorded pages, unless
+    the searches overlap: then each group of 'overlap' consecutive searches
+    returns the same ads.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, stats: StandInStats, pages: int = 2,
+                 latency: float = 0, error_rate: float = 0, overlap: int = 1) -> None:
+        """
+        Init the server on a free local port.
+
+        Args:
+            stats (StandInStats): the counters of the requests served.
+            pages (int): number of pages of results of each search.
+            latency (float): delay added to each OLX page, in seconds.
+            error_rate (float): fraction of the OLX pages answered with 503.
+            overlap (int): number of consecutive searches sharing their ads.
+        """
+        super().__init__(("127.0.0.1", 0), OlxStandInHandler)
+        self.overlap = max(overlap, 1)
+        self.stats = stats
+        self.latency = latency
+        self.error_rate = error_rate
+        self.netloc = f"127.0.0.1:{self.server_address[1]}"
+        self.base_url = f"http://{self.netloc}"
+        with open(os.path.join(FIXTURES_DIR, "olx_listing.html"), encoding="utf-8") as f:
+            listing_html = f.read().replace("https://www.olx.ro", self.base_url)
+        pagination = "".join(
+            f'<li class="pagination-item"><a href="?page={page}">{page}</a></li>'
+            for page in range(1, pages + 1))
+        listing_html = PAGINATION_PATTERN.sub(
+            lambda match: match.group(1) + pagination + match.group(2), listing_html)
+        self.listing_html = TOTAL_PAGES_PATTERN.sub(
+            lambda match: f"{match.group(1)}{pages}", listing_html)
+        with open(os.path.join(FIXTURES_DIR, "olx_ad.html"), encoding="utf-8") as f:
+            self.ad_html = f.read().replace("https://www.olx.ro", self.base_url)
+
+    def render_listing(self, search: int, page: int) -> str:
+        """
+        Returns a page of results, whose ads are unique to the search (or
+        to its group of overlapping searches) and page.
+        """
+        search //= self.overlap
+        suffix = f"s{search}p{page}"
+        html = AD_TOKEN_PATTERN.sub(
+            lambda match: f"-ID{match.group(1)}{suffix}.html", self.listing_html)
+        return STATE_ID_PATTERN.sub(
+            lambda match: f"{match.group(1)}{match.group(2)}{search:05d}{page:03d}", html)
+
+    def render_ad(self, token: str) -> str:
+        """
+        Returns the page of an ad, whose title contains the ID of the ad.
+        """
+        html = AD_TOKEN_PATTERN.sub(f"-ID{token}.html", self.ad_html)
+        return TITLE_PATTERN.sub(lambda match: f"{match.group(1)}{token} ", html)
+
+
+class ProxyStandInHandler(BaseHTTPRequestHandler):
+    """Request handler of the proxy stand-in: forwards plain HTTP GETs."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _send(self, status: int, data: bytes, headers: dict) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        server = self.server
+        server.stats.count(f"proxy_{server.index}_requests")
+        if server.failing:
+            self._send(502, b"Bad Gateway", {"Content-Type": "text/plain"})
+            return
+        if not server.take_token():
+            # The site throttles the IP of this proxy
+            server.stats.count("proxy_throttled")
+            self._send(429, b"Too Many Requests", {"Content-Type": "text/plain"})
+            return
+        headers = {name: value for name, value in self.headers.items()
+                   if name.lower() not in ("host", "proxy-connection", "connection")}
+        request = urllib.request.Request(self.path, headers=headers)
+        try:
+            with server.opener.open(request, timeout=60) as response:
+                status, data, response_headers = response.status, response.read(), response.headers
+        except urllib.error.HTTPError as error:
+            status, data, response_headers = error.code, error.read(), error.headers
+        self._send(status, data, {name: value for name, value in response_headers.items()
+                                  if name.lower() in ("content-type", "etag", "last-modified")})
+
+
+class ProxyStandIn(ThreadingHTTPServer):
+    """
+    Local stand-in of an egress proxy. The site allows each proxy, like each
+    client IP, 'rate' requests per second, and answers 429 above it.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, stats: StandInStats, index: int, rate: float = None,
+                 failing: bool = False) -> None:
+        """
+        Init the server on a free local port.
+
+        Args:
+            stats (StandInStats): the counters of the requests served.
+            index (int): the number of the proxy, used in the counters.
+            rate (float): requests per second allowed through the proxy,
+            or None for no limit.
+            failing (bool): if True, the proxy answers every request with 502.
+        """
+        super().__init__(("127.0.0.1", 0), ProxyStandInHandler)
+        self.stats = stats
+        self.index = index
+        self.rate = rate
+        self.failing = failing
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+        self._tokens = 1.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take_token(self) -> bool:
+        """
+        Returns False if the request exceeds the rate allowed to the proxy.
+        """
+        if self.rate is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(self.rate, 1.0),
+                               self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class SmtpStandInHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue: accepts any login and any message."""
+
+    def _reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self) -> None:
+        self._reply("220 olxradar-benchmark ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip().upper()
+            if command.startswith("EHLO"):
+                self.wfile.write(b"250-olxradar-benchmark\r\n250 AUTH PLAIN LOGIN\r\n")
+            elif command.startswith("AUTH"):
+                self._reply("235 Authentication successful")
+            elif command == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self.server.stats.count("emails")
+                self._reply("250 OK")
+            elif command == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class SmtpStandIn(socketserver.ThreadingTCPServer):
+    """Local stand-in of the SMTP server."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stats: StandInStats) -> None:
+        super().__init__(("127.0.0.1", 0), SmtpStandInHandler)
+        self.stats = stats
+
+
+def start_server(server: socketserver.BaseServer) -> None:
+    """
+    Serves requests from a background thread.
+    """
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def get_peak_rss() -> int:
+    """
+    Returns:
+        int: the peak resident memory of the current process, in bytes,
+        or None if it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_standin_stats(config: dict) -> dict:
+    """
+    Returns the counters of the stand-in servers.
+    """
+    with urllib.request.urlopen(f"{config['olx_url']}/__stats") as response:
+        return json.loads(response.read())
+
+
+def register_standin_site(config: dict) -> None:
+    """
+    Makes the stand-in site known to the scraper, without any rate limit.
+    """
+    from site_adapters import SiteAdapter, register_site_adapter
+    register_site_adapter(SiteAdapter(
+        config["netloc"], schema="http",
+        requests_per_second=config.get("site_rate") or 1000))
+
+
+def bench_cycle(config: dict) -> dict:
+    """
+    Runs main.main() twice: with all the ads new, then with all the ads known.
+    """
+    register_standin_site(config)
+    import main
+    from utils import BASE_DIR
+    with open(os.path.join(BASE_DIR, "target_urls.txt"), "w") as f:
+        f.write("\n".join(config["target_urls"]) + "\n")
+    results = {}
+    for phase in ("cold", "warm"):
+        before = get_standin_stats(config)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        main.main(shards=config.get("shards"))
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+        after = get_standin_stats(config)
+        delta = {name: after.get(name, 0) - before.get(name, 0) for name in after}
+        pages = delta.get("listing_pages", 0) + delta.get("ad_pages", 0)
+        requests_count = pages + delta.get("errors", 0)
+        results[phase] = {
+            "seconds": seconds,
+            "requests": requests_count,
+            "requests_per_second": requests_count / seconds,
+            "listing_pages": delta.get("listing_pages", 0),
+            "ad_pages": delta.get("ad_pages", 0),
+            "errors": delta.get("errors", 0),
+            "cpu_seconds": cpu_seconds,
+            "cpu_ms_per_page": cpu_seconds * 1000 / pages if pages else None,
+            "emails": delta.get("emails", 0),
+            "telegram_messages": delta.get("telegram_messages", 0),
+            "proxy_requests": {name: count for name, count in delta.items()
+                               if name.startswith("proxy_")},
+            "ads_recorded": main.get_db().conn.execute(
+                "SELECT COUNT(*) FROM seen_ads").fetchone()[0]
+        }
+    if main.metrics.enabled:
+        # Where the time of both cycles went, with METRICS=1
+        results["metrics"] = main.metrics.to_dict()
+    main.close_resources()
+    return results
+
+
+def bench_scraper(config: dict) -> dict:
+    """
+    Collects the ads of each search with the sequential scraper API.
+    """
+    register_standin_site(config)
+    from scraper_manager import OlxScraper, FetchError
+    ads_urls_count = 0
+    ads_count = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for target_url in config["target_urls"]:
+        scraper = OlxScraper(site=config["netloc"])
+        ads_urls = scraper.scrape_ads_urls(target_url.rstrip("/"))
+        ads_urls_count += len(ads_urls)
+        for ad_url in ads_urls:
+            try:
+                if scraper.get_ad_data(ad_url) is not None:
+                    ads_count += 1
+            except FetchError:
+                pass
+        scraper.close()
+    seconds = time.perf_counter() - start
+    requests_count = len(config["target_urls"]) * config["pages"] + ads_urls_count
+    return {
+        "seconds": seconds,
+        "requests": requests_count,
+        "requests_per_second": requests_count / seconds,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "ads_urls": ads_urls_count,
+        "ads": ads_count
+    }
+
+
+def bench_database(config: dict) -> dict:
+    """
+    Looks up and inserts the ads URLs of each search.
+    """
+    from database_manager import DatabaseManager
+    from utils import BASE_DIR
+    db = DatabaseManager(os.path.join(BASE_DIR, "benchmark.db"),
+                         use_cache=os.getenv("DEDUP_CACHE") == "1")
+    ads_per_search = config["pages"] * config["ads_per_page"]
+    searches = [[f"{config['olx_url']}/d/oferta/ad-ID{ad}s{search}.html"
+                 for ad in range(ads_per_search)]
+                for search in range(len(config["target_urls"]))]
+    all_urls = [url for urls in searches for url in urls]
+    lookups = random.Random(0).sample(all_urls, min(DB_LOOKUPS, len(all_urls)))
+    operations = (
+        ("filter_new", lambda: [db.filter_new(urls) for urls in searches], all_urls),
+        ("add_urls", lambda: [db.add_urls(urls) for urls in searches], all_urls),
+        ("filter_known", lambda: [db.filter_new(urls) for urls in searches], all_urls),
+        ("url_exists", lambda: [db.url_exists(url) for url in lookups], lookups)
+    )
+    results = {}
+    for name, operation, urls in operations:
+        start = time.perf_counter()
+        operation()
+        seconds = time.perf_counter() - start
+        results[name] = {
+            "urls": len(urls),
+            "seconds": seconds,
+            "ops_per_second": len(urls) / seconds if seconds else None
+        }
+    db.close()
+    return results
+
+
+def bench_parse(config: dict) -> dict:
+    """
+    Measures the CPU time needed to parse the recorded pages.
+    """
+    from extractors import EXTRACTORS
+    pages = {}
+    for kind in ("listing", "ad"):
+        with open(os.path.join(config["fixtures_dir"], f"olx_{kind}.html"),
+                  encoding="utf-8") as f:
+            pages[kind] = f.read()
+    results = {}
+    for name, extractor_class in EXTRACTORS.items():
+        try:
+            extractor = extractor_class()
+        except ImportError:
+            continue
+        results[name] = {}
+        for kind, parse in (("listing", extractor.parse_listing),
+                            ("ad", extractor.parse_ad)):
+            start = time.process_time()
+            for _ in range(config["parse_repeat"]):
+                parse(pages[kind])
+            cpu_seconds = time.process_time() - start
+            results[name][f"{kind}_cpu_ms_per_page"] = \
+                cpu_seconds * 1000 / config["parse_repeat"]
+    return results
+
+
+def bench_search(config: dict) -> dict:
+    """
+    Indexes synthetic ads, whose words follow a Zipf distribution like
+    natural text, then times the queries of SEARCH_QUERIES.
+    """
+    from search_index import SearchIndex
+    from utils import BASE_DIR
+    index = SearchIndex(os.path.join(BASE_DIR, "benchmark.db"))
+    rng = random.Random(0)
+    vocabulary = [f"w{rank}" for rank in range(5000)] + ["raspberry", "pi", "bicicleta"]
+    weights = [1 / (rank + 1) for rank in range(5000)] + [0.002, 0.003, 0.002]
+    ads = [{
+        "url": f"{config['olx_url']}/d/oferta/ad-ID{number:x}.html",
+        "title": " ".join(rng.choices(vocabulary, weights, k=6)),
+        "description": " ".join(rng.choices(vocabulary, weights, k=40)),
+        "price": f"{rng.randint(10, 5000)} lei"
+    } for number in range(config["search_ads"])]
+    start = time.perf_counter()
+    for offset in range(0, len(ads), 500):
+        index.add(ads[offset:offset + 500])
+    seconds = time.perf_counter() - start
+    results = {"ads": len(ads), "index_ads_per_second": len(ads) / seconds}
+    for name, query in SEARCH_QUERIES:
+        query = dict(query)
+        if "since_days" in query:
+            query["since"] = time.time() - query.pop("since_days") * 86400
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            found = index.search(**query)
+            timings.append((time.perf_counter() - start) * 1000)
+        results[f"{name}_ms"] = sorted(timings)[len(timings) // 2]
+        results[f"{name}_results"] = len(found)
+    index.close()
+    return results
+
+
+def time_command(args: list, repeat: int) -> float:
+    """
+    Returns the median wall time of a command, in milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, capture_output=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def bench_startup(config: dict) -> dict:
+    """
+    Measures the cold start of the app in new interpreters, with a saved
+    schedule where nothing is due, as when cron starts 'main.py --check'.
+    """
+    from utils import BASE_DIR
+    from scheduler import AdaptiveScheduler
+    with open(os.path.join(BASE_DIR, "target_urls.txt"), "w") as f:
+        f.write(f"{config['olx_url']}/oferte/q-bench-0/\n")
+    scheduler = AdaptiveScheduler()
+    scheduler.add(f"{config['olx_url']}/oferte/q-bench-0/")
+    scheduler.searches[f"{config['olx_url']}/oferte/q-bench-0/"]["next_run"] = \
+        time.time() + 3600
+    scheduler.save(os.path.join(BASE_DIR, "schedule.json"))
+    repeat = config["startup_repeat"]
+    interpreter_ms = time_command([sys.executable, "-c", "pass"], repeat)
+    import_ms = time_command([sys.executable, "-c", "import main"], repeat)
+    check_ms = time_command(
+        [sys.executable, os.path.join(BASE_DIR, "main.py"), "--check"], repeat)
+    process = subprocess.run(
+        [sys.executable, "-c", "import sys, json, main; print(json.dumps("
+         f"[name for name in {HEAVY_MODULES!r} if name in sys.modules]))"],
+        check=True, capture_output=True, text=True)
+    return {
+        "interpreter_ms": interpreter_ms,
+        "import_main_ms": import_ms - interpreter_ms,
+        "check_ms": check_ms,
+        "heavy_modules": json.loads(process.stdout),
+        "budget_ms": config["startup_budget_ms"],
+        "over_budget": import_ms - interpreter_ms > config["startup_budget_ms"]
+    }
+
+
+def run_worker(config: dict) -> dict:
+    """
+    Runs a scenario in the current process, which is a scratch copy of the app.
+
+    Args:
+        config (dict): the scenario and its settings.
+
+    Returns:
+        dict: the measurements of the scenario.
+    """
+    scenarios = {
+        "cycle": bench_cycle,
+        "scraper": bench_scraper,
+        "database": bench_database,
+        "parse": bench_parse,
+        "search": bench_search,
+        "startup": bench_startup
+    }
+    from logging_config import setup_logging
+    setup_logging()
+    results = scenarios[config["scenario"]](config)
+    results["peak_rss_bytes"] = get_peak_rss()
+    return results
+
+
+def run_scenario(config: dict, env: dict) -> dict:
+    """
+    Runs a scenario in a new process, inside a scratch copy of the app.
+
+    Args:
+        config (dict): the scenario and its settings.
+        env (dict): the environment variables of the process.
+
+    Returns:
+        dict: the measurements of the scenario.
+
+    Raises:
+        RuntimeError: If the scenario fails.
+    """
+    with tempfile.TemporaryDirectory(prefix="olxradar-benchmark-") as scratch_dir:
+        for path in glob.glob(os.path.join(APP_DIR, "*.py")):
+            shutil.copy(path, scratch_dir)
+        process = subprocess.run(
+            [sys.executable, os.path.join(scratch_dir, "benchmark.py"),
+             "--worker", json.dumps(config)],
+            cwd=scratch_dir, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"Scenario '{config['scenario']}' failed:\n{process.stderr[-4000:]}")
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def get_commit() -> str:
+    """
+    Returns:
+        str: the current git commit of the app, or None.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """
+    Starts the stand-in servers and runs the selected scenarios.
+
+    Args:
+        args (argparse.Namespace): the command line arguments.
+
+    Returns:
+        dict: the settings and the measurements of all the scenarios.
+    """
+    stats = StandInStats()
+    olx = OlxStandIn(stats, pages=args.pages, latency=args.latency,
+                     error_rate=args.error_rate, overlap=args.overlap)
+    smtp = SmtpStandIn(stats)
+    proxies = [ProxyStandIn(stats, index, rate=args.proxy_rate,
+                            failing=index < args.bad_proxies)
+               for index in range(args.proxies)]
+    for server in [olx, smtp] + proxies:
+        start_server(server)
+    # Point every outgoing service to the stand-ins
+    env = dict(
+        os.environ,
+        SMTP_HOST="127.0.0.1",
+        SMTP_PORT=str(smtp.server_address[1]),
+        SMTP_SSL="0",
+        EMAIL_SENDER="benchmark@localhost",
+        EMAIL_APP_PASSWORD="benchmark",
+        EMAIL_RECEIVER="benchmark@localhost",
+        TELEGRAM_API_URL=olx.base_url,
+        TELEGRAM_BOT_TOKEN="benchmark",
+        TELEGRAM_CHAT_ID="1",
+        TELEGRAM_RATE="1000",
+        RATE_LIMIT_MAX="1000",
+        RATE_LIMIT_SHARED="0",
+        HTTP_PROXIES=",".join(proxy.url for proxy in proxies)
+    )
+    with open(os.path.join(FIXTURES_DIR, "olx_listing.html"), encoding="utf-8") as f:
+        ads_per_page = len(AD_TOKEN_PATTERN.findall(f.read().split("<script")[0]))
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "settings": {
+            "pages": args.pages,
+            "ads_per_page": ads_per_page,
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "overlap": args.overlap,
+            "shards": args.shards,
+            "proxies": args.proxies,
+            "bad_proxies": args.bad_proxies,
+            "proxy_rate": args.proxy_rate
+        },
+        "results": []
+    }
+    try:
+        for scenario in args.scenarios:
+            for searches in ([None] if scenario in ("parse", "search", "startup")
+                             else args.searches):
+                config = {
+                    "scenario": scenario,
+                    "netloc": olx.netloc,
+                    "olx_url": olx.base_url,
+                    "target_urls": [f"{olx.base_url}/oferte/q-bench-{search}/"
+                                    for search in range(searches or 0)],
+                    "pages": args.pages,
+                    "ads_per_page": ads_per_page,
+                    "fixtures_dir": FIXTURES_DIR,
+                    "parse_repeat": PARSE_REPEAT,
+                    "search_ads": SEARCH_ADS,
+                    "startup_repeat": STARTUP_REPEAT,
+                    "startup_budget_ms": args.startup_budget,
+                    "shards": args.shards,
+                    # The site allows proxy_rate requests per second per IP
+                    "site_rate": args.proxy_rate
+                }
+                label = scenario if searches is None else f"{scenario} x{searches}"
+                print(f"Running {label}...", file=sys.stderr)
+                result = {"scenario": scenario, "searches": searches}
+                result.update(run_scenario(config, env))
+                report["results"].append(result)
+    finally:
+        for server in [olx, smtp] + proxies:
+            server.shutdown()
+    return report
+
+
+def parse_args(args: list = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments.
+
+    Args:
+        args (list): the arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark OLXRadar against local stand-ins of OLX, SMTP and Telegram.")
+    parser.add_argument(
+        "--searches", type=int, nargs="+", default=[1, 50, 500],
+        help="numbers of monitored searches to benchmark")
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS),
+        help="scenarios to run")
+    parser.add_argument(
+        "--pages", type=int, default=2, help="number of pages of results of each search")
+    parser.add_argument(
+        "--latency", type=float, default=0.01,
+        help="delay added to each OLX page, in seconds")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="fraction of the OLX pages answered with HTTP 503")
+    parser.add_argument(
+        "--overlap", type=int, default=1,
+        help="number of consecutive searches returning the same ads")
+    parser.add_argument(
+        "--shards", type=int,
+        help="run the cycle scenario with this many worker processes")
+    parser.add_argument(
+        "--proxies", type=int, default=0,
+        help="number of proxy stand-ins the requests to OLX are spread over")
+    parser.add_argument(
+        "--bad-proxies", type=int, default=0,
+        help="number of the proxy stand-ins answering every request with 502")
+    parser.add_argument(
+        "--proxy-rate", type=float,
+        help="requests per second OLX allows through each proxy, answering "
+        "429 above it; also set as the rate of the site in the scraper")
+    parser.add_argument(
+        "--startup-budget", type=float, default=STARTUP_BUDGET_MS,
+        help="maximum time of 'import main' in the startup scenario, in "
+        "milliseconds; the benchmark exits with status 1 above it")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.worker:
+        print(json.dumps(run_worker(json.loads(arguments.worker))))
+        sys.exit(0)
+    report = run_benchmark(arguments)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            f.write(output + "\n")
+    # Cold start regression check, e.g. in CI: python benchmark.py --scenarios startup
+    for result in report["results"]:
+        if result["scenario"] == "startup" and (
+                result["over_budget"] or result["heavy_modules"]):
+            print(f"Cold start over budget: 'import main' took "
+                  f"{result['import_main_ms']:.1f} ms (budget {result['budget_ms']} ms), "
+                  f"heavy modules loaded: {result['heavy_modules']}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,240 @@
+"""
+On-disk HTTP response cache. Each entry is keyed by the hash of its URL and
+holds the validators sent by the server (ETag/Last-Modified), the compressed
+body and the data already extracted from it, so that an unchanged page
+doesn't have to be downloaded or parsed again.
+"""
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+from utils import BASE_DIR
+
+
+class HttpCache():
+    """Class that stores HTTP responses on disk, with TTL and LRU eviction."""
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = 100 * 1024 ** 2) -> None:
+        """
+        Init a new cache and create its directory, if it doesn't exist.
+
+        Args:
+            cache_dir (str): directory of the cache files. Defaults to
+            'http_cache', in the same directory as the script.
+            max_bytes (int): maximum total size of the cache files. The least
+            recently used entries are evicted when it is exceeded.
+        """
+        self.cache_dir = cache_dir or os.path.join(BASE_DIR, "http_cache")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        """
+        Returns the paths of the metadata and body files of an URL.
+
+        Args:
+            url (str): the URL.
+
+        Returns:
+            Tuple[str, str]: the path of the metadata file and of the body file.
+        """
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return f"{base}.json", f"{base}.z"
+
+    def get(self, url: str) -> dict:
+        """
+        Returns the cache entry of an URL and marks it as recently used.
+
+        Args:
+            url (str): the URL.
+
+        Returns:
+            dict: the entry - 'url', 'etag', 'last_modified', 'stored_at' and
+            'extracted' - or None if the URL is not cached.
+        """
+        meta_path, _ = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                entry = json.load(f)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def get_body(self, url: str) -> str:
+        """
+        Returns the cached body of an URL.
+
+        Args:
+            url (str): the URL.
+
+        Returns:
+            str: the body, or None if it is not cached.
+        """
+        _, body_path = self._paths(url)
+        try:
+            with open(body_path, "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except (OSError, zlib.error):
+            return None
+
+    @staticmethod
+    def is_fresh(entry: dict, ttl: float) -> bool:
+        """
+        Returns True if an entry was stored or revalidated less than
+        ttl seconds ago.
+
+        Args:
+            entry (dict): the cache entry.
+            ttl (float): the time to live of the entry, in seconds.
+
+        Returns:
+            bool: True if the entry can be used without asking the server.
+        """
+        return ttl > 0 and time.time() - entry["stored_at"] < ttl
+
+    @staticmethod
+    def get_conditional_headers(entry: dict) -> dict:
+        """
+        Returns the headers of a conditional request for a cached entry.
+
+        Args:
+            entry (dict): the cache entry.
+
+        Returns:
+            dict: the If-None-Match and If-Modified-Since headers, when
+            the server sent the corresponding validators.
+        """
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url: str, body: str, etag: str = None,
+              last_modified: str = None, extracted: dict = None) -> None:
+        """
+        Stores a response in the cache, then evicts the least recently used
+        entries if the cache is too large.
+
+        Args:
+            url (str): the URL of the response.
+            body (str): the body of the response.
+            etag (str): the ETag header of the response.
+            last_modified (str): the Last-Modified header of the response.
+            extracted (dict): data already extracted from the body.
+
+        Returns:
+            None
+        """
+        meta_path, body_path = self._paths(url)
+        entry = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "stored_at": time.time(),
+            "extracted": extracted or {}
+        }
+        data = zlib.compress(body.encode("utf-8"))
+        with self._lock:
+            try:
+                old_size = self._entry_size(meta_path, body_path)
+                with open(body_path, "wb") as f:
+                    f.write(data)
+                self._write_meta(meta_path, entry)
+            except OSError as error:
+                logging.error(f"Error writing to the HTTP cache: {error}")
+                return
+            if self._size is not None:
+                self._size += self._entry_size(meta_path, body_path) - old_size
+            self._evict()
+
+    def update(self, url: str, entry: dict) -> None:
+        """
+        Saves the changes made to an entry (new extracted data or a
+        revalidation) and marks it as fresh.
+
+        Args:
+            url (str): the URL of the entry.
+            entry (dict): the entry returned by get().
+
+        Returns:
+            None
+        """
+        meta_path, _ = self._paths(url)
+        entry["stored_at"] = time.time()
+        with self._lock:
+            try:
+                self._write_meta(meta_path, entry)
+            except OSError as error:
+                logging.error(f"Error writing to the HTTP cache: {error}")
+
+    @staticmethod
+    def _write_meta(meta_path: str, entry: dict) -> None:
+        """
+        Writes the metadata file of an entry atomically.
+
+        Args:
+            meta_path (str): the path of the metadata file.
+            entry (dict): the cache entry.
+
+        Returns:
+            None
+        """
+        tmp_path = f"{meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, meta_path)
+
+    @staticmethod
+    def _entry_size(*paths: str) -> int:
+        """
+        Returns the total size of the existing files among the given paths.
+        """
+        size = 0
+        for path in paths:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def _evict(self) -> None:
+        """
+        Deletes the least recently used entries until the size of the cache
+        is below its limit. Must be called with the lock held.
+
+        Returns:
+            None
+        """
+        if self._size is None:
+            self._size = sum(entry.stat().st_size
+                             for entry in os.scandir(self.cache_dir))
+        if self._size <= self.max_bytes:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort()
+        # Evict down to 90% of the limit, so eviction doesn't run on every store
+        target = self.max_bytes * 0.9
+        for _, meta_path in entries:
+            if self._size <= target:
+                break
+            body_path = f"{meta_path[:-len('.json')]}.z"
+            self._size -= self._entry_size(meta_path, body_path)
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
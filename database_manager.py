@@ -1,31 +1,222 @@
 import sqlite3
 import os
-from utils import BASE_DIR
+import time
+import logging
+from utils import BASE_DIR, get_ad_key
+from dedup_cache import BloomFilter, SeenAdCache
+import metrics
+
+# Maximum number of keys bound to a single query (SQLite allows 999 variables)
+BATCH_SIZE = 500
+# Minimum number of ads the Bloom filter is sized for
+BLOOM_MIN_CAPACITY = 100000
+# Ads recorded this many seconds before the watermark of the Bloom filter are
+# read again when it is caught up, in case they were committed late
+BLOOM_WATERMARK_SLACK = 60
 
 
 class DatabaseManager():
     """Class responsible for the interactions with the database."""
 
-    def __init__(self) -> None:
+    def __init__(self, db_path: str = None, use_cache: bool = False) -> None:
         """
-        Init a new DB object and create the 'ads' table, if it doesn't exist.
+        Init a new DB object, open a persistent connection and create
+        the 'seen_ads' table, if it doesn't exist.
+
+        The known ads are stored by key (see utils.get_ad_key()), not by URL,
+        so an ad whose URL changes after a title edit isn't seen as new.
+
+        Args:
+            db_path (str): path of the database file. Defaults to
+            'database.db', in the same directory as the script.
+            use_cache (bool): if True, lookups go through an in-memory
+            Bloom filter and LRU, and only Bloom filter hits reach the disk.
         """
-        self.DB = os.path.join(BASE_DIR, "database.db")
-        self.conn = sqlite3.connect(self.DB)
-        self.cursor = self.conn.cursor()
+        self.DB = db_path or os.path.join(BASE_DIR, "database.db")
+        # Shard workers write to the same database: wait for their locks.
+        # WAL mode relies on shared memory, so all the processes must run on
+        # the same host, and the database can't be on a network filesystem
+        self.conn = sqlite3.connect(self.DB, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         sql_create_table = """
-            CREATE TABLE IF NOT EXISTS ads (
-                id          INTEGER     PRIMARY KEY     AUTOINCREMENT,
-                url         TEXT        NOT NULL
+            CREATE TABLE IF NOT EXISTS seen_ads (
+                ad_key      INTEGER     PRIMARY KEY,
+                first_seen  INTEGER     NOT NULL
+            ) WITHOUT ROWID;
+            """
+        sql_create_searches_table = """
+            CREATE TABLE IF NOT EXISTS searches (
+                url                 TEXT        PRIMARY KEY,
+                last_full_sweep     REAL
             );
             """
-        self.cursor.execute(sql_create_table)
-        self.cursor.close()
-        self.conn.commit()
+        # Ads rejected by the filter of a search, from their card: they are
+        # only known to that search, the others can still notify them
+        sql_create_rejected_table = """
+            CREATE TABLE IF NOT EXISTS rejected_ads (
+                search_url  TEXT        NOT NULL,
+                ad_key      INTEGER     NOT NULL,
+                rejected_at INTEGER     NOT NULL,
+                PRIMARY KEY (search_url, ad_key)
+            ) WITHOUT ROWID;
+            """
+        with self.conn:
+            self.conn.execute(sql_create_table)
+            self.conn.execute(sql_create_searches_table)
+            self.conn.execute(sql_create_rejected_table)
+            # Lets the Bloom filter read only the ads recorded since it was saved
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_seen_ads_first_seen ON seen_ads (first_seen)")
+        self._migrate_ads_table()
+        self.cache = None
+        self._bloom_path = f"{self.DB}.bloom"
+        self._bloom_watermark = 0
+        if use_cache:
+            self._warm_cache()
+
+    def _migrate_ads_table(self) -> None:
+        """
+        Moves the URLs of the 'ads' table, used by older versions, to the
+        'seen_ads' table, then drops the old table and reclaims its space.
+        The time the migrated ads were first seen is unknown, so it is 0.
+
+        Returns:
+            None
+        """
+        cursor = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ads'")
+        if not cursor.fetchone():
+            return
+        with self.conn:
+            cursor = self.conn.execute("SELECT url FROM ads")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO seen_ads (ad_key, first_seen) VALUES(?, 0)",
+                ((get_ad_key(url),) for url, in cursor))
+            self.conn.execute("DROP TABLE ads")
+        self.conn.execute("VACUUM")
+        logging.info("Migrated the 'ads' table to 'seen_ads'")
+
+    def _warm_cache(self) -> None:
+        """
+        Creates the seen-ad cache. The Bloom filter is restored from its
+        sidecar file, if available, and only the ads recorded after it was
+        saved are added to it.
+
+        Returns:
+            None
+        """
+        bloom, watermark = BloomFilter.load(self._bloom_path)
+        if bloom is not None:
+            watermark = self._fill_bloom(bloom, watermark)
+        if bloom is None or bloom.is_full():
+            # Resize the filter, so its false positive rate stays low
+            total = self.conn.execute("SELECT COUNT(*) FROM seen_ads").fetchone()[0]
+            bloom = BloomFilter(max(total * 2, BLOOM_MIN_CAPACITY))
+            watermark = self._fill_bloom(bloom, 0)
+        self._bloom_watermark = watermark
+        self.cache = SeenAdCache(bloom)
+
+    def _fill_bloom(self, bloom: BloomFilter, watermark: int) -> int:
+        """
+        Adds to a Bloom filter the keys of the ads first seen since the
+        watermark. They are read through the index on 'first_seen', so a
+        filter which is up to date costs a single index lookup; an empty
+        filter is filled with a scan of the whole table.
+
+        Args:
+            bloom (BloomFilter): the filter to fill.
+            watermark (int): UNIX time up to which the ads are in the filter.
+
+        Returns:
+            int: the UNIX time up to which the ads are in the filter.
+        """
+        if watermark:
+            cursor = self.conn.execute(
+                "SELECT ad_key, first_seen FROM seen_ads WHERE first_seen >= ?",
+                (max(watermark - BLOOM_WATERMARK_SLACK, 0),))
+        else:
+            cursor = self.conn.execute("SELECT ad_key, first_seen FROM seen_ads")
+        for ad_key, first_seen in cursor:
+            bloom.add(ad_key)
+            watermark = max(watermark, first_seen)
+        return watermark
+
+    def refresh_cache(self) -> None:
+        """
+        Adds to the Bloom filter the ads recorded since it was last filled,
+        including those recorded by the other processes sharing the
+        database. A Bloom filter miss is taken for a new ad without asking
+        the database, so a long-lived process must call this before each
+        cycle. Does nothing if the cache is disabled.
+
+        Returns:
+            None
+        """
+        if self.cache is None:
+            return
+        with metrics.span("db.refresh_cache"):
+            self._bloom_watermark = self._fill_bloom(
+                self.cache.bloom, self._bloom_watermark)
+
+    def _select_existing(self, keys: list) -> set:
+        """
+        Returns the keys which are found in the database, using one query
+        per batch of keys.
+
+        Args:
+            keys (list): the keys to check.
+
+        Returns:
+            set: the keys found in the database.
+        """
+        existing = set()
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = self.conn.execute(
+                f"SELECT ad_key FROM seen_ads WHERE ad_key IN ({placeholders})", batch)
+            existing.update(row[0] for row in cursor)
+        return existing
+
+    def _select_rejected(self, target_url: str, keys: list) -> set:
+        """
+        Returns the keys of the ads rejected by the filter of a search,
+        using one query per batch of keys.
+
+        Args:
+            target_url (str): the monitored URL.
+            keys (list): the keys to check.
+
+        Returns:
+            set: the keys rejected by the search.
+        """
+        rejected = set()
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = self.conn.execute(
+                f"SELECT ad_key FROM rejected_ads "
+                f"WHERE search_url = ? AND ad_key IN ({placeholders})", [target_url] + batch)
+            rejected.update(row[0] for row in cursor)
+        return rejected
+
+    def get_cache_stats(self) -> dict:
+        """
+        Returns the counters of the seen-ad cache.
+
+        Returns:
+            dict: the number of LRU hits, Bloom filter misses (certainly new
+            URLs), database confirmations and Bloom filter false positives.
+            Empty if the cache is disabled.
+        """
+        if self.cache is None:
+            return {}
+        return dict(self.cache.stats)
 
     def url_exists(self, url: str) -> bool:
         """
-        Returns True if an entry with the specified url exists
+        Returns True if the ad with the specified url exists
         in the database, otherwise False.
 
         Args:
@@ -35,21 +226,43 @@ class DatabaseManager():
             bool: True if an entry with the specified url exists in
             the database, otherwise False.
         """
-        self.conn = sqlite3.connect(self.DB)
-        self.cursor = self.conn.cursor()
-        sql_command = f"SELECT url FROM ads WHERE url = '{url}'"
-        self.cursor.execute(sql_command)
-        result = self.cursor.fetchone()
-        self.cursor.close()
-        self.conn.commit()
-        self.conn.close()
-        if result:
-            return True
-        return False
+        return not self.filter_new([url])
+
+    def filter_new(self, urls, target_url: str = None) -> set:
+        """
+        Returns the URLs of the ads which are not found in the database.
+        The ads are checked by key, in batches, with one query per batch.
+
+        Args:
+            urls (Iterable[str]): the URLs to check.
+            target_url (str): if given, the ads rejected by the filter of
+            this monitored URL are not new either.
+
+        Returns:
+            set: the URLs of the new ads. When several URLs point to the
+            same new ad, only the first one is returned.
+        """
+        with metrics.span("db.filter_new"):
+            urls_by_key = {}
+            for url in urls:
+                urls_by_key.setdefault(get_ad_key(url), url)
+            candidates = set(urls_by_key)
+            if self.cache is None:
+                new_keys = candidates - self._select_existing(list(candidates))
+            else:
+                new_keys, to_confirm = self.cache.classify(candidates)
+                not_found = to_confirm - self._select_existing(list(to_confirm))
+                self.cache.confirm(to_confirm, not_found)
+                new_keys |= not_found
+            if target_url is not None and new_keys:
+                new_keys -= self._select_rejected(target_url, list(new_keys))
+        metrics.inc("dedup.checked", len(candidates))
+        metrics.inc("dedup.hits", len(candidates) - len(new_keys))
+        return {urls_by_key[key] for key in new_keys}
 
     def add_url(self, url: str) -> None:
         """
-        Adds a new entry with the specified url to the 'ads' table.
+        Records the ad with the specified url as seen.
 
         Args:
             url (str): a string representing the URL of the item.
@@ -57,11 +270,95 @@ class DatabaseManager():
         Returns:
             None
         """
-        self.conn = sqlite3.connect(self.DB)
-        self.cursor = self.conn.cursor()
+        self.add_urls([url])
+
+    def add_urls(self, urls) -> None:
+        """
+        Records the ads with the specified URLs as seen, in a single
+        transaction. Ads already recorded are ignored.
+
+        Args:
+            urls (Iterable[str]): the URLs of the items.
+
+        Returns:
+            None
+        """
+        keys = {get_ad_key(url) for url in urls}
+        now = int(time.time())
+        with metrics.span("db.add_urls"), self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO seen_ads (ad_key, first_seen) VALUES(?, ?)",
+                ((key, now) for key in keys))
+        if self.cache is not None:
+            for key in keys:
+                self.cache.add(key)
+
+    def add_rejected(self, target_url: str, urls) -> None:
+        """
+        Records the ads rejected by the filter of a monitored URL, in a
+        single transaction. They are not recorded as seen: the other
+        searches still notify them.
 
-        sql = "INSERT INTO ads (url) VALUES(?)"
-        self.cursor.execute(sql, (url,))
-        self.cursor.close()
-        self.conn.commit()
+        Args:
+            target_url (str): the monitored URL.
+            urls (Iterable[str]): the URLs of the rejected ads.
+
+        Returns:
+            None
+        """
+        now = int(time.time())
+        with metrics.span("db.add_rejected"), self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO rejected_ads (search_url, ad_key, rejected_at) "
+                "VALUES(?, ?, ?)",
+                ((target_url, key, now) for key in {get_ad_key(url) for url in urls}))
+
+    def get_last_full_sweep(self, target_url: str) -> float:
+        """
+        Returns the time of the last full crawl of a monitored URL.
+
+        Args:
+            target_url (str): the monitored URL.
+
+        Returns:
+            float: a UNIX timestamp, or None if the URL was never fully crawled.
+        """
+        with metrics.span("db.get_last_full_sweep"):
+            cursor = self.conn.execute(
+                "SELECT last_full_sweep FROM searches WHERE url = ?", (target_url,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set_last_full_sweep(self, target_url: str, timestamp: float) -> None:
+        """
+        Records the time of the last full crawl of a monitored URL.
+
+        Args:
+            target_url (str): the monitored URL.
+            timestamp (float): a UNIX timestamp.
+
+        Returns:
+            None
+        """
+        with metrics.span("db.set_last_full_sweep"), self.conn:
+            self.conn.execute(
+                "INSERT INTO searches (url, last_full_sweep) VALUES(?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET last_full_sweep = excluded.last_full_sweep",
+                (target_url, timestamp))
+
+    def close(self) -> None:
+        """
+        Saves the Bloom filter to its sidecar file, if the cache is enabled,
+        and closes the connection to the database.
+
+        Returns:
+            None
+        """
+        if self.cache is not None:
+            try:
+                self._bloom_watermark = self._fill_bloom(
+                    self.cache.bloom, self._bloom_watermark)
+                self.cache.bloom.save(self._bloom_path, self._bloom_watermark)
+            except OSError as error:
+                logging.error(f"Error saving the Bloom filter: {error}")
         self.conn.close()
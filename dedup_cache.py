@@ -0,0 +1,219 @@
+"""
+In-memory structures used by DatabaseManager to answer "was this ad seen
+before?" without touching the disk: a Bloom filter holding the keys of all
+the known ads and a bounded LRU of recently confirmed keys.
+"""
+import os
+import math
+import struct
+import hashlib
+from collections import OrderedDict
+
+# Filters of the URL-keyed versions ("OLXB") are rebuilt from the database
+BLOOM_MAGIC = b"OLXK"
+BLOOM_HEADER = struct.Struct(">4sQQQI")
+
+
+class BloomFilter():
+    """Space-efficient probabilistic set, with no false negatives."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        """
+        Init an empty Bloom filter sized for the given number of items.
+
+        Args:
+            capacity (int): number of items the filter is sized for.
+            error_rate (float): false positive rate expected at full capacity.
+        """
+        capacity = max(int(capacity), 1)
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.capacity = capacity
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(round(self.num_bits / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        """
+        Yields the bit positions of an item, using double hashing.
+
+        Args:
+            item (int or str): the item to hash. Integers must fit in 64 bits.
+        """
+        data = item.to_bytes(8, "big", signed=True) if isinstance(item, int) \
+            else item.encode("utf-8")
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        h1, h2 = struct.unpack(">QQ", digest)
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item) -> None:
+        """
+        Adds an item to the filter. Items which are already present
+        are not counted again.
+
+        Args:
+            item (int or str): the item to add.
+
+        Returns:
+            None
+        """
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, item) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def is_full(self) -> bool:
+        """
+        Returns True if the filter holds more items than it was sized for,
+        which means its false positive rate is above the expected one.
+        """
+        return self.count > self.capacity
+
+    def save(self, path: str, watermark: int) -> None:
+        """
+        Saves the filter to a file. The file is replaced atomically.
+
+        Args:
+            path (str): path of the file.
+            watermark (int): position of the database up to which all the
+            items were added to the filter.
+
+        Returns:
+            None
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.capacity, self.count,
+                                      watermark, self.num_hashes))
+            f.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> tuple:
+        """
+        Loads a filter saved with save().
+
+        Args:
+            path (str): path of the file.
+
+        Returns:
+            Tuple[BloomFilter, int]: the filter and its watermark, or
+            (None, 0) if the file is missing or invalid.
+        """
+        try:
+            with open(path, "rb") as f:
+                header = f.read(BLOOM_HEADER.size)
+                bits = f.read()
+        except OSError:
+            return None, 0
+        if len(header) != BLOOM_HEADER.size:
+            return None, 0
+        magic, capacity, count, watermark, num_hashes = BLOOM_HEADER.unpack(header)
+        bloom = cls(capacity)
+        if magic != BLOOM_MAGIC or num_hashes != bloom.num_hashes \
+                or len(bits) != len(bloom.bits):
+            return None, 0
+        bloom.bits = bytearray(bits)
+        bloom.count = count
+        return bloom, watermark
+
+
+class SeenAdCache():
+    """Bloom filter of the keys of all known ads, plus an LRU of recent positives."""
+
+    def __init__(self, bloom: BloomFilter, lru_size: int = 10000) -> None:
+        """
+        Init a new cache.
+
+        Args:
+            bloom (BloomFilter): filter holding the keys of all the known ads.
+            lru_size (int): maximum number of recently confirmed keys kept.
+        """
+        self.bloom = bloom
+        self.lru = OrderedDict()
+        self.lru_size = lru_size
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "db_checks": 0,
+            "false_positives": 0
+        }
+
+    def remember(self, key: int) -> None:
+        """
+        Marks a key as recently confirmed.
+
+        Args:
+            key (int): the key of the ad.
+
+        Returns:
+            None
+        """
+        self.lru[key] = True
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def add(self, key: int) -> None:
+        """
+        Adds the key of a new ad to the cache.
+
+        Args:
+            key (int): the key of the ad.
+
+        Returns:
+            None
+        """
+        self.bloom.add(key)
+        self.remember(key)
+
+    def classify(self, keys) -> tuple[set, set]:
+        """
+        Splits keys into those which are certainly new and those which
+        must be confirmed in the database. Recently confirmed keys are
+        dropped from both sets.
+
+        Args:
+            keys (Iterable[int]): the keys to check.
+
+        Returns:
+            Tuple[set, set]: the new keys and the keys to confirm.
+        """
+        new_keys = set()
+        to_confirm = set()
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                self.stats["hits"] += 1
+            elif key in self.bloom:
+                to_confirm.add(key)
+            else:
+                self.stats["misses"] += 1
+                new_keys.add(key)
+        self.stats["db_checks"] += len(to_confirm)
+        return new_keys, to_confirm
+
+    def confirm(self, checked: set, not_found: set) -> None:
+        """
+        Records the result of a database confirmation.
+
+        Args:
+            checked (set): the keys confirmed in the database.
+            not_found (set): the keys missing from the database, which were
+            Bloom filter false positives.
+
+        Returns:
+            None
+        """
+        self.stats["false_positives"] += len(not_found)
+        for key in checked - not_found:
+            self.remember(key)
@@ -0,0 +1,411 @@
+"""
+Backends that extract the ads data from the HTML of the OLX pages.
+SoupExtractor, based on BeautifulSoup, is the reference implementation.
+LxmlExtractor gives the same output, several times faster, and is used
+automatically when lxml is installed. StateJsonExtractor reads the JSON
+state embedded in the pages instead of the generated CSS classes, and
+returns complete ad records straight from the pages of results.
+
+Run this module with saved HTML pages as arguments to check that all the
+available backends extract the same data from them:
+    python extractors.py page1.html page2.html
+"""
+import re
+import sys
+import json
+import html as html_lib
+import logging
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Tags and CSS classes of the elements holding the data on the OLX sites
+OLX_SELECTORS = {
+    "listing_ad": ("div", "css-1sw7q4x"),
+    "listing_link": ("a", "css-rc5s2u"),
+    "listing_title": ("h6", "css-16v5mdi"),
+    "listing_price": ("p", "css-10b0gli"),
+    "pagination": ("ul", "pagination-list"),
+    "pagination_item": ("li", "pagination-item"),
+    "ad_fields": {
+        "title": ("h1", "css-1soizd2"),
+        "price": ("h3", "css-ddweki"),
+        "description": ("div", "css-bgzo2k"),
+        "seller": ("h4", "css-1lcz6o7")
+    }
+}
+# Version of the format of the extracted data. Must be increased whenever
+# the data returned by the extractors changes, so that the data extracted
+# by an older version and kept in the HTTP cache is not used anymore
+EXTRACTOR_VERSION = 4
+# Separator between the text fragments of a field
+AD_FIELD_SEPARATORS = {"description": "\n"}
+# Variable holding the JSON state of the page, assigned in an inline script
+STATE_MARKER = "window.__PRERENDERED_STATE__"
+
+
+class SoupExtractor():
+    """Reference extractor, based on BeautifulSoup."""
+
+    name = "soup"
+
+    def __init__(self, selectors: dict = None) -> None:
+        """
+        Args:
+            selectors (dict): the tags and CSS classes of the elements holding
+            the data. Defaults to OLX_SELECTORS.
+        """
+        self.selectors = selectors or OLX_SELECTORS
+
+    def parse_listing(self, html: str) -> dict:
+        """
+        Extracts the links of the ads and the number of the last page from
+        a page of results.
+
+        Args:
+            html (str): the HTML of the page.
+
+        Returns:
+            dict: the 'links' (list of href values, in page order), the
+            'last_page' (int or None) and the 'cards' - the 'title' and the
+            'price' shown for each link (str or None).
+        """
+        content = BeautifulSoup(html, "html.parser")
+        selectors = self.selectors
+        links = []
+        cards = {}
+        for ad in content.find_all(selectors["listing_ad"][0],
+                                   class_=selectors["listing_ad"][1]):
+            link = ad.find(selectors["listing_link"][0],
+                           class_=selectors["listing_link"][1])
+            if link is not None and link.has_attr("href"):
+                links.append(link["href"])
+                card = {}
+                for field in ("title", "price"):
+                    tag, class_name = selectors[f"listing_{field}"]
+                    element = ad.find(tag, class_=class_name)
+                    card[field] = element.get_text(strip=True, separator=" ") \
+                        if element is not None else None
+                cards[link["href"]] = card
+        last_page = None
+        pagination_ul = content.find(selectors["pagination"][0],
+                                     class_=selectors["pagination"][1])
+        if pagination_ul is not None:
+            pages = pagination_ul.find_all(selectors["pagination_item"][0],
+                                           class_=selectors["pagination_item"][1])
+            if pages:
+                last_page = int(pages[-1].text)
+        return {"links": links, "last_page": last_page, "cards": cards}
+
+    def parse_ad(self, html: str) -> dict:
+        """
+        Extracts the fields of an ad from its page.
+
+        Args:
+            html (str): the HTML of the page.
+
+        Returns:
+            dict: the 'title', 'price', 'description' and 'seller' of the
+            ad. The fields which are not found are None.
+        """
+        content = BeautifulSoup(html, "html.parser")
+        fields = {}
+        for field, (tag, class_name) in self.selectors["ad_fields"].items():
+            element = content.find(tag, class_=class_name)
+            fields[field] = None
+            if element is not None:
+                fields[field] = element.get_text(
+                    strip=True, separator=AD_FIELD_SEPARATORS.get(field, ""))
+        return fields
+
+
+def _class_xpath(tag: str, class_name: str) -> str:
+    """
+    Returns an XPath expression matching the elements with the given tag
+    and CSS class, like BeautifulSoup's find(tag, class_=class_name).
+    """
+    return f"//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+
+
+class LxmlExtractor():
+    """Fast extractor, based on lxml. Gives the same output as SoupExtractor."""
+
+    name = "lxml"
+
+    def __init__(self, selectors: dict = None) -> None:
+        """
+        Args:
+            selectors (dict): the tags and CSS classes of the elements holding
+            the data. Defaults to OLX_SELECTORS.
+
+        Raises:
+            ImportError: If lxml is not installed.
+        """
+        if lxml is None:
+            raise ImportError("lxml is not installed")
+        selectors = selectors or OLX_SELECTORS
+        self._ads_xpath = _class_xpath(*selectors["listing_ad"])
+        self._link_xpath = "." + _class_xpath(*selectors["listing_link"])
+        self._card_xpaths = {field: f"(.{_class_xpath(*selectors[f'listing_{field}'])})[1]"
+                             for field in ("title", "price")}
+        self._pages_xpath = f"({_class_xpath(*selectors['pagination'])})[1]" \
+            + _class_xpath(*selectors["pagination_item"])
+        self._fields_xpath = {field: f"({_class_xpath(*selector)})[1]"
+                              for field, selector in selectors["ad_fields"].items()}
+
+    @staticmethod
+    def _parse(html: str):
+        """
+        Parses a document, returning None if it is empty or invalid.
+        """
+        try:
+            return lxml.html.document_fromstring(html)
+        except (ValueError, lxml.etree.ParserError):
+            return None
+
+    @staticmethod
+    def _get_text(element, separator: str) -> str:
+        """
+        Equivalent of BeautifulSoup's get_text(strip=True, separator=...).
+        """
+        strings = element.xpath(
+            ".//text()[not(ancestor::script) and not(ancestor::style)]")
+        return separator.join(
+            string.strip() for string in strings if string.strip())
+
+    def parse_listing(self, html: str) -> dict:
+        """
+        Same as SoupExtractor.parse_listing().
+        """
+        document = self._parse(html)
+        if document is None:
+            return {"links": [], "last_page": None, "cards": {}}
+        links = []
+        cards = {}
+        for ad in document.xpath(self._ads_xpath):
+            link = ad.xpath(self._link_xpath)
+            if link and link[0].get("href") is not None:
+                href = link[0].get("href")
+                links.append(href)
+                card = {}
+                for field, xpath in self._card_xpaths.items():
+                    element = ad.xpath(xpath)
+                    card[field] = self._get_text(element[0], " ") if element else None
+                cards[href] = card
+        last_page = None
+        pages = document.xpath(self._pages_xpath)
+        if pages:
+            last_page = int(pages[-1].text_content())
+        return {"links": links, "last_page": last_page, "cards": cards}
+
+    def parse_ad(self, html: str) -> dict:
+        """
+        Same as SoupExtractor.parse_ad().
+        """
+        document = self._parse(html)
+        fields = dict.fromkeys(self._fields_xpath)
+        if document is None:
+            return fields
+        for field, xpath in self._fields_xpath.items():
+            element = document.xpath(xpath)
+            if element:
+                fields[field] = self._get_text(
+                    element[0], AD_FIELD_SEPARATORS.get(field, ""))
+        return fields
+
+
+class StateJsonExtractor():
+    """
+    Extractor that reads the JSON state embedded by OLX in its pages. It
+    doesn't depend on the generated CSS class names, and the pages of results
+    hold the full records of their ads. Falls back to the fastest HTML
+    extractor for the pages without a JSON state.
+    """
+
+    name = "json"
+
+    def __init__(self, selectors: dict = None) -> None:
+        """
+        Args:
+            selectors (dict): the selectors of the fallback HTML extractor.
+        """
+        self.fallback = get_extractor("auto", selectors)
+
+    @staticmethod
+    def get_state(html: str) -> dict:
+        """
+        Returns the JSON state of a page. The state is located with a plain
+        string search and decoded once, without parsing the HTML.
+
+        Args:
+            html (str): the HTML of the page.
+
+        Returns:
+            dict: the decoded state, or None if the page has no valid state.
+        """
+        start = html.find(STATE_MARKER)
+        if start == -1:
+            return None
+        start = html.find("=", start + len(STATE_MARKER))
+        if start == -1:
+            return None
+        start += 1
+        while start < len(html) and html[start].isspace():
+            start += 1
+        try:
+            state, _ = json.JSONDecoder().raw_decode(html, start)
+            # The state is usually assigned as a JSON-encoded string
+            if isinstance(state, str):
+                state = json.loads(state)
+        except ValueError:
+            return None
+        return state if isinstance(state, dict) else None
+
+    @staticmethod
+    def _html_to_text(value: str) -> str:
+        """
+        Converts the HTML of a description to plain text.
+        """
+        value = re.sub(r"<br\s*/?>", "\n", value, flags=re.IGNORECASE)
+        value = html_lib.unescape(re.sub(r"<[^>]+>", "", value))
+        lines = (line.strip() for line in value.splitlines())
+        return "\n".join(line for line in lines if line)
+
+    @staticmethod
+    def get_record(ad: dict) -> dict:
+        """
+        Converts an ad of the JSON state to an ad record.
+
+        Args:
+            ad (dict): the ad, as found in the JSON state.
+
+        Returns:
+            dict: the 'title', 'price', 'description' and 'seller' fields, as
+            returned by parse_ad(), plus the 'url', 'ad_id', 'price_value',
+            'currency', 'created_time' and 'refreshed_time' of the ad.
+        """
+        price = ad.get("price") or {}
+        regular_price = price.get("regularPrice") or {}
+        description = ad.get("description")
+        return {
+            "title": ad.get("title"),
+            "price": price.get("displayValue"),
+            "description": StateJsonExtractor._html_to_text(description)
+            if description is not None else None,
+            "seller": (ad.get("user") or {}).get("name"),
+            "url": ad.get("url"),
+            "ad_id": ad.get("id"),
+            "price_value": regular_price.get("value"),
+            "currency": regular_price.get("currencyCode"),
+            "created_time": ad.get("createdTime"),
+            "refreshed_time": ad.get("lastRefreshTime")
+        }
+
+    def parse_listing(self, html: str) -> dict:
+        """
+        Same as SoupExtractor.parse_listing(), plus the 'records' of the ads,
+        mapped to their links.
+        """
+        state = self.get_state(html)
+        listing = ((state or {}).get("listing") or {}).get("listing")
+        if not isinstance(listing, dict) or "ads" not in listing:
+            return self.fallback.parse_listing(html)
+        records = {}
+        for ad in listing["ads"]:
+            record = self.get_record(ad)
+            if record["url"]:
+                records[record["url"]] = record
+        last_page = listing.get("totalPages")
+        return {
+            "links": list(records),
+            "last_page": int(last_page) if last_page else None,
+            "cards": {url: {field: record[field] for field in
+                            ("title", "price", "price_value", "currency")}
+                      for url, record in records.items()},
+            "records": records
+        }
+
+    def parse_ad(self, html: str) -> dict:
+        """
+        Same as SoupExtractor.parse_ad(), plus the other fields of the
+        ad record when the page has a JSON state.
+        """
+        state = self.get_state(html)
+        ad = ((state or {}).get("ad") or {}).get("ad")
+        if not isinstance(ad, dict):
+            return self.fallback.parse_ad(html)
+        return self.get_record(ad)
+
+
+EXTRACTORS = {
+    SoupExtractor.name: SoupExtractor,
+    LxmlExtractor.name: LxmlExtractor,
+    StateJsonExtractor.name: StateJsonExtractor
+}
+
+
+def get_extractor(name: str = "auto", selectors: dict = None):
+    """
+    Returns an extractor instance.
+
+    Args:
+        name (str): 'soup', 'lxml', 'json' or 'auto' - the fastest available
+        HTML backend.
+        selectors (dict): the tags and CSS classes of the elements holding
+        the data. Defaults to OLX_SELECTORS.
+
+    Returns:
+        SoupExtractor, LxmlExtractor or StateJsonExtractor: the extractor.
+
+    Raises:
+        ValueError: If the name of the extractor is unknown.
+    """
+    if name == "auto":
+        name = "lxml" if lxml is not None else "soup"
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown extractor '{name}'")
+    try:
+        return EXTRACTORS[name](selectors)
+    except ImportError as error:
+        logging.error(f"Extractor '{name}' unavailable ({error}), using 'soup'")
+        return SoupExtractor(selectors)
+
+
+def check_parity(html: str) -> list:
+    """
+    Compares the output of all the available HTML extractors with the output
+    of the reference extractor, for both the listing and the ad fields.
+
+    Args:
+        html (str): the HTML of a page.
+
+    Returns:
+        list: the names of the extractors whose output differs.
+    """
+    reference = SoupExtractor()
+    expected = (reference.parse_listing(html), reference.parse_ad(html))
+    different = []
+    for name, extractor_class in EXTRACTORS.items():
+        if extractor_class is StateJsonExtractor:
+            # Reads a different source, so its output is richer by design
+            continue
+        try:
+            extractor = extractor_class()
+        except ImportError:
+            continue
+        if (extractor.parse_listing(html), extractor.parse_ad(html)) != expected:
+            different.append(name)
+    return different
+
+
+if __name__ == "__main__":
+    failed = False
+    for path in sys.argv[1:]:
+        with open(path, encoding="utf-8") as f:
+            different = check_parity(f.read())
+        print(json.dumps({"file": path, "different": different}))
+        failed = failed or bool(different)
+    sys.exit(1 if failed else 0)
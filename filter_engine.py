@@ -0,0 +1,224 @@
+"""
+Per-search filters, set as options of the monitored URLs in 'target_urls.txt':
+    https://www.olx.ro/oferte/q-raspberry-pi/ max_price=400 exclude=defect,piese
+
+    min_price, max_price    price range, in the currency of the ad
+    include                 comma-separated keywords, at least one of which
+                            must appear in the title or the description
+    exclude                 comma-separated keywords, none of which may
+                            appear in the title or the description
+    title_regex             regular expression the title must match
+    exclude_sellers         comma-separated names of sellers to ignore
+
+The filters are compiled once, when the options are loaded: the keywords of
+a search become a single regular expression, matched against the text
+normalized like the titles of the price history (case, accents, spacing).
+
+A filter is applied twice. First to the cards of the pages of results, before
+the pages of the ads are fetched: an ad is rejected there only when the card
+is enough to be sure, e.g. when its price is out of range or its title contains
+an excluded keyword. Then to the full data of the ads, before notifying them.
+"""
+import re
+import logging
+from utils import normalize_text, parse_price
+
+# Options of 'target_urls.txt' handled by the filters
+FILTER_OPTIONS = ("min_price", "max_price", "include", "exclude",
+                  "title_regex", "exclude_sellers")
+
+
+def normalize(text: str) -> str:
+    """
+    Returns the form of a text used for matching: lowercase, without accents,
+    with single spaces.
+
+    Args:
+        text (str): the text.
+
+    Returns:
+        str: the normalized text.
+    """
+    return " ".join(normalize_text(text).lower().split())
+
+
+def split_list(value: str) -> list:
+    """
+    Splits a comma-separated option value into its normalized items.
+
+    Args:
+        value (str): the value of the option.
+
+    Returns:
+        list: the non-empty items.
+    """
+    items = (normalize(item) for item in value.split(","))
+    return [item for item in items if item]
+
+
+def compile_keywords(keywords: list) -> re.Pattern:
+    """
+    Compiles keywords into a single regular expression matching any of them
+    as whole words. Longer keywords are tried first.
+
+    Args:
+        keywords (list): the normalized keywords.
+
+    Returns:
+        re.Pattern: the compiled expression, or None if there are no keywords.
+    """
+    if not keywords:
+        return None
+    alternatives = "|".join(
+        re.escape(keyword) for keyword in sorted(set(keywords), key=len, reverse=True))
+    return re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)")
+
+
+class SearchFilter():
+    """Compiled filter of a monitored URL."""
+
+    def __init__(self, min_price: float = None, max_price: float = None,
+                 include: list = None, exclude: list = None,
+                 title_regex: str = None, exclude_sellers: list = None) -> None:
+        """
+        Init a new filter.
+
+        Args:
+            min_price (float): minimum price of the ads.
+            max_price (float): maximum price of the ads.
+            include (list): keywords, at least one of which must appear in
+            the title or the description.
+            exclude (list): keywords which must not appear in the title or
+            the description.
+            title_regex (str): regular expression the normalized title must match.
+            exclude_sellers (list): names of the sellers to ignore.
+
+        Raises:
+            ValueError: If the regular expression is invalid.
+        """
+        self.min_price = min_price
+        self.max_price = max_price
+        self.include = compile_keywords([normalize(item) for item in include or []])
+        self.exclude = compile_keywords([normalize(item) for item in exclude or []])
+        try:
+            self.title_regex = re.compile(title_regex, re.IGNORECASE) \
+                if title_regex else None
+        except re.error as error:
+            raise ValueError(f"Invalid title_regex '{title_regex}': {error}") from error
+        self.exclude_sellers = frozenset(normalize(item) for item in exclude_sellers or [])
+
+    @classmethod
+    def from_options(cls, options: dict):
+        """
+        Compiles the filter options of a monitored URL.
+
+        Args:
+            options (dict): the options of the URL, as parsed from 'target_urls.txt'.
+
+        Returns:
+            SearchFilter: the filter, or None if no filter option is set.
+
+        Raises:
+            ValueError: If an option has an invalid value.
+        """
+        if not any(options.get(option) not in (None, "") for option in FILTER_OPTIONS):
+            return None
+        prices = {}
+        for option in ("min_price", "max_price"):
+            value = options.get(option)
+            if value in (None, ""):
+                continue
+            try:
+                prices[option] = float(value)
+            except ValueError:
+                raise ValueError(f"Invalid value for option '{option}': {value}")
+        return cls(
+            include=split_list(options.get("include", "")),
+            exclude=split_list(options.get("exclude", "")),
+            title_regex=options.get("title_regex") or None,
+            exclude_sellers=split_list(options.get("exclude_sellers", "")),
+            **prices)
+
+    def _check_price(self, fields: dict) -> bool:
+        """
+        Returns False if the price of an ad is known and out of range.
+        """
+        if self.min_price is None and self.max_price is None:
+            return True
+        price = fields.get("price_value")
+        if price is None and fields.get("price"):
+            price, _ = parse_price(fields["price"])
+        if price is None:
+            return True
+        if self.min_price is not None and price < self.min_price:
+            return False
+        return self.max_price is None or price <= self.max_price
+
+    def match_card(self, card: dict) -> bool:
+        """
+        Checks an ad as shown on a page of results. Only the conditions which
+        can be decided from the card reject it.
+
+        Args:
+            card (dict): the 'title', 'price' and, if known, 'price_value'
+            and 'seller' of the ad.
+
+        Returns:
+            bool: False if the ad certainly doesn't match the filter.
+        """
+        if not self._check_price(card):
+            return False
+        title = normalize(card.get("title") or "")
+        if title:
+            if self.title_regex is not None and not self.title_regex.search(title):
+                return False
+            if self.exclude is not None and self.exclude.search(title):
+                return False
+        seller = card.get("seller")
+        return not (seller and normalize(seller) in self.exclude_sellers)
+
+    def match_ad(self, ad_data: dict) -> bool:
+        """
+        Checks the full data of an ad.
+
+        Args:
+            ad_data (dict): the data of the ad, as returned by the scraper.
+
+        Returns:
+            bool: True if the ad matches the filter.
+        """
+        if not self.match_card(ad_data):
+            return False
+        text = normalize(f"{ad_data.get('title') or ''} {ad_data.get('description') or ''}")
+        if self.include is not None and not self.include.search(text):
+            return False
+        return self.exclude is None or not self.exclude.search(text)
+
+
+_compiled = {}
+
+
+def get_filter(target_url: str, options: dict) -> SearchFilter:
+    """
+    Returns the compiled filter of a monitored URL. Filters are compiled
+    once and reused as long as the options of the URL don't change.
+
+    Args:
+        target_url (str): the monitored URL.
+        options (dict): the options of the URL.
+
+    Returns:
+        SearchFilter: the filter, or None if the URL has no filter or if
+        its options are invalid.
+    """
+    key = tuple((option, options.get(option)) for option in FILTER_OPTIONS)
+    cached = _compiled.get(target_url)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    try:
+        search_filter = SearchFilter.from_options(options)
+    except ValueError as error:
+        logging.error(f"Filter of {target_url} ignored: {error}")
+        search_filter = None
+    _compiled[target_url] = (key, search_filter)
+    return search_filter
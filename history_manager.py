@@ -0,0 +1,257 @@
+"""
+Price and listing history of the monitored ads. Every crawl appends, in one
+batch, a snapshot of the ads shown on the pages of results - price, currency
+and title hash - to the 'ad_snapshots' table, and compares it with the latest
+snapshot of each ad to detect price drops and relisted ads. The ad pages are
+never fetched for this: the data comes from the pages of results.
+"""
+import time
+import sqlite3
+import threading
+from utils import get_ad_key, get_title_hash
+import metrics
+
+# Maximum number of keys bound to a single query (SQLite allows 999 variables)
+BATCH_SIZE = 500
+# An unchanged ad gets a new snapshot at most this often (seconds), which
+# records that it is still listed without growing the table on every poll
+SNAPSHOT_INTERVAL = 24 * 3600
+# A new ad is only taken for a relist of an ad seen during this period
+# (seconds)...
+RELIST_WINDOW = 30 * 24 * 3600
+# ...at about the same price: at most this fraction above or below it
+RELIST_MAX_PRICE_CHANGE = 0.2
+# Change types reported by AdHistory.record()
+PRICE_DROP = "price_drop"
+RELIST = "relist"
+
+
+class AdHistory():
+    """Class that records the snapshots of the ads and detects their changes."""
+
+    def __init__(self, db_path: str, min_drop_percent: float = 0) -> None:
+        """
+        Init a new history and create its table, if it doesn't exist. The
+        history has its own connection, like the pipeline.
+
+        Args:
+            db_path (str): path of the database file.
+            min_drop_percent (float): smaller price drops are not reported.
+        """
+        self.min_drop_percent = min_drop_percent
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+        sql_create_table = """
+            CREATE TABLE IF NOT EXISTS ad_snapshots (
+                ad_key      INTEGER     NOT NULL,
+                seen_at     INTEGER     NOT NULL,
+                price       REAL,
+                currency    TEXT,
+                title_hash  INTEGER     NOT NULL,
+                PRIMARY KEY (ad_key, seen_at)
+            ) WITHOUT ROWID;
+            """
+        with self._lock, self.conn:
+            self.conn.execute(sql_create_table)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_ad_snapshots_title "
+                "ON ad_snapshots (title_hash)")
+
+    def _select_latest(self, keys: list) -> dict:
+        """
+        Returns the latest snapshot of each ad, using the primary key index.
+        Must be called with the lock held.
+
+        Args:
+            keys (list): the keys of the ads.
+
+        Returns:
+            dict: the keys mapped to their (seen_at, price, currency,
+            title_hash) tuple. Ads without snapshots are not included.
+        """
+        latest = {}
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = self.conn.execute(
+                f"SELECT ad_key, MAX(seen_at), price, currency, title_hash "
+                f"FROM ad_snapshots WHERE ad_key IN ({placeholders}) GROUP BY ad_key",
+                batch)
+            for ad_key, seen_at, price, currency, title_hash in cursor:
+                latest[ad_key] = (seen_at, price, currency, title_hash)
+        return latest
+
+    def _select_by_title(self, title_hashes: list, since: int) -> dict:
+        """
+        Returns the latest snapshot of the ads with the given title hashes
+        seen since a given time. Must be called with the lock held.
+
+        Args:
+            title_hashes (list): the title hashes.
+            since (int): UNIX time of the oldest snapshots returned.
+
+        Returns:
+            dict: the title hashes mapped to the list of the (ad_key,
+            seen_at, price, currency) tuples of the ads with that title,
+            most recently seen first.
+        """
+        found = {}
+        for start in range(0, len(title_hashes), BATCH_SIZE):
+            batch = title_hashes[start:start + BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = self.conn.execute(
+                f"SELECT title_hash, ad_key, MAX(seen_at), price, currency "
+                f"FROM ad_snapshots WHERE title_hash IN ({placeholders}) "
+                f"AND seen_at >= ? GROUP BY title_hash, ad_key", batch + [since])
+            for title_hash, ad_key, seen_at, price, currency in cursor:
+                found.setdefault(title_hash, []).append((ad_key, seen_at, price, currency))
+        for matches in found.values():
+            matches.sort(key=lambda match: match[1], reverse=True)
+        return found
+
+    @staticmethod
+    def _find_relisted(key: int, price: float, currency: str, matches: list) -> tuple:
+        """
+        Returns the ad relisted by a new ad, among the recent ads with the
+        same title: an ad of the same site, under another ID, at about the
+        same price in the same currency. The title alone is not enough, as
+        common titles are used by unrelated sellers.
+
+        Args:
+            key (int): the key of the new ad.
+            price (float): the price of the new ad.
+            currency (str): the currency of the new ad.
+            matches (list): the snapshots returned by _select_by_title()
+            for the title of the new ad.
+
+        Returns:
+            tuple: the (ad_key, seen_at, price, currency) snapshot of the
+            relisted ad, or None.
+        """
+        if price is None or price <= 0:
+            return None
+        return next(
+            (match for match in matches
+             if match[0] != key and match[0] >> 48 == key >> 48
+             and match[3] == currency and match[2] is not None
+             and abs(price - match[2]) <= match[2] * RELIST_MAX_PRICE_CHANGE),
+            None)
+
+    def record(self, cards: dict) -> list:
+        """
+        Appends the snapshots of the ads seen in a crawl and returns their
+        changes since their latest snapshot:
+            - a price drop, when the price of an ad is lower than before,
+            in the same currency;
+            - a relist, when a new ad has the same title as an ad of the same
+            site seen under another ID in the last RELIST_WINDOW seconds,
+            at a price within RELIST_MAX_PRICE_CHANGE of its own.
+
+        Args:
+            cards (dict): the URLs of the ads mapped to their 'title',
+            'price', 'price_value' and 'currency', as shown on the pages of
+            results.
+
+        Returns:
+            List[dict]: the changes, each with its 'type' (PRICE_DROP or
+            RELIST), the 'url', 'title' and 'price' of the ad, and the
+            'old_price', 'new_price' and 'currency'.
+        """
+        now = int(time.time())
+        snapshots = {}
+        for url, card in cards.items():
+            if not card.get("title"):
+                continue
+            snapshots[get_ad_key(url)] = (url, card, get_title_hash(card["title"]))
+        if not snapshots:
+            return []
+        changes = []
+        rows = []
+        with metrics.span("history.record"), self._lock:
+            latest = self._select_latest(list(snapshots))
+            # Relists are only searched for ads with a regular key
+            new_titles = [title_hash for key, (_, _, title_hash) in snapshots.items()
+                          if key not in latest and key >= 0]
+            previous_by_title = self._select_by_title(
+                new_titles, now - RELIST_WINDOW) if new_titles else {}
+            for key, (url, card, title_hash) in snapshots.items():
+                price, currency = card.get("price_value"), card.get("currency")
+                previous = latest.get(key)
+                if previous is None:
+                    match = self._find_relisted(
+                        key, price, currency, previous_by_title.get(title_hash, []))
+                    if match is not None:
+                        changes.append(self._change(RELIST, url, card, match[2], match[3]))
+                    rows.append((key, now, price, currency, title_hash))
+                    continue
+                seen_at, old_price, old_currency, old_title_hash = previous
+                if self._is_drop(old_price, old_currency, price, currency):
+                    changes.append(self._change(PRICE_DROP, url, card, old_price, old_currency))
+                if (price, currency, title_hash) != (old_price, old_currency, old_title_hash) \
+                        or now - seen_at >= SNAPSHOT_INTERVAL:
+                    rows.append((key, max(now, seen_at + 1), price, currency, title_hash))
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO ad_snapshots "
+                    "(ad_key, seen_at, price, currency, title_hash) VALUES(?, ?, ?, ?, ?)",
+                    rows)
+        metrics.inc("history.snapshots", len(rows))
+        metrics.inc("history.price_drops",
+                    sum(change["type"] == PRICE_DROP for change in changes))
+        metrics.inc("history.relists", sum(change["type"] == RELIST for change in changes))
+        return changes
+
+    def _is_drop(self, old_price: float, old_currency: str,
+                 price: float, currency: str) -> bool:
+        """
+        Returns True if the new price is lower than the old one, in the same
+        currency, by at least min_drop_percent.
+        """
+        if old_price is None or price is None or old_currency != currency \
+                or old_price <= 0:
+            return False
+        return price < old_price \
+            and (old_price - price) / old_price * 100 >= self.min_drop_percent
+
+    @staticmethod
+    def _change(change_type: str, url: str, card: dict,
+                old_price: float, old_currency: str) -> dict:
+        """
+        Builds the description of a change.
+        """
+        return {
+            "type": change_type,
+            "url": url,
+            "title": card["title"],
+            "price": card.get("price"),
+            "old_price": old_price,
+            "new_price": card.get("price_value"),
+            "currency": card.get("currency") or old_currency
+        }
+
+    def get_history(self, url: str) -> list:
+        """
+        Returns the snapshots of an ad, oldest first.
+
+        Args:
+            url (str): the URL of the ad.
+
+        Returns:
+            List[Tuple[int, float, str]]: the time (UNIX timestamp), the
+            price and the currency of each snapshot.
+        """
+        with self._lock:
+            return self.conn.execute(
+                "SELECT seen_at, price, currency FROM ad_snapshots "
+                "WHERE ad_key = ? ORDER BY seen_at", (get_ad_key(url),)).fetchall()
+
+    def close(self) -> None:
+        """
+        Closes the connection of the history.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,303 @@
+"""
+Shared HTTP transport used by the scraper and by the notification services.
+Requests go through a pooled session, so the DNS, TCP and TLS handshakes
+are made once per host and the connections are reused afterwards.
+"""
+import os
+import time
+import logging
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils import BASE_DIR
+from rate_limiter import AdaptiveRateLimiter
+
+# Responses that are worth retrying: rate limiting and server errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class SafeRetry(Retry):
+    """
+    Retry policy which only repeats the requests that are safe to repeat.
+    GET requests are retried on all the RETRY_STATUS_CODES. A POST, e.g. a
+    Telegram message, is not idempotent: after a server error it may have
+    been processed, so it is only retried after a 429, which the server
+    answers without processing the request.
+    """
+
+    def is_retry(self, method: str, status_code: int,
+                 has_retry_after: bool = False) -> bool:
+        if method.upper() == "POST":
+            return status_code == 429 and status_code in (self.status_forcelist or ())
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class HttpClient():
+    """Class that wraps a pooled requests session with retry/backoff."""
+
+    def __init__(self, pool_size: int = None, max_retries: int = None,
+                 backoff_factor: float = None,
+                 limiter: AdaptiveRateLimiter = None, proxy: str = None,
+                 limiter_key: str = None) -> None:
+        """
+        Init a new HTTP client. The settings which are not specified are read
+        from the HTTP_POOL_SIZE, HTTP_MAX_RETRIES and HTTP_BACKOFF_FACTOR
+        environment variables.
+
+        Args:
+            pool_size (int): maximum number of connections kept open per host.
+            max_retries (int): maximum number of retries for a request.
+            backoff_factor (float): base of the exponential backoff, in seconds.
+            limiter (AdaptiveRateLimiter): optional per-host rate limiter,
+            applied to every request and fed with its outcome.
+            proxy (str): optional URL of the proxy of all the requests.
+            limiter_key (str): if given, the client has its own limits for
+            each host, e.g. one per egress proxy, kept under
+            '<host>@<limiter_key>' in the rate limiter.
+        """
+        self.limiter = limiter
+        self.limiter_key = limiter_key
+        if pool_size is None:
+            pool_size = int(os.getenv("HTTP_POOL_SIZE", 10))
+        if max_retries is None:
+            max_retries = int(os.getenv("HTTP_MAX_RETRIES", 3))
+        if backoff_factor is None:
+            backoff_factor = float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5))
+        self.max_retries = max_retries
+        # With a rate limiter, the answers with a retryable status are
+        # retried by request(), so the limiter sees each of them and paces
+        # the retries. urllib3 only retries the connection errors.
+        self.retry = SafeRetry(
+            total=max_retries,
+            status=0 if limiter is not None else None,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=self.retry
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        if proxy is not None:
+            self.session.proxies = {"http": proxy, "https": proxy}
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a GET request through the pooled session.
+
+        Args:
+            url (str): the URL to request.
+            **kwargs: arguments passed to requests.Session.get().
+
+        Returns:
+            requests.Response: the response of the server.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails.
+        """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a POST request through the pooled session.
+
+        Args:
+            url (str): the URL to request.
+            **kwargs: arguments passed to requests.Session.post().
+
+        Returns:
+            requests.Response: the response of the server.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails.
+        """
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request through the pooled session. With a rate limiter,
+        waits for the budget of the host first, then reports the outcome,
+        and retries the answers with a retryable status the same way.
+
+        Args:
+            method (str): the HTTP method.
+            url (str): the URL to request.
+            **kwargs: arguments passed to requests.Session.request().
+
+        Returns:
+            requests.Response: the response of the server.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails.
+        """
+        if self.limiter is None:
+            return self.session.request(method, url, **kwargs)
+        host = self.get_limiter_key(urlparse(url).netloc)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(host)
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                self.limiter.record(host, None, time.monotonic() - start)
+                raise
+            retry_after = response.headers.get("Retry-After")
+            self.limiter.record(
+                host, response.status_code, time.monotonic() - start,
+                float(retry_after) if retry_after and retry_after.isdigit() else None)
+            if attempt == self.max_retries \
+                    or not self.retry.is_retry(method, response.status_code):
+                return response
+            response.close()
+
+    def get_limiter_key(self, host: str) -> str:
+        """
+        Returns the key of the rate limits of a host, for this client.
+
+        Args:
+            host (str): the host, e.g. 'www.olx.ro'.
+
+        Returns:
+            str: the key.
+        """
+        return host if self.limiter_key is None else f"{host}@{self.limiter_key}"
+
+    def get_stats(self) -> dict:
+        """
+        Returns the connection reuse counters of the connection pools.
+
+        Returns:
+            dict: the number of requests sent, the number of connections
+            opened and the number of requests sent over a reused connection.
+        """
+        requests_count = 0
+        connections_count = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_count += pool.num_requests
+            connections_count += pool.num_connections
+        return {
+            "requests": requests_count,
+            "connections": connections_count,
+            "reused": max(requests_count - connections_count, 0)
+        }
+
+    def close(self) -> None:
+        """
+        Closes all the pooled connections.
+
+        Returns:
+            None
+        """
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_limiter = None
+_limiter_pid = None
+_proxy_pool = None
+_proxy_pool_pid = None
+
+
+def get_rate_limiter() -> AdaptiveRateLimiter:
+    """
+    Returns the per-host rate limiter of the current process. Unless
+    RATE_LIMIT_SHARED is set to 0, the limiter keeps its state in the
+    'rate_limits' directory, so the limits are shared by all the processes.
+
+    Returns:
+        AdaptiveRateLimiter: the shared rate limiter.
+    """
+    global _limiter, _limiter_pid
+    if _limiter is None or _limiter_pid != os.getpid():
+        state_dir = None
+        if os.getenv("RATE_LIMIT_SHARED", "1") == "1":
+            state_dir = os.path.join(BASE_DIR, "rate_limits")
+        _limiter = AdaptiveRateLimiter(
+            max_rate=float(os.getenv("RATE_LIMIT_MAX", 10)), state_dir=state_dir)
+        _limiter_pid = os.getpid()
+    return _limiter
+
+
+def get_http_client() -> HttpClient:
+    """
+    Returns the HTTP client of the current process. Each worker process gets
+    its own client, because pooled sockets cannot be shared after a fork.
+
+    Returns:
+        HttpClient: the shared HTTP client.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = HttpClient(limiter=get_rate_limiter())
+        _client_pid = os.getpid()
+    return _client
+
+
+def get_proxy_pool():
+    """
+    Returns the pool of egress proxies of the current process, configured
+    by the comma-separated HTTP_PROXIES environment variable. Like the HTTP
+    client, each worker process gets its own pool.
+
+    Returns:
+        ProxyPool: the pool, or None if no proxy is configured.
+    """
+    global _proxy_pool, _proxy_pool_pid
+    if _proxy_pool is None or _proxy_pool_pid != os.getpid():
+        proxy_urls = [url.strip() for url in os.getenv("HTTP_PROXIES", "").split(",")
+                      if url.strip()]
+        if not proxy_urls:
+            return None
+        from proxy_pool import ProxyPool
+        _proxy_pool = ProxyPool(proxy_urls, limiter=get_rate_limiter())
+        _proxy_pool_pid = os.getpid()
+    return _proxy_pool
+
+
+def get_site_client():
+    """
+    Returns the client of the requests to the crawled sites: the pool of
+    egress proxies, if configured, otherwise the shared HTTP client.
+
+    Returns:
+        ProxyPool or HttpClient: the client.
+    """
+    proxy_pool = get_proxy_pool()
+    return proxy_pool if proxy_pool is not None else get_http_client()
+
+
+def log_http_stats() -> None:
+    """
+    Logs the connection reuse counters of the shared HTTP client, and the
+    health of the egress proxies, if any.
+
+    Returns:
+        None
+    """
+    if _proxy_pool is not None and _proxy_pool_pid == os.getpid():
+        for name, health in _proxy_pool.get_stats().items():
+            logging.info(
+                f"Proxy {name}: {health['requests']} requests, {health['errors']} "
+                f"errors, latency {health['latency']:.2f}s"
+                + (", quarantined" if health["quarantined"] else ""))
+    if _client is None or _client_pid != os.getpid():
+        return
+    stats = _client.get_stats()
+    logging.info(
+        f"HTTP: {stats['requests']} requests, {stats['connections']} "
+        f"connections opened, {stats['reused']} reused")
+    if _client.limiter is not None:
+        for host, state in _client.limiter.get_states().items():
+            logging.info(
+                f"Rate limit of {host}: {state['rate']:.2f} requests/s, "
+                f"back-off {state['backoff']:.0f}s, {state['errors']} errors")
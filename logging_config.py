@@ -1,17 +1,34 @@
 """
 Sets the format of messages related to the script operation (status and errors),
 which will be written to the log.log file, saved in the same directory as the script.
+
+The handlers are installed by setup_logging(), called by the entry points,
+so importing the modules of the app has no side effect.
 """
 import os
 import logging
 from utils import BASE_DIR
 
 log_file_path = os.path.join(BASE_DIR, "log.log")
-logging.basicConfig(
-    level=logging.ERROR,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file_path),
-        logging.StreamHandler()
-    ]
-)
+_configured = False
+
+
+def setup_logging() -> None:
+    """
+    Configures the root logger, once.
+
+    Returns:
+        None
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    logging.basicConfig(
+        level=logging.ERROR,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(log_file_path),
+            logging.StreamHandler()
+        ]
+    )
@@ -1,109 +1,982 @@
 import os
+import sys
+import time
+import shlex
 import logging
-import logging_config
-from multiprocessing import Pool
-from scraper_manager import OlxScraper
-from database_manager import DatabaseManager
-from notification_manager import Messenger
-from utils import BASE_DIR
+import argparse
+from typing import TYPE_CHECKING
+from utils import BASE_DIR, load_env
+from logging_config import setup_logging
+import metrics
+from pipeline_manager import DISCOVERED, FETCHED
+from scheduler import AdaptiveScheduler, is_work_due
+from filter_engine import get_filter
 
+if TYPE_CHECKING:
+    from shard_manager import ShardPool
 
-scraper = OlxScraper()
-db = DatabaseManager()
+# The settings of '.env' must be loaded before the settings below are read
+load_env()
 
+# The scraper, the database, the notifications and their dependencies
+# (bs4, requests, asyncio) are only loaded by the first stage needing them,
+# so that a run with nothing to do, e.g. 'main.py --check' started by cron,
+# exits before paying for them. See get_scraper(), get_db(), etc.
+_scraper = None
+_db = None
+_dispatcher = None
+_pipeline = None
+_history = None
+_search_index = None
+_repost_detector = None
 
-def load_target_urls() -> list:
+# Maximum time the daemon sleeps before reloading 'target_urls.txt'
+DAEMON_MAX_SLEEP = 60
+# Stop the pagination at the first page without new ads
+INCREMENTAL_CRAWL = os.getenv("INCREMENTAL_CRAWL", "1") == "1"
+# Crawl all pages of a search at least this often (seconds), to catch
+# re-sorted or promoted listings
+FULL_SWEEP_INTERVAL = float(os.getenv("FULL_SWEEP_INTERVAL", 6 * 3600))
+# Number of fetched ads committed to the pipeline at once
+FETCH_COMMIT_BATCH = 50
+# Maximum number of discovered ads waiting for a fetch worker, per search
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", 200))
+# Number of fetch workers per search. The requests are also bounded by the
+# global concurrency limit of the scraper
+FETCH_WORKERS = 10
+# Maximum number of ads per notification
+NOTIFY_CHUNK_SIZE = int(os.getenv("NOTIFY_CHUNK_SIZE", 100))
+# Port of the /metrics endpoint, served in daemon mode when METRICS=1
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+# Notify the price drops and the relisted ads of the monitored searches
+NOTIFY_CHANGES = os.getenv("NOTIFY_CHANGES", "1") == "1"
+# Keep the data of the fetched ads in the local full-text index
+SEARCH_INDEX = os.getenv("SEARCH_INDEX", "1") == "1"
+# What to do with the reposts of ads seen before: 'tag' them in the
+# notifications, 'drop' them, or 'off' to disable the detection
+REPOSTS = os.getenv("REPOSTS", "tag")
+# Path of the file of the monitored URLs
+TARGETS_PATH = os.path.join(BASE_DIR, "target_urls.txt")
+# Compiled filters of the monitored URLs which have filter options
+filters = {}
+# In a shard worker, the price drops and relists found, returned to the
+# parent process with the results instead of being notified
+shard_changes = None
+
+
+def get_scraper():
     """
-    Fetch the list of URLs to monitor from the file 'target_urls.txt',
-    which is located in the same directory as the script.
+    Returns the scraper of the app, creating it on first use.
 
     Returns:
-        list: list of URLs from which to collect data. If the
-        file does not exist, it creates it and returns an empty list.
+        OlxScraper: the scraper.
+    """
+    global _scraper
+    if _scraper is None:
+        from scraper_manager import OlxScraper
+        from cache_manager import HttpCache
+        _scraper = OlxScraper(
+            cache=HttpCache(max_bytes=int(os.getenv("HTTP_CACHE_MAX_BYTES", 100 * 1024 ** 2)))
+            if os.getenv("HTTP_CACHE", "1") == "1" else None,
+            cache_ttl=float(os.getenv("HTTP_CACHE_TTL", 3600)),
+            extractor=os.getenv("EXTRACTOR", "auto"))
+    return _scraper
+
+
+def get_db():
+    """
+    Returns the database of the seen ads, opening it on first use.
+
+    Returns:
+        DatabaseManager: the database.
+    """
+    global _db
+    if _db is None:
+        from database_manager import DatabaseManager
+        _db = DatabaseManager(use_cache=os.getenv("DEDUP_CACHE") == "1")
+    return _db
+
+
+def get_dispatcher():
+    """
+    Returns the notification dispatcher, starting it on first use.
+
+    Returns:
+        NotificationDispatcher: the dispatcher.
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        from notification_manager import NotificationDispatcher
+        _dispatcher = NotificationDispatcher(digest=os.getenv("NOTIFY_DIGEST") == "1")
+    return _dispatcher
+
+
+def get_pipeline():
+    """
+    Returns the pipeline of the new ads, opening it on first use.
+
+    Returns:
+        Pipeline: the pipeline.
+    """
+    global _pipeline
+    if _pipeline is None:
+        from pipeline_manager import Pipeline
+        _pipeline = Pipeline(get_db().DB)
+    return _pipeline
+
+
+def get_history():
+    """
+    Returns the price and listing history, opening it on first use.
+
+    Returns:
+        AdHistory: the history.
+    """
+    global _history
+    if _history is None:
+        from history_manager import AdHistory
+        _history = AdHistory(
+            get_db().DB, min_drop_percent=float(os.getenv("PRICE_DROP_MIN_PERCENT", 0)))
+    return _history
+
+
+def get_search_index():
+    """
+    Returns the full-text index of the ads, opening it on first use.
+
+    Returns:
+        SearchIndex: the index.
+    """
+    global _search_index
+    if _search_index is None:
+        from search_index import SearchIndex
+        _search_index = SearchIndex(get_db().DB)
+    return _search_index
+
+
+def get_repost_detector():
+    """
+    Returns the detector of the reposted ads, opening it on first use.
+
+    Returns:
+        RepostDetector: the detector.
+    """
+    global _repost_detector
+    if _repost_detector is None:
+        from repost_detector import RepostDetector, MAX_DISTANCE
+        _repost_detector = RepostDetector(
+            get_db().DB,
+            max_distance=int(os.getenv("REPOST_MAX_DISTANCE", MAX_DISTANCE)))
+    return _repost_detector
+
+
+def close_resources() -> None:
+    """
+    Closes the connections opened by the run, if any.
+
+    Returns:
+        None
+    """
+    global _pipeline, _history, _search_index, _repost_detector, _db
+    if _pipeline is not None:
+        _pipeline.close()
+        _pipeline = None
+    if _history is not None:
+        _history.close()
+        _history = None
+    if _search_index is not None:
+        _search_index.close()
+        _search_index = None
+    if _repost_detector is not None:
+        _repost_detector.close()
+        _repost_detector = None
+    if _db is not None:
+        _db.close()
+        _db = None
+
+
+def parse_target_line(line: str) -> tuple[str, dict]:
+    """
+    Parses a line of the file 'target_urls.txt'. A line contains a URL,
+    optionally followed by options written as key=value, e.g.:
+    https://www.olx.ro/oferte/q-raspberry-pi/ min_interval=60 max_interval=3600
+    The filter options are described in filter_engine.py.
+
+    Args:
+        line (str): the line to parse.
+
+    Returns:
+        Tuple[str, dict]: the URL and its options, or (None, {}) for
+        empty lines and comments (lines starting with '#').
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None, {}
+    try:
+        parts = shlex.split(line)
+    except ValueError as error:
+        logging.error(f"Invalid line in 'target_urls.txt': {line} ({error})")
+        return None, {}
+    url, options = parts[0], {}
+    for part in parts[1:]:
+        key, separator, value = part.partition("=")
+        if not separator:
+            logging.error(f"Invalid option '{part}' for {url}")
+            continue
+        if key in ("min_interval", "max_interval"):
+            try:
+                value = float(value)
+            except ValueError:
+                logging.error(f"Invalid value for option '{key}' of {url}")
+                continue
+        options[key] = value
+    return url, options
+
+
+def load_targets() -> dict:
+    """
+    Fetch the URLs to monitor and their options from the file
+    'target_urls.txt', which is located in the same directory as the script.
 
+    Returns:
+        dict: the URLs from which to collect data, mapped to their options.
+        If the file does not exist, it creates it and returns an empty dict.
     """
-    file_path = os.path.join(BASE_DIR, "target_urls.txt")
+    file_path = TARGETS_PATH
     user_message = f"The file 'target_urls.txt' has been created. Add " \
         + f"in it at least one URL to monitor for new ads. Add 1 URL per line."
+    targets = {}
     try:
         with open(file_path) as f:
-            target_urls = [line.strip() for line in f]
+            for line in f:
+                url, options = parse_target_line(line)
+                if url is not None:
+                    targets[url] = options
     except FileNotFoundError:
         logging.info(user_message)
         open(file_path, "w").close()
-        target_urls = []
-    if not target_urls:
+    if not targets:
         logging.info(user_message)
-    return target_urls
+    return targets
+
+
+def load_filters(targets: dict) -> None:
+    """
+    Compiles the filters of the monitored URLs. Unchanged filters are not
+    compiled again.
+
+    Args:
+        targets (dict): the monitored URLs, mapped to their options.
+
+    Returns:
+        None
+    """
+    filters.clear()
+    for target_url, options in targets.items():
+        search_filter = get_filter(target_url, options)
+        if search_filter is not None:
+            filters[target_url] = search_filter
+
+
+def load_target_urls() -> list:
+    """
+    Fetch the list of URLs to monitor from the file 'target_urls.txt',
+    which is located in the same directory as the script.
 
+    Returns:
+        list: list of URLs from which to collect data. If the
+        file does not exist, it creates it and returns an empty list.
 
-def get_new_ads_urls(all_urls: list) -> list:
+    """
+    return list(load_targets())
+
+
+def get_new_ads_urls(all_urls: list, target_url: str = None) -> list:
     """
     Returns a list of new ad URLs (not found in the database). 
 
     Args:
         all_urls (list): list of URLs to be matched against the database.
+        target_url (str): if given, the ads rejected by the filter of this
+        monitored URL are not new either.
 
     Returns:
         new_urls (list): List of URLs not found in the database.
     """
-    new_urls = []
-    if all_urls:
-        for url in all_urls:
-            if not db.url_exists(url):
-                new_urls.append(url)
-    return new_urls
+    if not all_urls:
+        return []
+    new_urls = get_db().filter_new(all_urls, target_url)
+    return [url for url in all_urls if url in new_urls]
 
 
-def get_new_ads_urls_for_url(target_url: str) -> list:
+def notify_changes(target_url: str, changes: list) -> None:
     """
-    Extracts ads for a specific URL and filters out previously processed ads.
+    Queues the notification of the price drops and relists of a monitored
+    URL, or, in a shard worker, keeps them for the parent process.
 
     Args:
-        target_url (str): A string representing the URL for which new ads should be retrieved.
+        target_url (str): the monitored URL.
+        changes (List[Dict]): the changes returned by AdHistory.record().
 
     Returns:
-        List[str]: A list of URLs representing new ads retrieved from the monitored URL.
+        None
+    """
+    if not NOTIFY_CHANGES or not changes:
+        return
+    if shard_changes is not None:
+        shard_changes.setdefault(target_url, []).extend(changes)
+    else:
+        get_dispatcher().submit_changes(target_url, changes)
+
+
+async def iter_new_ads(target_url: str):
     """
+    Yields the new ads of a monitored URL page by page, so that huge searches
+    are processed in constant memory. The ads shown on the pages of results
+    are recorded in the price history, and their price drops and relists are
+    notified. The new ads rejected by the filter of the URL on their card are
+    recorded as rejected by this URL only, without fetching their pages: the
+    other searches finding them still notify them.
+
+    Args:
+        target_url (str): A string representing the URL for which new ads should be retrieved.
 
+    Yields:
+        Dict[str, Dict]: the URLs of the new ads of each page of results,
+        mapped to their data when it is complete on the page, or to None.
+    """
+    db, history = get_db(), get_history()
+    now = time.time()
+    last_full_sweep = db.get_last_full_sweep(target_url)
+    full_sweep = not INCREMENTAL_CRAWL or last_full_sweep is None \
+        or now - last_full_sweep >= FULL_SWEEP_INTERVAL
+    search_filter = filters.get(target_url)
+    # The ads already rejected by this search count as known
+    filter_new = None if full_sweep else lambda urls: db.filter_new(urls, target_url)
+    found_ads = False
     try:
-        ads_urls = scraper.scrape_ads_urls(target_url)
+        async for listing_page in get_scraper().async_iter_listing(
+                target_url, filter_new=filter_new):
+            cards = listing_page.get("cards", {})
+            ads = dict.fromkeys(listing_page["links"])
+            ads.update(listing_page.get("records", {}))
+            found_ads = found_ads or bool(ads)
+            notify_changes(target_url, history.record(cards))
+            new_ads = {url: ads[url] for url in get_new_ads_urls(list(ads), target_url)}
+            if search_filter is not None and new_ads:
+                rejected = {url for url, data in new_ads.items()
+                            if not search_filter.match_card(data or cards.get(url) or {})}
+                if rejected:
+                    db.add_rejected(target_url, rejected)
+                    metrics.inc("ads_filtered", len(rejected))
+                    logging.info(
+                        f"{len(rejected)} new ads of {target_url} rejected by its filter")
+                    new_ads = {url: data for url, data in new_ads.items()
+                               if url not in rejected}
+            if new_ads:
+                yield new_ads
     except ValueError as error:
         logging.error(error)
-        return []
-    return get_new_ads_urls(ads_urls)
+        return
+    if full_sweep and found_ads:
+        db.set_last_full_sweep(target_url, now)
 
 
-def main() -> None:
+async def get_new_ads_for_url(target_url: str) -> dict:
     """
-    Main function. Collects and processes ads
-    and sends notifications by email and Telegram.
+    Extracts ads for a specific URL and filters out previously processed ads.
+    See iter_new_ads().
+
+    Args:
+        target_url (str): A string representing the URL for which new ads should be retrieved.
+
+    Returns:
+        Dict[str, Dict]: the URLs of the new ads retrieved from the monitored URL,
+        mapped to their data when it is complete on the pages of results, or to None.
+    """
+    new_ads = {}
+    async for page_new_ads in iter_new_ads(target_url):
+        new_ads.update(page_new_ads)
+    return new_ads
+
+
+async def fetch_stage(target_url: str = None) -> None:
+    """
+    Fetches the data of the discovered ads and moves them to the 'fetched'
+    stage of the pipeline, committing the results in batches. The ads are
+    claimed STREAM_QUEUE_SIZE at a time, to bound the memory used.
+
+    Args:
+        target_url (str): if given, only the ads of this monitored URL.
     """
+    import asyncio
+    from scraper_manager import FetchError
+    pipeline = get_pipeline()
+
+    async def fetch(url: str) -> tuple[str, dict]:
+        try:
+            return url, await get_scraper().async_get_ad_data(url)
+        except FetchError as error:
+            return url, error
+
+    while True:
+        items = pipeline.claim(DISCOVERED, target_url, limit=STREAM_QUEUE_SIZE)
+        if not items:
+            return
+        results = {}
+        failed = []
+        try:
+            for task in asyncio.as_completed([fetch(url) for url, _, _ in items]):
+                url, ad_data = await task
+                if isinstance(ad_data, FetchError):
+                    # Not an ad without data: its page is fetched again later
+                    logging.warning(f"Will retry {url}: {ad_data}")
+                    failed.append(url)
+                    continue
+                results[url] = ad_data
+                if len(results) >= FETCH_COMMIT_BATCH:
+                    pipeline.mark_fetched(results)
+                    results = {}
+        finally:
+            pipeline.mark_fetched(results)
+            pipeline.mark_failed(failed)
+            pipeline.release([url for url, _, _ in items])
+
 
-    target_urls = load_target_urls()
+def notify_stage(target_url: str = None) -> None:
+    """
+    Queues the notifications of the fetched ads, grouped by monitored URL,
+    NOTIFY_CHUNK_SIZE ads at a time: a huge set of new ads is sent as
+    several notifications instead of one giant one.
+    The ads move to the 'notified' stage once their notification is sent,
+    by email or by Telegram. When it couldn't be sent at all, they stay in
+    the 'fetched' stage and are notified again in the next cycle.
+    The data of the ads is added to the full-text index, with SEARCH_INDEX=1,
+    and the reposts of ads seen before are tagged or dropped, per REPOSTS.
+    An ad found by several searches is notified once, with the first of
+    them whose filter accepts it. The ads rejected by the filters of all
+    their searches are recorded as rejected by these searches only, and
+    leave the pipeline without being recorded as seen: a search which
+    finds them later, in this cycle or the next ones, still notifies them.
+
+    Args:
+        target_url (str): if given, only the ads of this monitored URL.
+    """
+    pipeline = get_pipeline()
+    while True:
+        items = pipeline.claim(FETCHED, target_url, limit=NOTIFY_CHUNK_SIZE)
+        if not items:
+            return
+        if SEARCH_INDEX:
+            get_search_index().add([ad_data for _, _, ad_data in items])
+        reposts = get_repost_detector().check([ad_data for _, _, ad_data in items]) \
+            if REPOSTS in ("tag", "drop") else {}
+        sections = {}
+        dropped = []
+        rejected = {}
+        matches = pipeline.get_targets([url for url, _, _ in items])
+        for url, item_target_url, ad_data in items:
+            if url in reposts:
+                if REPOSTS == "drop":
+                    dropped.append(url)
+                    continue
+                ad_data = dict(ad_data, repost_of=reposts[url])
+            # An ad found by several searches is notified once, in the
+            # first search whose filter accepts it
+            candidates = matches.get(url, [item_target_url])
+            section_url = next(
+                (candidate for candidate in candidates
+                 if candidate not in filters or filters[candidate].match_ad(ad_data)),
+                None)
+            if section_url is None:
+                rejected[url] = candidates
+                continue
+            sections.setdefault(section_url, {})[url] = ad_data
+        if dropped:
+            pipeline.mark_notified(dropped)
+        if rejected:
+            searches = {}
+            for url, candidates in rejected.items():
+                for candidate in candidates:
+                    searches.setdefault(candidate, []).append(url)
+            for candidate, urls in searches.items():
+                get_db().add_rejected(candidate, urls)
+            pipeline.reject(rejected)
+            metrics.inc("ads_filtered", len(rejected))
+        for item_target_url, new_ads in sections.items():
+            urls = list(new_ads)
+            get_dispatcher().submit(item_target_url, list(new_ads.values()),
+                                    on_sent=lambda urls=urls: pipeline.mark_notified(urls),
+                                    on_failed=lambda urls=urls: pipeline.release(urls))
+
+
+async def process_target_url(target_url: str, notify: bool = True) -> int:
+    """
+    Collects the new ads of a monitored URL and streams them through the
+    pipeline: each page of results is discovered as soon as it is parsed,
+    its new ads are handed to fetch workers through a bounded queue, and
+    the fetched ads are notified in chunks of NOTIFY_CHUNK_SIZE, while the
+    next pages are crawled. When the fetch workers fall behind, the queue
+    is full and the crawl of the pages waits, so the memory used doesn't
+    depend on the number of ads of the search.
+
+    Args:
+        target_url (str): URL of the OLX page to monitor.
+        notify (bool): if False, the new ads stop at the 'fetched' stage.
+
+    Returns:
+        int: the number of new ads found.
+    """
+    import asyncio
+    from scraper_manager import FetchError
+    scraper, pipeline = get_scraper(), get_pipeline()
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    claimed = set()
+    added = 0
+    # Fetched ads of this URL waiting for a notification
+    ready = 0
+
+    def commit(results: dict) -> None:
+        nonlocal ready
+        pipeline.mark_fetched(results)
+        claimed.difference_update(results)
+        ready += sum(data is not None for data in results.values())
+        if notify and ready >= NOTIFY_CHUNK_SIZE:
+            notify_stage(target_url)
+            ready = 0
+
+    async def discover() -> None:
+        nonlocal added, ready
+        async for new_ads in iter_new_ads(target_url):
+            page_added = pipeline.discover(target_url, new_ads)
+            added += page_added
+            metrics.inc("ads_new", page_added)
+            # Ads complete on the pages of results are already fetched
+            ready += sum(data is not None for data in new_ads.values())
+            # Also picks up the ads left by an interrupted run
+            for url, _, _ in pipeline.claim(DISCOVERED, target_url):
+                claimed.add(url)
+                await queue.put(url)
+
+    async def fetch_worker() -> None:
+        results = {}
+        try:
+            while True:
+                url = await queue.get()
+                try:
+                    results[url] = await scraper.async_get_ad_data(url)
+                    if len(results) >= FETCH_COMMIT_BATCH:
+                        commit(results)
+                        results = {}
+                except FetchError as error:
+                    # Not an ad without data: its page is fetched again later
+                    logging.warning(f"Will retry {url}: {error}")
+                    pipeline.mark_failed([url])
+                    claimed.discard(url)
+                except Exception as error:
+                    # The ad stays in the 'discovered' stage, for the next cycle
+                    logging.error(f"Error processing {url}: {error}")
+                finally:
+                    queue.task_done()
+        finally:
+            commit(results)
+
+    workers = [asyncio.ensure_future(fetch_worker()) for _ in range(FETCH_WORKERS)]
+    try:
+        await discover()
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        pipeline.release(list(claimed))
+    if notify:
+        notify_stage(target_url)
+    return added
+
+
+async def crawl(target_urls: list, resume: bool = True, notify: bool = True) -> list:
+    """
+    Resumes the work left by an interrupted run, then crawls all the
+    monitored URLs concurrently, under the global concurrency limit of
+    the scraper.
+
+    Args:
+        target_urls (list): URLs of the OLX pages to monitor.
+        resume (bool): if False, only the work left for the given URLs is
+        resumed, e.g. in a shard, which doesn't own the other URLs.
+        notify (bool): if False, the new ads stop at the 'fetched' stage.
+
+    Returns:
+        List[int]: the number of new ads found for each monitored URL,
+        in the same order.
+    """
+    import asyncio
+    if resume:
+        await fetch_stage()
+        notify_stage()
+    return await asyncio.gather(
+        *(process_target_url(target_url, notify) for target_url in target_urls))
+
+
+def init_shard_worker(site_adapters: list) -> None:
+    """
+    Initializes a shard worker process with the site adapters of the
+    parent, including those registered at runtime.
+
+    Args:
+        site_adapters (List[SiteAdapter]): the site adapters.
+
+    Returns:
+        None
+    """
+    from site_adapters import register_site_adapter
+    setup_logging()
+    for adapter in site_adapters:
+        register_site_adapter(adapter)
+
+
+def crawl_shard(target_urls: list, shard_filters: dict) -> dict:
+    """
+    Runs in a shard worker process: crawls the monitored URLs of the shard
+    and takes their new ads to the 'fetched' stage of the pipeline. The
+    parent process notifies them.
+
+    Args:
+        target_urls (list): the monitored URLs of the shard.
+        shard_filters (dict): the compiled filters of the monitored URLs.
+
+    Returns:
+        dict: the 'targets' - the monitored URLs, mapped to the number of
+        new ads found and to their price drops and relists - and the
+        'metrics' collected by the worker process during the crawl.
+    """
+    import asyncio
+    from http_manager import log_http_stats
+    global shard_changes
+    shard_changes = {}
+    filters.clear()
+    filters.update(shard_filters)
+    if _db is not None:
+        # The parent recorded the ads notified since the previous cycle
+        _db.refresh_cache()
+    try:
+        counts = asyncio.run(crawl(target_urls, resume=False, notify=False))
+    finally:
+        if _scraper is not None:
+            _scraper.close()
+        changes, shard_changes = shard_changes, None
+    log_http_stats()
+    return {
+        "targets": {target_url: (count, changes.get(target_url, []))
+                    for target_url, count in zip(target_urls, counts)},
+        # The worker process is kept between cycles: send only the metrics
+        # of this crawl, the parent process exports them
+        "metrics": metrics.drain()
+    }
+
+
+def crawl_shards(shard_pool: "ShardPool", target_urls: list) -> dict:
+    """
+    Crawls the monitored URLs in the worker processes of their shards,
+    then queues the notifications of all the new ads found.
+
+    Args:
+        shard_pool (ShardPool): the worker processes.
+        target_urls (list): URLs of the OLX pages to monitor.
+
+    Returns:
+        dict: the number of new ads found for each monitored URL.
+    """
+    counts = {}
+    for shard_results in shard_pool.map(crawl_shard, target_urls, filters):
+        metrics.merge(shard_results["metrics"])
+        for target_url, (count, changes) in shard_results["targets"].items():
+            counts[target_url] = count
+            notify_changes(target_url, changes)
+    notify_stage()
+    return counts
+
+
+def run_cycle(target_urls: list, wait_notifications: bool = True,
+              shard_pool: "ShardPool" = None, resume: bool = True) -> dict:
+    """
+    Runs a full cycle for the given URLs: collects and processes the new
+    ads, sends the notifications and records the ads in the database.
+
+    Args:
+        target_urls (list): URLs of the OLX pages to monitor.
+        wait_notifications (bool): if False, returns without waiting for
+        the notifications of the cycle to be sent.
+        shard_pool (ShardPool): if given, the URLs are crawled by its
+        worker processes.
+        resume (bool): if False, only the work left for the given URLs
+        is resumed.
+
+    Returns:
+        dict: the number of new ads found for each monitored URL.
+    """
+    import asyncio
+    from http_manager import log_http_stats
+    if _db is not None:
+        # Other processes, e.g. other shards, may have recorded ads since
+        # the previous cycle
+        _db.refresh_cache()
+    try:
+        with metrics.span("cycle"):
+            if shard_pool is not None:
+                results = crawl_shards(shard_pool, target_urls)
+            else:
+                results = dict(zip(target_urls, asyncio.run(
+                    crawl(target_urls, resume=resume))))
+    finally:
+        if _scraper is not None:
+            _scraper.close()
+        if _dispatcher is not None:
+            _dispatcher.end_cycle(wait=wait_notifications)
+        get_pipeline().archive(get_db())
+    metrics.inc("cycles")
+    log_http_stats()
+    logging.info(f"Pipeline: {get_pipeline().get_stats()}")
+    return results
+
+
+def select_shard(targets: dict, shards: int, shard_index: int) -> dict:
+    """
+    Keeps the monitored URLs of one shard, when the shards run as separate
+    processes on the same host.
+
+    Args:
+        targets (dict): the monitored URLs, mapped to their options.
+        shards (int): the number of shards.
+        shard_index (int): the index of the shard of this process.
+
+    Returns:
+        dict: the monitored URLs of the shard, with their options.
+    """
+    from shard_manager import HashRing
+    ring = HashRing(shards)
+    return {target_url: options for target_url, options in targets.items()
+            if ring.get_shard(target_url) == shard_index}
+
+
+def start_shard_pool(shards: int) -> "ShardPool":
+    """
+    Returns the worker processes of the sharded mode.
+
+    Args:
+        shards (int): the number of worker processes.
+
+    Returns:
+        ShardPool: the worker processes.
+    """
+    from shard_manager import ShardPool
+    from site_adapters import SITE_ADAPTERS
+    logging.info(f"Crawling with {shards} worker processes")
+    return ShardPool(shards, initializer=init_shard_worker,
+                     initargs=(list(SITE_ADAPTERS.values()),))
+
+
+def get_schedule_path(shard_index: int = None) -> str:
+    """
+    Returns the path of the file where the schedule of the monitored URLs
+    is kept between the runs. Each shard run as a separate process has
+    its own file.
+
+    Args:
+        shard_index (int): the index of the shard of this process, if any.
+
+    Returns:
+        str: the path of the file.
+    """
+    if shard_index is None:
+        return os.path.join(BASE_DIR, "schedule.json")
+    return os.path.join(BASE_DIR, f"schedule-{shard_index}.json")
+
+
+def load_scheduler(shard_index: int = None) -> AdaptiveScheduler:
+    """
+    Returns the scheduler of the monitored URLs, with the schedule saved
+    by the previous run, if any.
+
+    Args:
+        shard_index (int): the index of the shard of this process, if any.
+
+    Returns:
+        AdaptiveScheduler: the scheduler.
+    """
+    scheduler = AdaptiveScheduler(
+        min_interval=float(os.getenv("POLL_MIN_INTERVAL", 60)),
+        max_interval=float(os.getenv("POLL_MAX_INTERVAL", 3600)))
+    scheduler.load(get_schedule_path(shard_index))
+    return scheduler
+
+
+def save_schedule(scheduler: AdaptiveScheduler, target_urls: list,
+                  new_ads_counts: dict, shard_index: int = None) -> None:
+    """
+    Records the results of a cycle in the schedule and saves it, with
+    whether the pipeline still holds ads to fetch or to notify, which
+    makes the next run due whatever the schedule.
+
+    Args:
+        scheduler (AdaptiveScheduler): the scheduler.
+        target_urls (list): the URLs crawled by the cycle.
+        new_ads_counts (dict): the number of new ads found for each URL.
+        shard_index (int): the index of the shard of this process, if any.
+
+    Returns:
+        None
+    """
     for target_url in target_urls:
-        ads_urls = get_new_ads_urls_for_url(target_url)
+        scheduler.record(target_url, new_ads_counts.get(target_url, 0))
+    backlog = get_pipeline().get_stats()["backlog"]
+    try:
+        scheduler.save(get_schedule_path(shard_index),
+                       pending_work=backlog["discovered"] + backlog["fetched"] > 0)
+    except OSError as error:
+        logging.error(f"Cannot save the schedule: {error}")
 
-        # Filter out the already processed ads
-        new_ads_urls = get_new_ads_urls(ads_urls)
-        if not new_ads_urls:
-            continue
 
-        # Process ads in parallel, for increased speed
-        with Pool(10) as pool:
-            new_ads = pool.map(scraper.get_ad_data, new_ads_urls)
-        new_ads = list(filter(None, new_ads))
+def register_metrics() -> None:
+    """
+    Exposes the stats of the pipeline, of the deduplication cache, of the
+    HTTP connection pools, of the rate limiter and of the egress proxies
+    as metrics.
+    """
+    from http_manager import get_http_client, get_rate_limiter, get_proxy_pool
+    metrics.register_gauges("pipeline", get_pipeline().get_stats)
+    metrics.register_gauges("dedup_cache", get_db().get_cache_stats)
+    metrics.register_gauges("http", lambda: get_http_client().get_stats())
+    metrics.register_gauges("rate_limits", lambda: get_rate_limiter().get_states())
+    if get_proxy_pool() is not None:
+        metrics.register_gauges("proxies", lambda: get_proxy_pool().get_stats())
 
-        if new_ads:
-            message_subject, message_body = Messenger.generate_email_content(
-                target_url, new_ads)
-            Messenger.send_email_message(message_subject, message_body)
-            Messenger.send_telegram_message(message_subject, message_body)
 
-        # Add the processed ads to database
-        for url in new_ads_urls:
-            db.add_url(url)
+def run_daemon(shards: int = None, shard_index: int = None) -> None:
+    """
+    Runs the app continuously. Each monitored URL is polled according to
+    its own adaptive interval, and 'target_urls.txt' is reloaded regularly.
+    With METRICS=1, the metrics are served on http://127.0.0.1:METRICS_PORT/metrics.
+
+    Args:
+        shards (int): if given, the URLs are spread over this many shards.
+        shard_index (int): if given, this process only crawls the URLs of
+        this shard. Otherwise, each shard is a worker process of this one.
+    """
+    if metrics.enabled:
+        register_metrics()
+        metrics.start_http_server(METRICS_PORT)
+    scheduler = load_scheduler(shard_index)
+    shard_pool = start_shard_pool(shards) \
+        if shards is not None and shard_index is None else None
+    try:
+        while True:
+            targets = load_targets()
+            if shard_index is not None:
+                targets = select_shard(targets, shards, shard_index)
+            load_filters(targets)
+            scheduler.sync(targets)
+            due_urls = scheduler.due()
+            if due_urls:
+                new_ads_counts = run_cycle(
+                    due_urls, wait_notifications=False, shard_pool=shard_pool,
+                    resume=shard_index is None)
+                save_schedule(scheduler, due_urls, new_ads_counts, shard_index)
+            sleep_time = scheduler.seconds_until_next()
+            if sleep_time is None or sleep_time > DAEMON_MAX_SLEEP:
+                sleep_time = DAEMON_MAX_SLEEP
+            time.sleep(sleep_time)
+    finally:
+        if shard_pool is not None:
+            shard_pool.close()
+
+
+def main(shards: int = None, shard_index: int = None, check: bool = False) -> None:
+    """
+    Main function. Collects and processes ads
+    and sends notifications by email and Telegram.
+    With METRICS=1, the metrics of the run are saved to 'metrics.json'.
+
+    Args:
+        shards (int): if given, the URLs are spread over this many shards.
+        shard_index (int): if given, this process only crawls the URLs of
+        this shard. Otherwise, each shard is a worker process of this one.
+        check (bool): if True, only the URLs due according to their
+        adaptive interval are crawled, instead of all of them.
+    """
+    if metrics.enabled:
+        register_metrics()
+    targets = load_targets()
+    if shard_index is not None:
+        targets = select_shard(targets, shards, shard_index)
+    load_filters(targets)
+    scheduler = load_scheduler(shard_index)
+    scheduler.sync(targets)
+    target_urls = scheduler.due() if check else list(targets)
+    shard_pool = start_shard_pool(shards) \
+        if shards is not None and shard_index is None else None
+    try:
+        new_ads_counts = run_cycle(
+            target_urls, shard_pool=shard_pool, resume=shard_index is None)
+    finally:
+        if shard_pool is not None:
+            shard_pool.close()
+    save_schedule(scheduler, target_urls, new_ads_counts, shard_index)
+    if metrics.enabled:
+        metrics.dump_json(os.path.join(BASE_DIR, "metrics.json"))
+
+
+def parse_args(args: list = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments.
+
+    Args:
+        args (list): the arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Get notified of new listings on OLX.")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="run continuously, polling each URL at an adaptive interval")
+    parser.add_argument(
+        "--shards", type=int,
+        help="spread the URLs over this many worker processes (consistent hashing)")
+    parser.add_argument(
+        "--shard-index", type=int,
+        help="only crawl the URLs of this shard (0 to SHARDS-1), to run the "
+        "shards as separate processes on the same host")
+    parser.add_argument(
+        "--check", action="store_true",
+        help="exit at once if no URL is due according to the schedule saved "
+        "by the previous run, e.g. when started by cron every minute, and "
+        "otherwise only crawl the due URLs")
+    arguments = parser.parse_args(args)
+    if arguments.shards is not None and arguments.shards < 1:
+        parser.error("--shards must be at least 1")
+    if arguments.shard_index is not None and (
+            arguments.shards is None or not 0 <= arguments.shard_index < arguments.shards):
+        parser.error("--shard-index requires --shards and must be between 0 and SHARDS-1")
+    if arguments.check and arguments.daemon:
+        parser.error("--check cannot be used with --daemon")
+    return arguments
 
 
 if __name__ == "__main__":
-    main()
+    arguments = parse_args()
+    if arguments.check and not is_work_due(
+            get_schedule_path(arguments.shard_index), TARGETS_PATH):
+        sys.exit(0)
+    setup_logging()
+    try:
+        if arguments.daemon:
+            run_daemon(arguments.shards, arguments.shard_index)
+        else:
+            main(arguments.shards, arguments.shard_index, arguments.check)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        close_resources()
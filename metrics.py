@@ -0,0 +1,396 @@
+"""
+Lightweight instrumentation of the hot paths: timing spans, counters and
+histograms, exported in the Prometheus text format on a local /metrics HTTP
+endpoint in daemon mode, and saved as JSON after a one-shot run.
+
+Metrics are disabled unless the METRICS environment variable is set to 1.
+When disabled, span() returns a shared no-op context manager and inc() and
+observe() return immediately, so the instrumented code pays almost nothing.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from utils import load_env
+
+load_env()
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Prefix of the exported metric names
+PREFIX = "olxradar_"
+
+enabled = os.getenv("METRICS") == "1"
+
+
+class Histogram():
+    """Cumulative histogram of observed values."""
+
+    def __init__(self, buckets: tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """
+        Adds a value to the histogram. Must be called with the lock of the
+        registry held.
+        """
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def merge(self, data: dict) -> None:
+        """
+        Adds the values of another histogram, as returned by to_dict().
+        Must be called with the lock of the registry held.
+        """
+        self.count += data["count"]
+        self.sum += data["sum"]
+        self.max = max(self.max, data["max"])
+        for index, bound in enumerate(self.buckets):
+            self.counts[index] += data["buckets"].get(str(bound), 0)
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            dict: the count, sum, average and maximum of the values, and the
+            number of values in each bucket (not cumulative).
+        """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": {str(bound): count
+                        for bound, count in zip(self.buckets, self.counts)}
+        }
+
+
+class Registry():
+    """Thread-safe store of the counters and histograms."""
+
+    def __init__(self) -> None:
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1) -> None:
+        """
+        Increments a counter.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        Adds a value to a histogram.
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def register_gauges(self, name: str, collect) -> None:
+        """
+        Registers a function returning the current values of a group of gauges.
+        """
+        with self._lock:
+            self.gauges[name] = collect
+
+    def collect_gauges(self) -> dict:
+        """
+        Returns:
+            dict: the flattened current values of the registered gauges.
+        """
+        with self._lock:
+            gauges = dict(self.gauges)
+        values = {}
+        for name, collect in gauges.items():
+            try:
+                _flatten(name, collect(), values)
+            except Exception as error:
+                logging.error(f"Error collecting the '{name}' metrics: {error}")
+        return values
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+            dict: the 'counters', 'histograms' and 'gauges'.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.to_dict()
+                          for name, histogram in self.histograms.items()}
+        return {"counters": counters, "histograms": histograms,
+                "gauges": self.collect_gauges()}
+
+    def drain(self) -> dict:
+        """
+        Returns the counters and histograms, and clears them.
+
+        Returns:
+            dict: the 'counters' and 'histograms', like to_dict().
+        """
+        with self._lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+        return {"counters": counters,
+                "histograms": {name: histogram.to_dict()
+                               for name, histogram in histograms.items()}}
+
+    def merge(self, data: dict) -> None:
+        """
+        Adds the counters and histograms of another registry, e.g. of a
+        worker process, as returned by drain().
+        """
+        with self._lock:
+            for name, value in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, values in data["histograms"].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.merge(values)
+
+    def to_prometheus(self) -> str:
+        """
+        Returns:
+            str: the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = _metric_name(name) + "_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+            for name, histogram in sorted(self.histograms.items()):
+                metric = _metric_name(name) + "_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{metric}_sum {histogram.sum}")
+                lines.append(f"{metric}_count {histogram.count}")
+        for name, value in sorted(self.collect_gauges().items()):
+            metric = _metric_name(name)
+            lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _metric_name(name: str) -> str:
+    """
+    Converts a dotted name, e.g. 'db.filter_new', to a Prometheus metric name.
+    """
+    return PREFIX + "".join(
+        char if char.isalnum() else "_" for char in name)
+
+
+def _flatten(prefix: str, value, values: dict) -> None:
+    """
+    Adds the numeric values of a nested dict to 'values', under dotted names.
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(f"{prefix}.{key}", item, values)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        values[prefix] = value
+
+
+registry = Registry()
+
+
+class _Span():
+    """Context manager timing a block of code into a histogram."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        registry.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoopSpan():
+    """Context manager used when the metrics are disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str):
+    """
+    Times a block of code:
+        with metrics.span("db.filter_new"):
+            ...
+
+    Args:
+        name (str): the name of the histogram receiving the duration.
+
+    Returns:
+        A context manager.
+    """
+    if not enabled:
+        return _NOOP_SPAN
+    return _Span(name)
+
+
+def inc(name: str, value: float = 1) -> None:
+    """
+    Increments a counter, if the metrics are enabled.
+
+    Args:
+        name (str): the name of the counter.
+        value (float): the increment.
+
+    Returns:
+        None
+    """
+    if enabled:
+        registry.inc(name, value)
+
+
+def observe(name: str, value: float) -> None:
+    """
+    Adds a duration to a histogram, if the metrics are enabled.
+
+    Args:
+        name (str): the name of the histogram.
+        value (float): the duration, in seconds.
+
+    Returns:
+        None
+    """
+    if enabled:
+        registry.observe(name, value)
+
+
+def register_gauges(name: str, collect) -> None:
+    """
+    Registers a group of gauges, e.g. the stats of a component. The function
+    is called when the metrics are exported; nested dicts are flattened.
+
+    Args:
+        name (str): the prefix of the gauges.
+        collect (callable): function returning a dict of numeric values.
+
+    Returns:
+        None
+    """
+    if enabled:
+        registry.register_gauges(name, collect)
+
+
+def to_dict() -> dict:
+    """
+    Returns:
+        dict: all the metrics collected so far.
+    """
+    return registry.to_dict()
+
+
+def drain() -> dict:
+    """
+    Returns the counters and histograms collected so far, and clears them,
+    e.g. to send them from a worker process to the parent process.
+
+    Returns:
+        dict: the 'counters' and 'histograms'.
+    """
+    return registry.drain()
+
+
+def merge(data: dict) -> None:
+    """
+    Adds the counters and histograms returned by drain() in another process.
+
+    Args:
+        data (dict): the metrics.
+
+    Returns:
+        None
+    """
+    registry.merge(data)
+
+
+def dump_json(path: str) -> None:
+    """
+    Saves all the metrics collected so far to a JSON file.
+
+    Args:
+        path (str): the path of the file.
+
+    Returns:
+        None
+    """
+    with open(path, "w") as f:
+        json.dump(to_dict(), f, indent=2)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1"):
+    """
+    Serves the metrics from a background thread.
+
+    Args:
+        port (int): the port of the endpoint.
+        host (str): the address to listen on. Local only by default.
+
+    Returns:
+        ThreadingHTTPServer: the server.
+    """
+    # Only the daemon serves the metrics: the one-shot runs don't pay for
+    # the import of http.server
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        """Serves /metrics (Prometheus text format) and /metrics.json."""
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            if self.path == "/metrics":
+                body = registry.to_prometheus().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(registry.to_dict()).encode("utf-8")
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server",
+                     daemon=True).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
@@ -1,19 +1,32 @@
 import os
 import ssl
+import time
+import queue
 import smtplib
 import requests
 import logging
-from dotenv import load_dotenv
-from utils import normalize_text, extract_search_term
-import logging_config
+import threading
+from utils import normalize_text, extract_search_term, load_env
+from http_manager import get_http_client
+from rate_limiter import TokenBucket
+import metrics
 
-load_dotenv()
+load_env()
 
 EMAIL_SENDER = os.getenv("EMAIL_SENDER")
 EMAIL_APP_PASSWORD = os.getenv("EMAIL_APP_PASSWORD")
 EMAIL_RECEIVER = os.getenv("EMAIL_RECEIVER")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+# The services can be pointed elsewhere, e.g. to the stand-ins of the benchmark
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 465))
+SMTP_SSL = os.getenv("SMTP_SSL", "1") == "1"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# Telegram allows about one message per second in the same chat
+telegram_limiter = TokenBucket(
+    rate=float(os.getenv("TELEGRAM_RATE", 1)), capacity=1)
 
 
 class Messenger():
@@ -27,7 +40,8 @@ class Messenger():
         Args:
             index (int): index of the ad in the list.
             ad (dict): A dictionary containing details about
-            the ad - title, description, price and URL.
+            the ad - title, description, price and URL, and the URL of
+            the earlier ad it reposts, if any ('repost_of').
 
         Returns:
             str: The contents of an ad as a string.
@@ -36,7 +50,10 @@ class Messenger():
         description = normalize_text(ad["description"]).strip()[:150]
         price = normalize_text(ad["price"]).strip()
         url = ad["url"]
-        return f"{index}. {title} ({price})\n{description}...\n{url}\n\n"
+        ad_string = f"{index}. {title} ({price})\n{description}...\n{url}\n"
+        if ad.get("repost_of"):
+            ad_string += f"Repost of {ad['repost_of']}\n"
+        return ad_string + "\n"
 
     @staticmethod
     def generate_email_content(target_url: str, new_ads: list) -> tuple[str, str]:
@@ -66,16 +83,110 @@ class Messenger():
         return email_subject, email_body
 
     @staticmethod
-    def send_email_message(subject: str, message: str) -> None:
+    def generate_digest_content(sections: list) -> tuple[str, str]:
+        """
+        Generates the subject and the body of a single email containing the
+        new ads of several monitored URLs.
+
+        Params:
+            sections (List[Tuple[str, List[Dict]]]): the monitored URLs,
+            each with the list of its new ads.
+
+        Returns:
+            Tuple[str, str]: A tuple containing the subject and the body of the email.
+        """
+        if len(sections) == 1:
+            return Messenger.generate_email_content(*sections[0])
+        email_body_elements = []
+        ads_count = 0
+        for target_url, new_ads in sections:
+            _, section_body = Messenger.generate_email_content(target_url, new_ads)
+            search_term = extract_search_term(target_url)
+            title = search_term.title() if search_term is not None else target_url
+            email_body_elements.append(f"== {title} ==\n\n{section_body}")
+            ads_count += len(new_ads)
+        email_subject = f"OLXRadar: {ads_count} new ads for {len(sections)} searches"
+        return email_subject, "\n".join(email_body_elements)
+
+    @staticmethod
+    def generate_changes_content(target_url: str, changes: list) -> tuple[str, str]:
+        """
+        Generates the subject and the body of an email containing the price
+        drops and the relisted ads of a monitored URL.
+
+        Params:
+            target_url (str): URL of the page where the ads were found.
+            changes (List[Dict]): the changes returned by AdHistory.record().
+
+        Returns:
+            Tuple[str, str]: A tuple containing the subject and the body of the email.
+        """
+        drops = sum(change["type"] == "price_drop" for change in changes)
+        relists = len(changes) - drops
+        email_body_elements = []
+        for index, change in enumerate(changes, start=1):
+            title = normalize_text(change["title"]).strip()
+            currency = change["currency"] or ""
+            old_price = f"{change['old_price']:g} {currency}".strip() \
+                if change["old_price"] is not None else "?"
+            new_price = f"{change['new_price']:g} {currency}".strip() \
+                if change["new_price"] is not None else "?"
+            label = "Price drop" if change["type"] == "price_drop" else "Relisted"
+            email_body_elements.append(
+                f"{index}. {label}: {title} ({old_price} -> {new_price})\n{change['url']}\n\n")
+
+        search_term = extract_search_term(target_url)
+        summary = []
+        if drops:
+            summary.append(f"{drops} price drops")
+        if relists:
+            summary.append(f"{relists} relisted ads")
+        email_subject = f"OLXRadar: {' and '.join(summary)}"
+        if search_term is not None:
+            email_subject += f" for the term '{search_term.title()}'"
+        return email_subject, "\n".join(email_body_elements)
+
+    @staticmethod
+    def open_smtp_connection() -> smtplib.SMTP:
+        """
+        Opens an authenticated connection to the SMTP server, which can be
+        reused to send several emails. The connection is encrypted, unless
+        SMTP_SSL is set to 0.
+
+        Returns:
+            smtplib.SMTP: the connection.
+
+        Raises:
+            SMTPAuthenticationError: If the authentication data is incorrect.
+            SMTPException: If the connection fails.
+        """
+        if SMTP_SSL:
+            context = ssl.create_default_context()
+            server = smtplib.SMTP_SSL(SMTP_HOST, port=SMTP_PORT, context=context)
+        else:
+            server = smtplib.SMTP(SMTP_HOST, port=SMTP_PORT)
+        try:
+            server.login(EMAIL_SENDER, EMAIL_APP_PASSWORD)
+        except smtplib.SMTPException:
+            server.close()
+            raise
+        return server
+
+    @staticmethod
+    def send_email_message(subject: str, message: str,
+                           server: smtplib.SMTP = None) -> bool:
         """
         Send the recipient an email with the given subject and message.
 
         Params:
             Subject (str): Subject of the email.
             message (str): Body of the message.
+            server (smtplib.SMTP): an open connection returned by
+            open_smtp_connection(). If None, a new connection is opened
+            and closed for this email.
 
         Returns:
-            None
+            bool: True if the email was sent, False if an error occurred.
 
         Raises:
             SMTPAuthenticationError: If the authentication data is incorrect.
@@ -86,17 +197,23 @@ class Messenger():
             message = str(message)
             message = f"""Subject: {subject}\n\n{message}"""
             message = normalize_text(message)
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL("smtp.gmail.com", port=465, context=context) as server:
-                server.login(EMAIL_SENDER, EMAIL_APP_PASSWORD)
-                server.sendmail(EMAIL_SENDER, EMAIL_RECEIVER, message)
-                server.quit()
-        except (smtplib.SMTPAuthenticationError, smtplib.SMTPException) as error:
+            with metrics.span("notify.email"):
+                if server is not None:
+                    server.sendmail(EMAIL_SENDER, EMAIL_RECEIVER, message)
+                else:
+                    with Messenger.open_smtp_connection() as server:
+                        server.sendmail(EMAIL_SENDER, EMAIL_RECEIVER, message)
+                        server.quit()
+        except (smtplib.SMTPAuthenticationError, smtplib.SMTPException, OSError) as error:
+            metrics.inc("notify.email_errors")
             logging.error(f"Error sending email notification: {error}")
+            return False
+        metrics.inc("notify.emails_sent")
         logging.info("Email notification sent successfully")
+        return True
 
     @staticmethod
-    def send_telegram_message(message_subject: str, message_body: str) -> None:
+    def send_telegram_message(message_subject: str, message_body: str) -> bool:
         """
         Send a message via Telegram. The service accepts messages up to
         4096 characters or less, so the notification will be divided into sections of
@@ -107,12 +224,12 @@ class Messenger():
             message_body (str): Body of the message to be sent.
 
         Returns:
-            None
+            bool: True if all the sections were sent, False if an error occurred.
 
         Raises:
             requests.exceptions.RequestException: In case an error is generated during the transmission.
         """
-        endpoint = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        endpoint = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
         max_length = 4000
         message_batches = []
         current_message = ""
@@ -127,6 +244,7 @@ class Messenger():
         message_batches.append(current_message.strip())
 
         # Send each batch as a separate notification in the same chain
+        sent = True
         for i, message_batch in enumerate(message_batches):
             if i == 0:
                 message_text = f"{message_subject}\n\n{message_batch}"
@@ -136,16 +254,24 @@ class Messenger():
                 "chat_id": TELEGRAM_CHAT_ID,
                 "text": message_text
             }
+            telegram_limiter.acquire()
             try:
-                response = requests.get(endpoint, params=params)
-                response.raise_for_status()
+                with metrics.span("notify.telegram"):
+                    response = get_http_client().post(endpoint, json=params, timeout=30)
+                    response.raise_for_status()
                 if response.json()["ok"]:
-                    logging.info("Email notification sent successfully")
+                    metrics.inc("notify.telegram_sent")
+                    logging.info("Telegram notification sent successfully")
                 else:
+                    sent = False
+                    metrics.inc("notify.telegram_errors")
                     logging.error(
                         "Error sending Telegram notification")
             except requests.exceptions.RequestException as error:
+                sent = False
+                metrics.inc("notify.telegram_errors")
                 logging.error(f"Telegram connection error: {error}")
+        return sent
 
     @staticmethod
     def _get_telegram_bot_chats() -> list:
@@ -159,9 +285,9 @@ class Messenger():
             'username'. For a group chat, the details are: 'id', 'type', 'title',
             'all_members_are_administrators'. In case of an error, it returns an emtpy list.
         """
-        endpoint = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
+        endpoint = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
         try:
-            response = requests.get(endpoint)
+            response = get_http_client().get(endpoint)
             response.raise_for_status()
             data = response.json()
             results = data.get("result", [])
@@ -174,3 +300,189 @@ class Messenger():
         except requests.exceptions.RequestException as error:
             logging.error(f"Error getting Telegram bot chat data: {error}")
             return []
+
+
+class NotificationDispatcher():
+    """
+    Sends the notifications from a background thread, so that the scraping
+    doesn't wait for the email and Telegram services. All the emails of a
+    cycle are sent over one SMTP connection, and the notifications of a
+    cycle can be coalesced into a single digest.
+
+    The queue of the notifications is bounded: when the services can't keep
+    up, submit() blocks, which slows down the crawl instead of piling up
+    notifications in memory.
+    """
+
+    def __init__(self, digest: bool = False, max_pending: int = 100,
+                 max_digest_ads: int = 500) -> None:
+        """
+        Init a new dispatcher and start its thread.
+
+        Args:
+            digest (bool): if True, the new ads of all the monitored URLs of
+            a cycle are sent as a single notification, at the end of the cycle.
+            max_pending (int): maximum number of notifications waiting to
+            be sent.
+            max_digest_ads (int): a digest is sent before the end of the
+            cycle once it holds this many ads.
+        """
+        self.digest = digest
+        self.max_digest_ads = max_digest_ads
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._sections = []
+        self._digest_ads = 0
+        self._smtp = None
+        self._thread = threading.Thread(
+            target=self._run, name="notification-dispatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, target_url: str, new_ads: list, on_sent=None,
+               on_failed=None) -> None:
+        """
+        Queues the notification of the new ads of a monitored URL.
+        Returns immediately.
+
+        Args:
+            target_url (str): URL of the page where the ads were found.
+            new_ads (List[Dict]): the data of the new ads.
+            on_sent (callable): optional function called without arguments,
+            from the dispatcher thread, once the notification was sent by
+            email or by Telegram.
+            on_failed (callable): optional function called without
+            arguments, from the dispatcher thread, if the notification
+            could be sent through none of them.
+
+        Returns:
+            None
+        """
+        if not new_ads:
+            return
+        callbacks = [(on_sent, on_failed)]
+        if self.digest:
+            self._sections.append((target_url, new_ads, callbacks, time.monotonic()))
+            self._digest_ads += len(new_ads)
+            if self._digest_ads >= self.max_digest_ads:
+                self._flush_digest()
+        else:
+            subject, body = Messenger.generate_email_content(target_url, new_ads)
+            self._queue.put((subject, body, callbacks, time.monotonic()))
+
+    def submit_changes(self, target_url: str, changes: list) -> None:
+        """
+        Queues the notification of the price drops and relisted ads of a
+        monitored URL. The changes are always sent on their own, outside
+        of the digest, as they are not new ads. Returns immediately.
+
+        Args:
+            target_url (str): URL of the page where the ads were found.
+            changes (List[Dict]): the changes returned by AdHistory.record().
+
+        Returns:
+            None
+        """
+        if not changes:
+            return
+        subject, body = Messenger.generate_changes_content(target_url, changes)
+        self._queue.put((subject, body, [], time.monotonic()))
+
+    def end_cycle(self, wait: bool = False) -> None:
+        """
+        Marks the end of a cycle: queues the digest, if enabled, and closes
+        the SMTP connection once the queued notifications are sent.
+
+        Args:
+            wait (bool): if True, blocks until all the notifications are sent.
+
+        Returns:
+            None
+        """
+        self._flush_digest()
+        self._queue.put(None)
+        if wait:
+            self._queue.join()
+
+    def _flush_digest(self) -> None:
+        """
+        Queues the digest of the sections submitted so far, if any.
+        """
+        if not self._sections:
+            return
+        subject, body = Messenger.generate_digest_content(
+            [(target_url, new_ads) for target_url, new_ads, _, _ in self._sections])
+        callbacks = [callback for _, _, section_callbacks, _ in self._sections
+                     for callback in section_callbacks]
+        submitted_at = min(section[3] for section in self._sections)
+        self._queue.put((subject, body, callbacks, submitted_at))
+        self._sections = []
+        self._digest_ads = 0
+
+    def _run(self) -> None:
+        """
+        Thread loop: sends the queued notifications. None marks the end of a cycle.
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    self._close_smtp()
+                else:
+                    self._send(*item)
+            except Exception as error:
+                logging.error(f"Error sending notifications: {error}")
+            finally:
+                self._queue.task_done()
+
+    def _send(self, subject: str, body: str, callbacks: list,
+              submitted_at: float) -> None:
+        """
+        Sends a notification by email, reusing the SMTP connection of the
+        cycle, and by Telegram. Then calls the on_sent callbacks of the
+        notification if it was delivered through at least one of them, and
+        the on_failed callbacks otherwise. 'callbacks' holds the (on_sent,
+        on_failed) pairs, and 'submitted_at' is the monotonic time at which
+        the notification was queued.
+        """
+        email_sent = self._send_email(subject, body)
+        telegram_sent = Messenger.send_telegram_message(subject, body)
+        delivered = email_sent or telegram_sent
+        if delivered:
+            # Time from the discovery of the ads to their notification
+            metrics.observe("notify.latency", time.monotonic() - submitted_at)
+        else:
+            metrics.inc("notify.failed")
+        for on_sent, on_failed in callbacks:
+            callback = on_sent if delivered else on_failed
+            if callback is not None:
+                callback()
+
+    def _send_email(self, subject: str, body: str) -> bool:
+        """
+        Sends an email over the SMTP connection of the cycle, opened on first
+        use. When sending fails, e.g. because the server closed the
+        connection, the connection is dropped and the email is sent once
+        more over a new one. Returns True if the email was sent.
+        """
+        for _ in range(2):
+            if self._smtp is None:
+                try:
+                    self._smtp = Messenger.open_smtp_connection()
+                except (smtplib.SMTPException, OSError) as error:
+                    logging.error(f"Error connecting to the SMTP server: {error}")
+                    continue
+            if Messenger.send_email_message(subject, body, self._smtp):
+                return True
+            self._close_smtp()
+        return False
+
+    def _close_smtp(self) -> None:
+        """
+        Closes the SMTP connection of the cycle, if open.
+        """
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
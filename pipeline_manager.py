@@ -0,0 +1,356 @@
+"""
+Durable crawl/notify pipeline. Every new ad goes through three stages,
+recorded in the 'pipeline' table of the database:
+    discovered -> fetched -> notified
+Each transition is committed in batches and only applies to items in the
+previous stage, so it is idempotent, and a restarted run continues exactly
+where the previous one stopped: discovered ads are not discovered again,
+fetched ads are not fetched again and notified ads are not notified again.
+
+The pipeline is shared by all the monitored URLs of a cycle: an ad found by
+several searches is a single item, fetched and notified once, and the
+'pipeline_targets' table records every search that found it.
+
+An ad whose page couldn't be fetched stays in the 'discovered' stage and is
+only claimed again after a delay, doubled after each failure, until it is
+given up after FETCH_MAX_ATTEMPTS failures.
+"""
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+DISCOVERED = 0
+FETCHED = 1
+NOTIFIED = 2
+STAGE_NAMES = {DISCOVERED: "discovered", FETCHED: "fetched", NOTIFIED: "notified"}
+# Maximum number of URLs bound to a single query (SQLite allows 999 variables)
+BATCH_SIZE = 500
+# Delay before the first retry of a failed fetch, and maximum delay (seconds)
+FETCH_RETRY_DELAY = 60
+FETCH_RETRY_MAX_DELAY = 3600
+# Number of failed fetches after which an ad is given up
+FETCH_MAX_ATTEMPTS = 5
+
+
+class Pipeline():
+    """Class that manages the resumable work queues of the pipeline."""
+
+    def __init__(self, db_path: str, retry_delay: float = FETCH_RETRY_DELAY,
+                 max_attempts: int = FETCH_MAX_ATTEMPTS) -> None:
+        """
+        Init a new pipeline and create its table, if it doesn't exist.
+        The pipeline has its own connection, which can be used from the
+        notification thread.
+
+        Args:
+            db_path (str): path of the database file.
+            retry_delay (float): delay before the first retry of a failed
+            fetch, in seconds.
+            max_attempts (int): number of failed fetches after which an ad
+            is given up.
+        """
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+        # Items handed to a worker and not yet moved to the next stage
+        self._claimed = set()
+        self._started_at = time.monotonic()
+        self._transitions = dict.fromkeys(STAGE_NAMES, 0)
+        sql_create_table = """
+            CREATE TABLE IF NOT EXISTS pipeline (
+                url         TEXT        PRIMARY KEY,
+                target_url  TEXT        NOT NULL,
+                stage       INTEGER     NOT NULL,
+                data        TEXT,
+                updated_at  REAL        NOT NULL,
+                attempts    INTEGER     NOT NULL DEFAULT 0,
+                retry_at    REAL        NOT NULL DEFAULT 0
+            );
+            """
+        sql_create_targets_table = """
+            CREATE TABLE IF NOT EXISTS pipeline_targets (
+                url         TEXT        NOT NULL,
+                target_url  TEXT        NOT NULL,
+                PRIMARY KEY (url, target_url)
+            );
+            """
+        with self._lock, self.conn:
+            self.conn.execute(sql_create_table)
+            self.conn.execute(sql_create_targets_table)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pipeline_stage ON pipeline (stage, target_url)")
+            # The pipelines of older versions don't retry the failed fetches
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(pipeline)")]
+            if "attempts" not in columns:
+                self.conn.execute(
+                    "ALTER TABLE pipeline ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute(
+                    "ALTER TABLE pipeline ADD COLUMN retry_at REAL NOT NULL DEFAULT 0")
+
+    def discover(self, target_url: str, ads: dict) -> int:
+        """
+        Adds newly found ads to the pipeline. The ads whose data is already
+        complete go straight to the 'fetched' stage. Ads already in the
+        pipeline, e.g. found by another search, are not added again: the
+        search is only recorded as one more search matching them.
+
+        Args:
+            target_url (str): URL of the page where the ads were found.
+            ads (dict): the URLs of the ads, mapped to their data or to None.
+
+        Returns:
+            int: the number of ads new for this search.
+        """
+        now = time.time()
+        rows = [(url, target_url, DISCOVERED if data is None else FETCHED,
+                 None if data is None else json.dumps(data), now)
+                for url, data in ads.items()]
+        with self._lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO pipeline (url, target_url, stage, data, updated_at) "
+                "VALUES(?, ?, ?, ?, ?)", rows)
+            self._transitions[DISCOVERED] += self.conn.total_changes - before
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO pipeline_targets (url, target_url) VALUES(?, ?)",
+                ((url, target_url) for url in ads))
+            added = self.conn.total_changes - before
+        return added
+
+    def claim(self, stage: int, target_url: str = None, limit: int = None) -> list:
+        """
+        Returns the items waiting in a stage which are not already being
+        processed, nor waiting for the retry of a failed fetch, and marks
+        them as being processed.
+
+        Args:
+            stage (int): DISCOVERED or FETCHED.
+            target_url (str): if given, only the items of this monitored URL.
+            limit (int): if given, the maximum number of items returned.
+            The rows are read lazily, so a large stage isn't loaded at once.
+
+        Returns:
+            List[Tuple[str, str, Dict]]: the URL, the monitored URL and the
+            data of each item.
+        """
+        sql = "SELECT url, target_url, data FROM pipeline WHERE stage = ? AND retry_at <= ?"
+        params = [stage, time.time()]
+        if target_url is not None:
+            sql += " AND target_url = ?"
+            params.append(target_url)
+        items = []
+        with self._lock:
+            for url, target, data in self.conn.execute(sql, params):
+                if url in self._claimed:
+                    continue
+                items.append((url, target, json.loads(data) if data else None))
+                if limit is not None and len(items) >= limit:
+                    break
+            self._claimed.update(item[0] for item in items)
+        return items
+
+    def mark_fetched(self, results: dict) -> None:
+        """
+        Moves discovered items to the 'fetched' stage, with their data.
+        Items whose page was fetched but has no ad data, e.g. a removed ad,
+        have nothing to notify, so they go straight to the 'notified' stage.
+        The items whose page couldn't be fetched go to mark_failed() instead.
+
+        Args:
+            results (dict): the URLs of the items, mapped to their data or to None.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        rows = [(FETCHED if data is not None else NOTIFIED,
+                 None if data is None else json.dumps(data), now, url)
+                for url, data in results.items()]
+        with self._lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                f"UPDATE pipeline SET stage = ?, data = ?, updated_at = ? "
+                f"WHERE url = ? AND stage = {DISCOVERED}", rows)
+            self._transitions[FETCHED] += self.conn.total_changes - before
+            self._claimed.difference_update(results)
+
+    def mark_failed(self, urls: list) -> None:
+        """
+        Leaves discovered items whose page couldn't be fetched in the
+        'discovered' stage, to be claimed again after a delay, doubled after
+        each failure up to FETCH_RETRY_MAX_DELAY. After max_attempts
+        failures, the items are given up: they go to the 'notified' stage.
+
+        Args:
+            urls (list): the URLs of the items.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                f"UPDATE pipeline SET attempts = attempts + 1, "
+                f"retry_at = ? + MIN(?, ? * (1 << attempts)), updated_at = ? "
+                f"WHERE url = ? AND stage = {DISCOVERED}",
+                ((now, FETCH_RETRY_MAX_DELAY, self.retry_delay, now, url) for url in urls))
+            given_up = []
+            for start in range(0, len(urls), BATCH_SIZE):
+                batch = urls[start:start + BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                given_up.extend(row[0] for row in self.conn.execute(
+                    f"SELECT url FROM pipeline WHERE url IN ({placeholders}) "
+                    f"AND stage = {DISCOVERED} AND attempts >= ?",
+                    batch + [self.max_attempts]))
+            self.conn.executemany(
+                f"UPDATE pipeline SET stage = {NOTIFIED}, data = NULL, updated_at = ? "
+                f"WHERE url = ? AND stage = {DISCOVERED}",
+                ((now, url) for url in given_up))
+            self._claimed.difference_update(urls)
+        for url in given_up:
+            logging.warning(f"Giving up {url} after {self.max_attempts} failed fetches")
+
+    def mark_notified(self, urls: list) -> None:
+        """
+        Moves fetched items to the 'notified' stage.
+
+        Args:
+            urls (list): the URLs of the items.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        with self._lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                f"UPDATE pipeline SET stage = {NOTIFIED}, updated_at = ? "
+                f"WHERE url = ? AND stage = {FETCHED}",
+                ((now, url) for url in urls))
+            self._transitions[NOTIFIED] += self.conn.total_changes - before
+            self._claimed.difference_update(urls)
+
+    def reject(self, rejections: dict) -> None:
+        """
+        Detaches fetched items from the searches whose filter rejected them.
+        The items left without any search are removed from the pipeline,
+        without being archived: they are not seen for the other searches,
+        which notify them when they find them. The items attached meanwhile
+        to another search stay in the 'fetched' stage, for that search.
+
+        Args:
+            rejections (dict): the URLs of the items, mapped to the
+            monitored URLs which rejected them.
+
+        Returns:
+            None
+        """
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM pipeline_targets WHERE url = ? AND target_url = ?",
+                ((url, target_url) for url, target_urls in rejections.items()
+                 for target_url in target_urls))
+            self.conn.executemany(
+                f"DELETE FROM pipeline WHERE url = ? AND stage = {FETCHED} AND NOT EXISTS "
+                f"(SELECT 1 FROM pipeline_targets WHERE pipeline_targets.url = pipeline.url)",
+                ((url,) for url in rejections))
+            self._claimed.difference_update(rejections)
+
+    def release(self, urls: list) -> None:
+        """
+        Makes items available again to claim(), e.g. after a failed attempt.
+
+        Args:
+            urls (list): the URLs of the items.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._claimed.difference_update(urls)
+
+    def get_targets(self, urls: list) -> dict:
+        """
+        Returns the searches which found each item, in the order in which
+        they found it.
+
+        Args:
+            urls (list): the URLs of the items.
+
+        Returns:
+            Dict[str, List[str]]: the URLs of the items, mapped to the
+            monitored URLs which found them.
+        """
+        targets = {}
+        with self._lock:
+            for start in range(0, len(urls), BATCH_SIZE):
+                batch = urls[start:start + BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                for url, target_url in self.conn.execute(
+                        f"SELECT url, target_url FROM pipeline_targets "
+                        f"WHERE url IN ({placeholders}) ORDER BY rowid", batch):
+                    targets.setdefault(url, []).append(target_url)
+        return targets
+
+    def archive(self, db) -> int:
+        """
+        Records the notified items in the 'ads' table and removes them
+        from the pipeline.
+
+        Args:
+            db (DatabaseManager): the database manager.
+
+        Returns:
+            int: the number of archived items.
+        """
+        with self._lock:
+            urls = [row[0] for row in self.conn.execute(
+                f"SELECT url FROM pipeline WHERE stage = {NOTIFIED}")]
+        if not urls:
+            return 0
+        # The ads are recorded first, so an interruption here is harmless
+        db.add_urls(urls)
+        with self._lock, self.conn:
+            self.conn.executemany(
+                f"DELETE FROM pipeline WHERE url = ? AND stage = {NOTIFIED}",
+                ((url,) for url in urls))
+            self.conn.executemany(
+                "DELETE FROM pipeline_targets WHERE url = ?", ((url,) for url in urls))
+        return len(urls)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the backlog of each stage and the throughput of each
+        transition since the pipeline was created.
+
+        Returns:
+            dict: 'backlog' - the number of items in each stage, and
+            'throughput' - the number of items which entered each stage
+            per second.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT stage, COUNT(*) FROM pipeline GROUP BY stage").fetchall()
+            transitions = dict(self._transitions)
+        backlog = dict.fromkeys(STAGE_NAMES.values(), 0)
+        for stage, count in rows:
+            backlog[STAGE_NAMES[stage]] = count
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        throughput = {STAGE_NAMES[stage]: count / elapsed
+                      for stage, count in transitions.items()}
+        return {"backlog": backlog, "throughput": throughput}
+
+    def close(self) -> None:
+        """
+        Closes the connection of the pipeline.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,351 @@
+"""
+Rate limiting primitives shared by the notification services and the scraper.
+"""
+import os
+import re
+import json
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are not available on Windows: limits are per process there
+    fcntl = None
+
+
+class TokenBucket():
+    """Thread-safe token bucket: allows bursts of up to 'capacity' operations
+    and a sustained rate of 'rate' operations per second."""
+
+    def __init__(self, rate: float, capacity: float = 1) -> None:
+        """
+        Init a new, full bucket.
+
+        Args:
+            rate (float): number of tokens added per second.
+            capacity (float): maximum number of tokens in the bucket.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        """
+        Adds the tokens accumulated since the last update. Must be called
+        with the lock held.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        Takes tokens from the bucket, if available.
+
+        Args:
+            tokens (float): the number of tokens to take.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the number of
+            seconds to wait until they are available.
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Takes tokens from the bucket, waiting until they are available.
+
+        Args:
+            tokens (float): the number of tokens to take.
+
+        Returns:
+            None
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter():
+    """
+    Per-host token buckets whose rate adapts to the responses of the host
+    (AIMD): the rate grows additively while requests succeed quickly, and
+    is cut multiplicatively on errors, throttling answers (403/429) and slow
+    responses. Throttling answers also pause the host for a back-off period.
+
+    When a state directory is given and the platform supports file locks,
+    the state of each host is kept in a locked file, so the limits are shared
+    by all the threads and processes of the machine using the same directory.
+    The directory must be on a local filesystem: file locks are unreliable
+    over NFS.
+    """
+
+    def __init__(self, max_rate: float = 10, min_rate: float = 0.2,
+                 increase: float = 0.5, decrease: float = 0.5,
+                 latency_threshold: float = 10, max_backoff: float = 300,
+                 state_dir: str = None) -> None:
+        """
+        Init a new limiter.
+
+        Args:
+            max_rate (float): default maximum rate of a host, in requests
+            per second. Hosts start at their maximum rate.
+            min_rate (float): minimum rate of a host.
+            increase (float): rate added per second of successful requests.
+            decrease (float): factor applied to the rate on a bad signal.
+            latency_threshold (float): responses slower than this, in seconds,
+            are treated as a sign of overload.
+            max_backoff (float): maximum back-off period, in seconds.
+            state_dir (str): directory of the shared state files. If None,
+            the state is kept in memory, for the current process only.
+        """
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.max_backoff = max_backoff
+        self.state_dir = state_dir if fcntl is not None else None
+        self._host_max_rates = {}
+        self._states = {}
+        # Copy of the latest state of each host seen by this process, read
+        # without locks by estimate_wait()
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        if self.state_dir is not None:
+            os.makedirs(self.state_dir, exist_ok=True)
+
+    def configure(self, host: str, max_rate: float) -> None:
+        """
+        Sets the maximum rate of a host.
+
+        Args:
+            host (str): the host, e.g. 'www.olx.ro'.
+            max_rate (float): the maximum rate, in requests per second.
+
+        Returns:
+            None
+        """
+        self._host_max_rates[host] = max_rate
+
+    def _new_state(self, host: str) -> dict:
+        """
+        Returns the initial state of a host.
+        """
+        max_rate = self._host_max_rates.get(host, self.max_rate)
+        return {
+            "host": host,
+            "rate": max_rate,
+            "tokens": 1.0,
+            "updated_at": time.time(),
+            "backoff_until": 0.0,
+            "errors": 0,
+            "last_decrease": 0.0
+        }
+
+    def _update(self, host: str, change) -> object:
+        """
+        Applies a change to the state of a host, atomically for all the
+        threads and, with a state directory, for all the processes.
+
+        Args:
+            host (str): the host.
+            change (callable): function that receives the state, modifies
+            it in place and returns a value.
+
+        Returns:
+            The value returned by the change function.
+        """
+        with self._lock:
+            if self.state_dir is None:
+                state = self._states.setdefault(host, self._new_state(host))
+                result = change(state)
+                self._snapshots[host] = dict(state)
+                return result
+            file_name = re.sub(r"[^\w.-]", "_", host) + ".json"
+            path = os.path.join(self.state_dir, file_name)
+            with open(path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = self._new_state(host)
+                    result = change(state)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            self._snapshots[host] = dict(state)
+            return result
+
+    def _refill(self, host: str, state: dict, now: float) -> None:
+        """
+        Adds the tokens accumulated since the last update of a state.
+        """
+        rate = min(state["rate"], self._host_max_rates.get(host, self.max_rate))
+        state["rate"] = max(rate, self.min_rate)
+        elapsed = max(now - state["updated_at"], 0.0)
+        state["tokens"] = min(max(state["rate"], 1.0),
+                              state["tokens"] + elapsed * state["rate"])
+        state["updated_at"] = now
+
+    def get_wait(self, host: str, take: bool = False) -> float:
+        """
+        Returns the time to wait before a request can be sent to a host.
+
+        Args:
+            host (str): the host.
+            take (bool): if True and no wait is needed, takes a token.
+
+        Returns:
+            float: 0 if a request can be sent now, otherwise the number
+            of seconds to wait.
+        """
+        def change(state: dict) -> float:
+            return self._take(host, state, time.time(), take)
+        return self._update(host, change)
+
+    def estimate_wait(self, host: str) -> float:
+        """
+        Estimates the time to wait before a request can be sent to a host,
+        from the latest state of the host seen by this process, without
+        locking or reading the state file. The estimate can be too low when
+        other processes use the host too, but acquire() still enforces the
+        actual limits. It is cheap enough to compare many hosts on every
+        request, e.g. the same site through several proxies.
+
+        Args:
+            host (str): the host.
+
+        Returns:
+            float: 0 if a request can probably be sent now, otherwise the
+            number of seconds to wait.
+        """
+        snapshot = self._snapshots.get(host)
+        if snapshot is None:
+            return 0.0
+        return self._take(host, dict(snapshot), time.time(), False)
+
+    def _take(self, host: str, state: dict, now: float, take: bool) -> float:
+        """
+        Refills a state and returns the time to wait before a request can
+        be sent, taking a token if requested and no wait is needed.
+        """
+        self._refill(host, state, now)
+        if now < state["backoff_until"]:
+            return state["backoff_until"] - now
+        if state["tokens"] >= 1:
+            if take:
+                state["tokens"] -= 1
+            return 0.0
+        return (1 - state["tokens"]) / state["rate"]
+
+    def acquire(self, host: str) -> None:
+        """
+        Waits until a request can be sent to a host, then takes a token.
+
+        Args:
+            host (str): the host.
+
+        Returns:
+            None
+        """
+        while True:
+            wait = self.get_wait(host, take=True)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def record(self, host: str, status_code: int = None, latency: float = 0,
+               retry_after: float = None) -> None:
+        """
+        Adapts the rate of a host to the outcome of a request.
+
+        Args:
+            host (str): the host.
+            status_code (int): the HTTP status of the response, or None if
+            the request failed without a response.
+            latency (float): the duration of the request, in seconds.
+            retry_after (float): the delay requested by the host, if any.
+
+        Returns:
+            None
+        """
+        throttled = status_code in (403, 429)
+        failed = status_code is None or status_code >= 500
+        slow = latency > self.latency_threshold
+
+        def change(state: dict) -> None:
+            now = time.time()
+            self._refill(host, state, now)
+            if not (throttled or failed or slow):
+                state["errors"] = 0
+                state["rate"] += self.increase / state["rate"]
+                return
+            state["errors"] += 1
+            # Requests in flight fail together: cut the rate once per second
+            if now - state["last_decrease"] >= 1:
+                state["rate"] = max(state["rate"] * self.decrease, self.min_rate)
+                state["last_decrease"] = now
+            if throttled:
+                backoff = retry_after if retry_after is not None \
+                    else 2 ** min(state["errors"], 16)
+                state["backoff_until"] = max(
+                    state["backoff_until"], now + min(backoff, self.max_backoff))
+                state["tokens"] = 0.0
+        self._update(host, change)
+
+    def get_state(self, host: str) -> dict:
+        """
+        Returns the current limits of a host.
+
+        Args:
+            host (str): the host.
+
+        Returns:
+            dict: the current 'rate' (requests per second), the remaining
+            'backoff' (seconds) and the number of consecutive 'errors'.
+        """
+        def change(state: dict) -> dict:
+            now = time.time()
+            self._refill(host, state, now)
+            return {
+                "rate": state["rate"],
+                "backoff": max(state["backoff_until"] - now, 0.0),
+                "errors": state["errors"]
+            }
+        return self._update(host, change)
+
+    def get_states(self) -> dict:
+        """
+        Returns the current limits of all the hosts used so far.
+
+        Returns:
+            dict: the result of get_state() for each host.
+        """
+        hosts = set(self._states) | set(self._host_max_rates)
+        if self.state_dir is not None:
+            for name in os.listdir(self.state_dir):
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.state_dir, name)) as f:
+                        hosts.add(json.load(f)["host"])
+                except (OSError, ValueError, KeyError):
+                    continue
+        return {host: self.get_state(host) for host in sorted(hosts)}
@@ -0,0 +1,265 @@
+"""
+Detection of reposted ads. Sellers often delete an ad and post the same
+item again, under a new URL: the URL-based deduplication sees a new ad.
+Each fetched ad gets a 64-bit SimHash fingerprint of its normalized title
+and description, in which similar texts differ by few bits. An ad whose
+fingerprint is within MAX_DISTANCE bits of the fingerprint of an earlier ad
+of the same site is a repost of it.
+
+The fingerprints are stored in the 'ad_fingerprints' table and in a banded
+LSH index, the 'fingerprint_bands' table: each fingerprint is split into
+LSH_BANDS bands of bits, and two fingerprints within MAX_DISTANCE bits share
+at least one band when LSH_BANDS > MAX_DISTANCE. A lookup only compares the
+fingerprints sharing a band with the new one, through the primary key, so
+it doesn't slow down as the history grows.
+"""
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from utils import get_ad_key, normalize_text
+import metrics
+
+# Maximum number of keys bound to a single query (SQLite allows 999 variables)
+BATCH_SIZE = 500
+# Number of bits of a fingerprint
+SIMHASH_BITS = 64
+# Number of bands of the LSH index, of SIMHASH_BITS / LSH_BANDS bits each
+LSH_BANDS = 4
+# Maximum number of differing bits between the fingerprints of a repost
+# and of the original ad. Must be lower than LSH_BANDS
+MAX_DISTANCE = 3
+# Texts with fewer words are too short for a meaningful fingerprint
+MIN_WORDS = 5
+# Weight of the words of the title, relative to those of the description
+TITLE_WEIGHT = 3
+WORD_PATTERN = re.compile(r"\w+")
+BAND_BITS = SIMHASH_BITS // LSH_BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def get_features(title: str, description: str) -> dict:
+    """
+    Returns the weighted features of an ad: the pairs of consecutive words
+    of its normalized title and description.
+
+    Args:
+        title (str): the title of the ad.
+        description (str): the description of the ad.
+
+    Returns:
+        dict: the features mapped to their weight, or an empty dict if the
+        text is too short.
+    """
+    features = {}
+    for text, weight in ((title, TITLE_WEIGHT), (description, 1)):
+        words = WORD_PATTERN.findall(normalize_text(text or "").lower())
+        if len(words) == 1:
+            features[words[0]] = features.get(words[0], 0) + weight
+        for first, second in zip(words, words[1:]):
+            feature = f"{first} {second}"
+            features[feature] = features.get(feature, 0) + weight
+    return features if sum(features.values()) >= MIN_WORDS else {}
+
+
+def simhash(features: dict) -> int:
+    """
+    Computes the SimHash of weighted features: each bit is the sign of the
+    weighted sum of that bit of the hashes of the features.
+
+    Args:
+        features (dict): the features mapped to their weight.
+
+    Returns:
+        int: the fingerprint, as an unsigned SIMHASH_BITS-bit integer.
+    """
+    totals = [0] * SIMHASH_BITS
+    for feature, weight in features.items():
+        value = int.from_bytes(hashlib.blake2b(
+            feature.encode("utf-8"), digest_size=SIMHASH_BITS // 8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            totals[bit] += weight if value >> bit & 1 else -weight
+    return sum(1 << bit for bit, total in enumerate(totals) if total > 0)
+
+
+def get_bands(fingerprint: int) -> list:
+    """
+    Splits a fingerprint into the bands of the LSH index.
+
+    Args:
+        fingerprint (int): the unsigned fingerprint.
+
+    Returns:
+        List[int]: the value of each band.
+    """
+    return [fingerprint >> (band * BAND_BITS) & BAND_MASK for band in range(LSH_BANDS)]
+
+
+def to_signed(value: int) -> int:
+    """
+    Returns a 64-bit unsigned integer as the signed integer stored by SQLite.
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class RepostDetector():
+    """Class that fingerprints the ads and finds the reposts among them."""
+
+    def __init__(self, db_path: str, max_distance: int = MAX_DISTANCE) -> None:
+        """
+        Init a new detector and create its tables, if they don't exist. The
+        detector has its own connection, like the pipeline.
+
+        Args:
+            db_path (str): path of the database file.
+            max_distance (int): maximum number of differing bits between
+            the fingerprints of a repost and of the original ad.
+
+        Raises:
+            ValueError: If max_distance is not lower than LSH_BANDS, in
+            which case the index could miss reposts.
+        """
+        if not 0 <= max_distance < LSH_BANDS:
+            raise ValueError(f"max_distance must be between 0 and {LSH_BANDS - 1}")
+        self.max_distance = max_distance
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+        sql_create_table = """
+            CREATE TABLE IF NOT EXISTS ad_fingerprints (
+                ad_key      INTEGER     PRIMARY KEY,
+                url         TEXT        NOT NULL,
+                simhash     INTEGER     NOT NULL,
+                seen_at     INTEGER     NOT NULL
+            ) WITHOUT ROWID;
+            """
+        sql_create_bands_table = """
+            CREATE TABLE IF NOT EXISTS fingerprint_bands (
+                band        INTEGER     NOT NULL,
+                value       INTEGER     NOT NULL,
+                ad_key      INTEGER     NOT NULL,
+                PRIMARY KEY (band, value, ad_key)
+            ) WITHOUT ROWID;
+            """
+        with self._lock, self.conn:
+            self.conn.execute(sql_create_table)
+            self.conn.execute(sql_create_bands_table)
+
+    def _select_candidates(self, bands: dict, keys: set) -> dict:
+        """
+        Returns the stored fingerprints sharing a band with the given ones.
+        Must be called with the lock held.
+
+        Args:
+            bands (dict): the band numbers, mapped to the set of the values
+            to look up in each band.
+            keys (set): keys of other ads whose stored fingerprints are
+            also returned, if any.
+
+        Returns:
+            dict: the keys of the candidate ads, mapped to their (url,
+            simhash, seen_at) tuple, with the unsigned simhash.
+        """
+        keys = set(keys)
+        for band, values in bands.items():
+            values = list(values)
+            for start in range(0, len(values), BATCH_SIZE):
+                batch = values[start:start + BATCH_SIZE]
+                placeholders = ", ".join("?" * len(batch))
+                cursor = self.conn.execute(
+                    f"SELECT ad_key FROM fingerprint_bands "
+                    f"WHERE band = ? AND value IN ({placeholders})", [band] + batch)
+                keys.update(ad_key for ad_key, in cursor)
+        candidates = {}
+        keys = list(keys)
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = self.conn.execute(
+                f"SELECT ad_key, url, simhash, seen_at FROM ad_fingerprints "
+                f"WHERE ad_key IN ({placeholders})", batch)
+            for ad_key, url, fingerprint, seen_at in cursor:
+                candidates[ad_key] = (url, fingerprint & (1 << 64) - 1, seen_at)
+        return candidates
+
+    def check(self, ads: list) -> dict:
+        """
+        Fingerprints ads, finds the reposts among them and stores their
+        fingerprints, in a single transaction. An ad is a repost when an
+        ad of the same site with another ID, first seen before it, including
+        an ad of the same batch, has a close fingerprint. An ad checked
+        again, e.g. when its notification is retried, keeps the date it was
+        first seen, so it is not taken for a repost of its own reposts.
+
+        Args:
+            ads (List[Dict]): the data of the ads, as returned by
+            OlxScraper.get_ad_data(). Ads without data are ignored.
+
+        Returns:
+            dict: the URLs of the reposts, mapped to the URL of the ad they
+            repeat.
+        """
+        fingerprints = {}
+        for ad_data in ads:
+            if not ad_data or not ad_data.get("url"):
+                continue
+            features = get_features(ad_data.get("title"), ad_data.get("description"))
+            if features:
+                fingerprints[get_ad_key(ad_data["url"])] = (ad_data["url"], simhash(features))
+        if not fingerprints:
+            return {}
+        bands = {}
+        for _, fingerprint in fingerprints.values():
+            for band, value in enumerate(get_bands(fingerprint)):
+                bands.setdefault(band, set()).add(value)
+        now = int(time.time())
+        reposts = {}
+        with metrics.span("reposts.check"), self._lock:
+            candidates = self._select_candidates(bands, set(fingerprints))
+            first_seen = {key: candidates[key][2] for key in fingerprints if key in candidates}
+            stored = {key: candidates[key][1] for key in first_seen}
+            for key, (url, fingerprint) in fingerprints.items():
+                seen_at = first_seen.get(key)
+                original = next(
+                    (candidate_url for candidate_key, (candidate_url, candidate, candidate_seen_at)
+                     in candidates.items()
+                     if candidate_key != key and candidate_key >> 48 == key >> 48
+                     and (seen_at is None or candidate_seen_at < seen_at)
+                     and bin(fingerprint ^ candidate).count("1") <= self.max_distance),
+                    None)
+                if original is not None:
+                    reposts[url] = original
+                # The next ads of the batch are also compared with this one
+                candidates.setdefault(key, (url, fingerprint, now))
+            with self.conn:
+                # The bands of a fingerprint which changed, e.g. after an
+                # edit of the ad, would still lead to the ad
+                self.conn.executemany(
+                    "DELETE FROM fingerprint_bands WHERE band = ? AND value = ? AND ad_key = ?",
+                    [(band, value, key) for key, fingerprint in stored.items()
+                     if fingerprint != fingerprints[key][1]
+                     for band, value in enumerate(get_bands(fingerprint))])
+                self.conn.executemany(
+                    "INSERT INTO ad_fingerprints (ad_key, url, simhash, seen_at) "
+                    "VALUES(?, ?, ?, ?) ON CONFLICT (ad_key) DO UPDATE SET "
+                    "url = excluded.url, simhash = excluded.simhash",
+                    [(key, url, to_signed(fingerprint), now)
+                     for key, (url, fingerprint) in fingerprints.items()])
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO fingerprint_bands (band, value, ad_key) "
+                    "VALUES(?, ?, ?)",
+                    [(band, value, key) for key, (_, fingerprint) in fingerprints.items()
+                     for band, value in enumerate(get_bands(fingerprint))])
+        metrics.inc("ads_reposts", len(reposts))
+        return reposts
+
+    def close(self) -> None:
+        """
+        Closes the connection of the detector.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.conn.close()
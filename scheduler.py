@@ -0,0 +1,247 @@
+"""
+Adaptive polling scheduler used by the daemon mode. Each monitored URL has
+its own next-run time and polling interval. The interval follows the rate at
+which the search produces new ads, within per-URL bounds.
+
+The schedule can be saved between runs, so that a run started by cron can
+tell, with is_work_due(), whether anything is due before loading the rest of
+the app.
+"""
+import os
+import json
+import time
+import random
+
+# Number of new ads a poll should find on average
+TARGET_ADS_PER_POLL = 1.0
+# Weight of the latest observation in the new-ad rate average
+RATE_SMOOTHING = 0.3
+# Maximum growth of the interval between two polls of a quiet search
+MAX_BACKOFF = 2.0
+
+
+class AdaptiveScheduler():
+    """Class that decides when each monitored URL should be polled."""
+
+    def __init__(self, min_interval: float = 60, max_interval: float = 3600,
+                 jitter: float = 0.1) -> None:
+        """
+        Init a new scheduler.
+
+        Args:
+            min_interval (float): default minimum polling interval, in seconds.
+            max_interval (float): default maximum polling interval, in seconds.
+            jitter (float): random spread applied to each interval, as a
+            fraction of the interval, so that searches don't align.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.searches = {}
+
+    def add(self, url: str, min_interval: float = None,
+            max_interval: float = None) -> None:
+        """
+        Adds a URL to the schedule, or updates its bounds. New URLs are due
+        immediately.
+
+        Args:
+            url (str): the monitored URL.
+            min_interval (float): minimum polling interval for this URL.
+            max_interval (float): maximum polling interval for this URL.
+
+        Returns:
+            None
+        """
+        min_interval = min_interval or self.min_interval
+        max_interval = max(max_interval or self.max_interval, min_interval)
+        search = self.searches.get(url)
+        if search is None:
+            self.searches[url] = {
+                "min_interval": min_interval,
+                "max_interval": max_interval,
+                "interval": min_interval,
+                "rate": 0.0,
+                "last_run": None,
+                "next_run": 0.0
+            }
+            return
+        search["min_interval"] = min_interval
+        search["max_interval"] = max_interval
+        search["interval"] = min(max(search["interval"], min_interval),
+                                 max_interval)
+
+    def sync(self, targets: dict) -> None:
+        """
+        Makes the schedule match the monitored URLs, adding the new ones
+        and dropping the ones which are no longer monitored.
+
+        Args:
+            targets (dict): the monitored URLs, mapped to their options.
+
+        Returns:
+            None
+        """
+        for url in list(self.searches):
+            if url not in targets:
+                del self.searches[url]
+        for url, options in targets.items():
+            self.add(url, options.get("min_interval"),
+                     options.get("max_interval"))
+
+    def due(self, now: float = None) -> list:
+        """
+        Returns the URLs which should be polled now.
+
+        Args:
+            now (float): the current time. Defaults to time.time().
+
+        Returns:
+            list: the URLs whose next-run time has passed.
+        """
+        now = time.time() if now is None else now
+        return [url for url, search in self.searches.items()
+                if search["next_run"] <= now]
+
+    def record(self, url: str, new_ads_count: int, now: float = None) -> None:
+        """
+        Records the result of a poll and schedules the next one. The
+        interval shrinks for searches with many new ads and grows,
+        gradually, for quiet searches.
+
+        Args:
+            url (str): the polled URL.
+            new_ads_count (int): the number of new ads found by the poll.
+            now (float): the current time. Defaults to time.time().
+
+        Returns:
+            None
+        """
+        search = self.searches.get(url)
+        if search is None:
+            return
+        now = time.time() if now is None else now
+        if search["last_run"] is not None:
+            elapsed = max(now - search["last_run"], 1.0)
+            search["rate"] += RATE_SMOOTHING * \
+                (new_ads_count / elapsed - search["rate"])
+        elif new_ads_count:
+            # No history yet: assume the ads appeared during one interval
+            search["rate"] = new_ads_count / search["interval"]
+        if search["rate"] > 0:
+            wanted = TARGET_ADS_PER_POLL / search["rate"]
+        else:
+            wanted = search["max_interval"]
+        interval = min(wanted, search["interval"] * MAX_BACKOFF)
+        search["interval"] = min(max(interval, search["min_interval"]),
+                                 search["max_interval"])
+        spread = random.uniform(1 - self.jitter, 1 + self.jitter)
+        search["last_run"] = now
+        search["next_run"] = now + search["interval"] * spread
+
+    def seconds_until_next(self, now: float = None) -> float:
+        """
+        Returns the number of seconds until the next URL is due.
+
+        Args:
+            now (float): the current time. Defaults to time.time().
+
+        Returns:
+            float: the number of seconds, or None if the schedule is empty.
+        """
+        if not self.searches:
+            return None
+        now = time.time() if now is None else now
+        next_run = min(search["next_run"] for search in self.searches.values())
+        return max(next_run - now, 0.0)
+
+    def save(self, path: str, pending_work: bool = False) -> None:
+        """
+        Saves the schedule to a JSON file. The file is replaced atomically,
+        so a concurrent reader never sees a partial schedule.
+
+        Args:
+            path (str): path of the file.
+            pending_work (bool): True if the run left work to finish, e.g.
+            ads not notified yet, so the next run must not skip it.
+
+        Returns:
+            None
+        """
+        state = {
+            "saved_at": time.time(),
+            "pending_work": pending_work,
+            "searches": self.searches
+        }
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, path)
+
+    def load(self, path: str) -> bool:
+        """
+        Loads a schedule saved by save(). Call sync() afterwards, to apply
+        the current monitored URLs and their bounds.
+
+        Args:
+            path (str): path of the file.
+
+        Returns:
+            bool: False if the file is missing or invalid, in which case
+            the schedule is unchanged.
+        """
+        state = read_state(path)
+        if state is None:
+            return False
+        self.searches = state["searches"]
+        return True
+
+
+def read_state(path: str) -> dict:
+    """
+    Reads a schedule saved by AdaptiveScheduler.save().
+
+    Args:
+        path (str): path of the file.
+
+    Returns:
+        dict: the saved state, or None if the file is missing or invalid.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or not isinstance(state.get("searches"), dict):
+        return None
+    return state
+
+
+def is_work_due(path: str, targets_path: str, now: float = None) -> bool:
+    """
+    Tells from a saved schedule alone whether a run has anything to do.
+    This only reads two small files, so it is cheap enough to be checked
+    by every run before the app is loaded.
+
+    Args:
+        path (str): path of the saved schedule.
+        targets_path (str): path of the file of the monitored URLs. The
+        work is due when it was modified after the schedule was saved.
+        now (float): the current time. Defaults to time.time().
+
+    Returns:
+        bool: True if the schedule is missing or invalid, if the last run
+        left work to finish, if the monitored URLs changed, or if a URL
+        is due.
+    """
+    state = read_state(path)
+    if state is None or state.get("pending_work"):
+        return True
+    try:
+        if os.path.getmtime(targets_path) >= state.get("saved_at", 0):
+            return True
+    except OSError:
+        return True
+    now = time.time() if now is None else now
+    return any(search.get("next_run", 0) <= now
+               for search in state["searches"].values())
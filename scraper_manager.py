@@ -1,22 +1,60 @@
 import re
+import asyncio
+import collections
 import requests
 import logging
-import logging_config
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from bs4 import BeautifulSoup, ResultSet, Tag
-from utils import get_header
+from bs4 import BeautifulSoup
+from utils import get_header, parse_price
+from http_manager import get_rate_limiter, get_proxy_pool, get_site_client
+import metrics
+from cache_manager import HttpCache
+from extractors import EXTRACTOR_VERSION, get_extractor
+from site_adapters import SITE_ADAPTERS, SiteAdapter, get_site_adapter
 
 
-class OlxScraper:
-    """Class used to scrape data from OLX Romania."""
+class FetchError(Exception):
+    """
+    Raised when a page couldn't be fetched, e.g. on a timeout or an HTTP
+    error, as opposed to a page fetched without the data looked for.
+    """
+
 
-    def __init__(self):
+class OlxScraper:
+    """
+    Class used to scrape data from the OLX sites. The rules of each site are
+    held by its SiteAdapter; OLX Romania is the default site.
+    """
+
+    def __init__(self, max_concurrency: int = 10, cache: HttpCache = None,
+                 cache_ttl: float = 0, extractor: str = "auto",
+                 site: str = "www.olx.ro"):
         self.headers = get_header()
-        self.netloc = "www.olx.ro"
-        self.schema = "https"
+        self.site = SITE_ADAPTERS[site]
+        self.netloc = self.site.netloc
+        self.schema = self.site.schema
         self.current_page = 1
         self.last_page = None
+        # Global limit of simultaneous requests made by the async engine
+        self.max_concurrency = max_concurrency
+        self._executor = None
+        self._semaphore = None
+        self._semaphore_loop = None
+        # Per-site concurrency limits
+        self._site_semaphores = {}
+        # Requests in flight, by URL, shared by the callers asking for the
+        # same page at the same time
+        self._in_flight = {}
+        # Optional on-disk cache of the fetched pages. Ad pages are reused
+        # without asking the server for cache_ttl seconds, while result
+        # pages are always revalidated.
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        # Backend used to extract the data from the HTML of the pages
+        self.extractor_name = extractor
+        self.extractor = get_extractor(extractor, self.site.selectors)
+        self._site_extractors = {self.site.netloc: self.extractor}
 
     def parse_content(self, target_url: str) -> BeautifulSoup:
         """
@@ -30,51 +68,215 @@ class OlxScraper:
             or None in case of error.
         """
         try:
-            r = requests.get(target_url, headers=self.headers, timeout=60)
-            r.raise_for_status()
+            with metrics.span("http.get"):
+                r = get_site_client().get(
+                    target_url, headers=self.headers, timeout=60)
+                r.raise_for_status()
         except requests.exceptions.RequestException as error:
+            metrics.inc("http.errors")
             logging.error(f"Connection error: {error}")
         else:
-            parsed_content = BeautifulSoup(r.text, "html.parser")
+            metrics.inc("pages_fetched")
+            metrics.inc("bytes_fetched", len(r.content))
+            with metrics.span("parse.soup"):
+                parsed_content = BeautifulSoup(r.text, "html.parser")
             return parsed_content
 
-    def get_ads(self, parsed_content: BeautifulSoup) -> ResultSet[Tag]:
+    def fetch_extracted(self, target_url: str, kind: str, extract, ttl: float = 0):
         """
-        Returns all ads found on the parsed web page.
+        Fetches a page and extracts data from it. With a cache, the data
+        extracted previously is reused when the cached page is fresh or the
+        server answers a conditional request with 304 Not Modified, so the
+        page is neither downloaded nor parsed again.
 
         Args:
-            parsed_content (BeautifulSoup): a BeautifulSoup object created as
-            a result of parsing the web page.
+            target_url (str): A string representing the URL to be processed.
+            kind (str): name of the extracted data. It is cached under this
+            name, the extractor and EXTRACTOR_VERSION, so the data extracted
+            by another extractor or version is not used.
+            extract (callable): function that receives the HTML of the page
+            and returns JSON-serializable data.
+            ttl (float): seconds during which a cached page is used without
+            asking the server.
 
         Returns:
-            ResultSet[Tag]: A ResultSet containing all HTML tags that contain ads.
+            The extracted data.
+
+        Raises:
+            FetchError: If the page couldn't be fetched.
         """
-        if parsed_content is None:
+        cache_key = f"{kind}:{self.extractor_name}:v{EXTRACTOR_VERSION}"
+        entry = self.cache.get(target_url) if self.cache is not None else None
+        if entry is not None and cache_key in entry["extracted"] \
+                and HttpCache.is_fresh(entry, ttl):
+            metrics.inc("cache.hits")
+            return entry["extracted"][cache_key]
+        headers = dict(self.headers)
+        if entry is not None:
+            headers.update(HttpCache.get_conditional_headers(entry))
+        r = self._get(target_url, headers)
+        if r is None:
+            raise FetchError(f"Couldn't fetch {target_url}")
+        if r.status_code == 304 and entry is not None:
+            metrics.inc("cache.revalidated")
+            if cache_key in entry["extracted"]:
+                self.cache.update(target_url, entry)
+                return entry["extracted"][cache_key]
+            html = self.cache.get_body(target_url)
+            if html is not None:
+                with metrics.span(f"parse.{kind}"):
+                    data = extract(html)
+                # The data of the other versions is outdated
+                entry["extracted"] = {
+                    name: value for name, value in entry["extracted"].items()
+                    if name.endswith(f":v{EXTRACTOR_VERSION}")}
+                entry["extracted"][cache_key] = data
+                self.cache.update(target_url, entry)
+                return data
+            # The body was evicted, so fetch the page unconditionally
+            r = self._get(target_url, self.headers)
+            if r is None:
+                raise FetchError(f"Couldn't fetch {target_url}")
+        with metrics.span(f"parse.{kind}"):
+            data = extract(r.text)
+        if self.cache is not None:
+            self.cache.store(target_url, r.text, r.headers.get("ETag"),
+                             r.headers.get("Last-Modified"), {cache_key: data})
+        return data
+
+    def _get(self, target_url: str, headers: dict) -> requests.Response:
+        """
+        Sends a GET request through the shared HTTP client, or through the
+        egress proxies, if configured.
+
+        Args:
+            target_url (str): the URL to request.
+            headers (dict): the headers of the request.
+
+        Returns:
+            requests.Response: the response, or None in case of error.
+        """
+        try:
+            with metrics.span("http.get"):
+                r = get_site_client().get(target_url, headers=headers, timeout=60)
+                r.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            metrics.inc("http.errors")
+            if error.response is not None and error.response.status_code in (403, 429):
+                logging.error(
+                    f"Throttled by {urlparse(target_url).netloc} "
+                    f"(HTTP {error.response.status_code}): {target_url}")
+            else:
+                logging.error(f"HTTP error: {error}")
+            return None
+        except requests.exceptions.RequestException as error:
+            metrics.inc("http.errors")
+            logging.error(f"Connection error: {error}")
             return None
-        ads = parsed_content.select("div.css-1sw7q4x")
-        return ads
+        metrics.inc("pages_fetched")
+        metrics.inc("bytes_fetched", len(r.content))
+        return r
 
-    def get_last_page(self, parsed_content: BeautifulSoup) -> int:
+    def get_listing_page(self, target_url: str) -> dict:
         """
-        Returns the number of the last page available for processing.
+        Fetches a page of results and extracts the ad URLs and the
+        number of the last page from it.
 
         Args:
-            parsed_content (BeautifulSoup): a BeautifulSoup object created
-            as a result of parsing the web page.
+            target_url (str): URL of the page of results.
 
         Returns:
-            int: The number of the last page available for parsing. If
-            there is no paging or the parsed object is None, it will return None.
+            dict: the 'links' (list) of the relevant ads, the 'last_page'
+            (int or None), the complete 'records' of the ads found on the
+            page and the 'cards' of the ads - the 'title', 'price',
+            'price_value' and 'currency' shown on the page - both mapped to
+            their links, or None in case of error.
         """
-        if parsed_content is not None:
-            pagination_ul = parsed_content.find("ul", class_="pagination-list")
-            if pagination_ul is not None:
-                pages = pagination_ul.find_all("li", class_="pagination-item")
-                if pages:
-                    return int(pages[-1].text)
-        return None
+        site = self.get_site(target_url)
+
+        def extract(html: str) -> dict:
+            listing = self.get_extractor(site).parse_listing(html)
+            links = self.filter_ads_urls(listing["links"], site)
+            records = {}
+            for link, record in listing.get("records", {}).items():
+                absolute_link = next(iter(self.filter_ads_urls([link], site)), None)
+                if absolute_link in links:
+                    ad_data = self.build_ad_data(record, absolute_link)
+                    if ad_data is not None:
+                        records[absolute_link] = ad_data
+            cards = {}
+            for link, card in listing.get("cards", {}).items():
+                absolute_link = next(iter(self.filter_ads_urls([link], site)), None)
+                if absolute_link in links:
+                    card = dict(card)
+                    if card.get("price_value") is None:
+                        card["price_value"], card["currency"] = parse_price(card["price"])
+                    cards[absolute_link] = card
+            return {
+                "links": sorted(links),
+                "last_page": listing["last_page"],
+                "records": records,
+                "cards": cards
+            }
+        try:
+            return self.fetch_extracted(target_url, "listing", extract)
+        except FetchError:
+            return None
+
+    def get_site(self, url: str) -> SiteAdapter:
+        """
+        Returns the adapter of the site a URL belongs to.
+
+        Args:
+            url (str): the URL.
+
+        Returns:
+            SiteAdapter: the adapter of the site, or the adapter of the
+            default site if the URL belongs to an unsupported site.
+        """
+        return get_site_adapter(url) or self.site
+
+    def get_extractor(self, site: SiteAdapter):
+        """
+        Returns the extractor configured with the selectors of a site.
+
+        Args:
+            site (SiteAdapter): the adapter of the site.
+
+        Returns:
+            The extractor of the site.
+        """
+        extractor = self._site_extractors.get(site.netloc)
+        if extractor is None:
+            extractor = get_extractor(self.extractor_name, site.selectors)
+            self._site_extractors[site.netloc] = extractor
+        return extractor
+
+    def filter_ads_urls(self, links: list, site: SiteAdapter = None) -> set:
+        """
+        Keeps the relevant internal links of the ads and makes them absolute.
+
+        Args:
+            links (list): the href values of the ads links.
+            site (SiteAdapter): the site of the page the links were taken
+            from. Defaults to the default site.
+
+        Returns:
+            set: the absolute URLs of the relevant ads.
+        """
+        site = site or self.site
+        ads_links = set()
+        for link_href in links:
+            if not self.is_internal_url(link_href, site.netloc):
+                continue
+            if not site.is_relevant_url(link_href):
+                continue
+            if self.is_relative_url(link_href):
+                link_href = f"{site.schema}://{site.netloc}{link_href}"
+            ads_links.add(link_href)
+        return ads_links
 
-    def scrape_ads_urls(self, target_url: str) -> list:
+    def scrape_ads_urls(self, target_url: str) -> set:
         """
         Scrapes the URLs of all valid ads present on an OLX page. Search all relevant
         URLs of the ads and adds them to a set. Parses all pages, from first to last.
@@ -83,37 +285,46 @@ class OlxScraper:
             target_url (str): URL of the OLX page to start the search from.
 
         Returns:
-            list: a list of relevant URLs of the ads found on the page.
+            set: the relevant URLs of the ads found on the pages.
 
         Raises:
-            ValueError: If the URL is invalid or does not belong to the specified domain.
+            ValueError: If the URL does not belong to a supported site.
         """
         ads_links = set()
-        if self.netloc != urlparse(target_url).netloc:
+        for page_links in self.iter_ads_urls(target_url):
+            ads_links.update(page_links)
+        return ads_links
+
+    def iter_ads_urls(self, target_url: str):
+        """
+        Same as scrape_ads_urls(), but yields the URLs of the ads page by
+        page, so only one page is held in memory at a time. The pages are
+        fetched and parsed by the site of the URL, like async_iter_listing().
+
+        Args:
+            target_url (str): URL of the OLX page to start the search from.
+
+        Yields:
+            set: the relevant URLs of the ads found on each page.
+
+        Raises:
+            ValueError: If the URL does not belong to a supported site.
+        """
+        site = get_site_adapter(target_url)
+        if site is None:
             raise ValueError(
-                f"Bad URL! OLXRadar is configured to process {self.netloc} links only.")
+                f"Bad URL! OLXRadar is configured to process "
+                f"{', '.join(SITE_ADAPTERS)} links only.")
         while True:
-            url = f"{target_url}/?page={self.current_page}"
-            parsed_content = self.parse_content(url)
-            self.last_page = self.get_last_page(parsed_content)
-            ads = self.get_ads(parsed_content)
-            if ads is None:
-                return ads_links
-            for ad in ads:
-                link = ad.find("a", class_="css-rc5s2u")
-                if link is not None and link.has_attr("href"):
-                    link_href = link["href"]
-                    if not self.is_internal_url(link_href, self.netloc):
-                        continue
-                    if not self.is_relevant_url(link_href):
-                        continue
-                    if self.is_relative_url(link_href):
-                        link_href = f"{self.schema}://{self.netloc}{link_href}"
-                    ads_links.add(link_href)
+            listing_page = self.get_listing_page(
+                site.get_page_url(target_url, self.current_page))
+            if listing_page is None:
+                return
+            self.last_page = listing_page["last_page"]
+            yield set(listing_page["links"])
             if self.last_page is None or self.current_page >= self.last_page:
                 break
             self.current_page += 1
-        return ads_links
 
     def is_relevant_url(self, url: str) -> bool:
         """
@@ -130,10 +341,7 @@ class OlxScraper:
         available for the user's region. Therefore, such a URL is not useful
         (relevant) for monitoring.
         """
-        segments = urlparse(url)
-        if segments.query != "":
-            return False
-        return True
+        return self.site.is_relevant_url(url)
 
     def is_internal_url(self, url: str, domain: str) -> bool:
         """
@@ -182,29 +390,46 @@ class OlxScraper:
         Returns:
             dict or None: A dictionary containing the scraped ad data
             or None if the required information is missing.
+
+        Raises:
+            FetchError: If the page of the ad couldn't be fetched.
         """
         logging.info(f"Processing {ad_url}")
-        content = self.parse_content(ad_url)
+        with metrics.span("scraper.get_ad_data"):
+            return self.fetch_extracted(
+                ad_url, "ad", lambda html: self.extract_ad_data(html, ad_url),
+                self.cache_ttl)
 
-        if content is None:
-            return None
+    def extract_ad_data(self, html: str, ad_url: str) -> dict[str]:
+        """
+        Extracts data from the HTML page of the ad.
+
+        Args:
+            html (str): the HTML of the page of the ad.
+            ad_url (str): the URL of the ad.
 
-        title = None
-        if content.find("h1", class_="css-1soizd2"):
-            title = content.find(
-                "h1", class_="css-1soizd2").get_text(strip=True)
-        price = None
-        if content.find("h3", class_="css-ddweki"):
-            price = content.find(
-                "h3", class_="css-ddweki").get_text(strip=True)
-        description = None
-        if content.find("div", class_="css-bgzo2k"):
-            description = content.find(
-                "div", class_="css-bgzo2k").get_text(strip=True, separator="\n")
-        seller = None
-        if content.find("h4", class_="css-1lcz6o7"):
-            seller = content.find(
-                "h4", class_="css-1lcz6o7").get_text(strip=True)
+        Returns:
+            dict or None: A dictionary containing the scraped ad data
+            or None if the required information is missing.
+        """
+        extractor = self.get_extractor(self.get_site(ad_url))
+        return self.build_ad_data(extractor.parse_ad(html), ad_url)
+
+    def build_ad_data(self, fields: dict, ad_url: str) -> dict[str]:
+        """
+        Builds the data of an ad from the fields extracted from a page.
+
+        Args:
+            fields (dict): the fields returned by the extractor.
+            ad_url (str): the URL of the ad.
+
+        Returns:
+            dict or None: A dictionary containing the scraped ad data
+            or None if the required information is missing.
+        """
+        title = fields.get("title")
+        price = fields.get("price")
+        description = fields.get("description")
         if any(item is None for item in [title, price, description]):
             return None
         ad_data = {
@@ -213,4 +438,272 @@ class OlxScraper:
             "url": ad_url,
             "description": description
         }
+        # Fields only provided by some extractors, e.g. the seller or the ad ID
+        for field, value in fields.items():
+            ad_data.setdefault(field, value)
         return ad_data
+
+    async def _run_limited(self, func, *args, site: SiteAdapter = None):
+        """
+        Runs a blocking function in the worker threads of the async engine,
+        without exceeding the global concurrency limit, nor the concurrency
+        limit and the request budget of the site.
+
+        Args:
+            func (callable): the blocking function to run.
+            *args: positional arguments passed to the function.
+            site (SiteAdapter): the site the function sends a request to.
+
+        Returns:
+            The value returned by the function.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        # A semaphore is bound to the event loop it was first used in
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+            self._site_semaphores = {}
+        site = site or self.site
+        limiter = get_rate_limiter()
+        # With egress proxies, the limits of the site apply to each proxy
+        proxy_pool = get_proxy_pool()
+        site_semaphore = self._site_semaphores.get(site.netloc)
+        if site_semaphore is None:
+            if proxy_pool is not None:
+                site_semaphore = asyncio.Semaphore(site.max_concurrency * len(proxy_pool))
+                proxy_pool.configure(site.netloc, site.requests_per_second)
+            else:
+                site_semaphore = asyncio.Semaphore(site.max_concurrency)
+                limiter.configure(site.netloc, site.requests_per_second)
+            self._site_semaphores[site.netloc] = site_semaphore
+        async with site_semaphore:
+            # Wait for the request budget here, rather than in a worker thread.
+            # The estimate doesn't touch the shared state file, which would
+            # block the event loop: the worker thread still waits in acquire()
+            # if other processes took the budget meanwhile
+            while True:
+                wait = proxy_pool.get_wait(site.netloc) if proxy_pool is not None \
+                    else limiter.estimate_wait(site.netloc)
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+            async with self._semaphore:
+                return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _single_flight(self, url: str, func, *args, site: SiteAdapter = None):
+        """
+        Same as _run_limited(), but concurrent calls for the same URL share
+        a single request: the callers arriving while it is in flight wait for
+        its result instead of fetching the page again. The result is shared,
+        so it must not be modified by the callers.
+
+        Args:
+            url (str): the URL of the page requested by the function.
+            func (callable): the blocking function to run.
+            *args: positional arguments passed to the function.
+            site (SiteAdapter): the site the function sends a request to.
+
+        Returns:
+            The value returned by the function.
+        """
+        future = self._in_flight.get(url)
+        if future is not None and future.get_loop() is asyncio.get_running_loop():
+            metrics.inc("requests_coalesced")
+            return await asyncio.shield(future)
+        future = asyncio.ensure_future(self._run_limited(func, *args, site=site))
+        self._in_flight[url] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self._in_flight.get(url) is future:
+                del self._in_flight[url]
+
+    async def async_parse_content(self, target_url: str) -> BeautifulSoup:
+        """
+        Async counterpart of parse_content().
+
+        Args:
+            target_url (str): A string representing the URL to be processed.
+
+        Returns:
+            BeautifulSoup: An object representing the processed content,
+            or None in case of error.
+        """
+        return await self._run_limited(
+            self.parse_content, target_url, site=self.get_site(target_url))
+
+    async def async_scrape_ads_urls(self, target_url: str,
+                                    filter_new=None) -> set:
+        """
+        Async counterpart of scrape_ads_urls(). Fetches the first page to
+        learn the number of the last page, then fetches all the remaining
+        pages concurrently.
+
+        If filter_new is given, the crawl is incremental: since OLX sorts the
+        results newest first, the pages are fetched one by one and the crawl
+        stops at the first page that contains only known ads.
+
+        Args:
+            target_url (str): URL of the OLX page to start the search from.
+            filter_new (callable): optional function that receives a set of
+            ad URLs and returns the ones which were not seen before.
+
+        Returns:
+            set: the relevant URLs of the ads found on the crawled pages.
+
+        Raises:
+            ValueError: If the URL is invalid or does not belong to the specified domain.
+        """
+        return set(await self.async_scrape_ads(target_url, filter_new))
+
+    async def async_scrape_ads(self, target_url: str, filter_new=None) -> dict:
+        """
+        Same as async_scrape_ads_urls(), but also returns the records of the
+        ads which are complete on the pages of results, so their pages don't
+        have to be fetched.
+
+        Args:
+            target_url (str): URL of the OLX page to start the search from.
+            filter_new (callable): optional function that receives a set of
+            ad URLs and returns the ones which were not seen before.
+
+        Returns:
+            dict: the relevant URLs of the ads found on the crawled pages,
+            mapped to their data, or to None if the data is not complete.
+
+        Raises:
+            ValueError: If the URL is invalid or does not belong to the specified domain.
+        """
+        return (await self.async_scrape_listing(target_url, filter_new))["ads"]
+
+    async def async_scrape_listing(self, target_url: str, filter_new=None) -> dict:
+        """
+        Same as async_scrape_ads(), but also returns the cards of all the
+        ads found, as shown on the pages of results.
+
+        Args:
+            target_url (str): URL of the OLX page to start the search from.
+            filter_new (callable): optional function that receives a set of
+            ad URLs and returns the ones which were not seen before.
+
+        Returns:
+            dict: the 'ads', as returned by async_scrape_ads(), and the
+            'cards' of the ads, mapped to their URLs (see get_listing_page()).
+
+        Raises:
+            ValueError: If the URL is invalid or does not belong to the specified domain.
+        """
+        ads = {}
+        cards = {}
+        async for listing_page in self.async_iter_listing(target_url, filter_new):
+            for link in listing_page["links"]:
+                ads.setdefault(link, None)
+            ads.update(listing_page.get("records", {}))
+            cards.update(listing_page.get("cards", {}))
+        return {"ads": ads, "cards": cards}
+
+    async def async_iter_listing(self, target_url: str, filter_new=None):
+        """
+        Yields the pages of results of a search one by one, in order, as
+        returned by get_listing_page(), so that huge searches are processed
+        in constant memory. Fetches the first page to learn the number of the
+        last page. The next pages are fetched concurrently, at most
+        'max_concurrency' of the site ahead of the consumer, so a slow
+        consumer slows down the crawl instead of buffering pages.
+
+        If filter_new is given, the crawl is incremental: since OLX sorts the
+        results newest first, the pages are fetched one by one and the crawl
+        stops at the first page that contains only known ads.
+
+        Args:
+            target_url (str): URL of the OLX page to start the search from.
+            filter_new (callable): optional function that receives a set of
+            ad URLs and returns the ones which were not seen before.
+
+        Yields:
+            dict: the 'links', 'last_page' and 'cards' of each page, and the
+            'records' of its ads, if the extractor provides them.
+
+        Raises:
+            ValueError: If the URL is invalid or does not belong to the specified domain.
+        """
+        site = get_site_adapter(target_url)
+        if site is None:
+            raise ValueError(
+                f"Bad URL! OLXRadar is configured to process "
+                f"{', '.join(SITE_ADAPTERS)} links only.")
+
+        def fetch(page: int):
+            page_url = site.get_page_url(target_url, page)
+            return self._single_flight(page_url, self.get_listing_page, page_url, site=site)
+
+        first_page = await fetch(1)
+        if first_page is None:
+            return
+        metrics.inc("ads_discovered", len(first_page["links"]))
+        yield first_page
+        last_page = first_page["last_page"]
+        if last_page is None or last_page < 2:
+            return
+        if filter_new is not None:
+            page_links = set(first_page["links"])
+            for page in range(2, last_page + 1):
+                if not filter_new(page_links):
+                    logging.info(
+                        f"Stopping at page {page - 1} of {target_url}: no new ads")
+                    break
+                listing_page = await fetch(page)
+                if listing_page is None:
+                    break
+                page_links = set(listing_page["links"])
+                metrics.inc("ads_discovered", len(listing_page["links"]))
+                yield listing_page
+            return
+        pending = collections.deque()
+        next_page = 2
+        try:
+            while pending or next_page <= last_page:
+                while next_page <= last_page and len(pending) < site.max_concurrency:
+                    pending.append(asyncio.ensure_future(fetch(next_page)))
+                    next_page += 1
+                listing_page = await pending.popleft()
+                if listing_page is not None:
+                    metrics.inc("ads_discovered", len(listing_page["links"]))
+                    yield listing_page
+        finally:
+            # The consumer stopped early: don't leave requests behind
+            for task in pending:
+                task.cancel()
+
+    async def async_get_ad_data(self, ad_url: str) -> dict[str]:
+        """
+        Async counterpart of get_ad_data().
+
+        Args:
+            ad_url (str): the URL of the ad.
+
+        Returns:
+            dict or None: A dictionary containing the scraped ad data
+            or None if the required information is missing.
+
+        Raises:
+            FetchError: If the page of the ad couldn't be fetched.
+        """
+        return await self._single_flight(
+            ad_url, self.get_ad_data, ad_url, site=self.get_site(ad_url))
+
+    def close(self) -> None:
+        """
+        Releases the worker threads used by the async engine.
+
+        Returns:
+            None
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._semaphore = None
+        self._semaphore_loop = None
@@ -0,0 +1,321 @@
+"""
+Local full-text search over the scraped ads. The data of every fetched ad -
+title, price, description - is kept in the 'ads_index' table of the database,
+and its title and description in the 'ads_fts' SQLite FTS5 index, which
+triggers keep in sync with the table. The ads are indexed in batches, as the
+pipeline notifies them, so the index grows during the crawl.
+
+The index can be queried from Python:
+    index = SearchIndex()
+    index.search("raspberry pi 4", max_price=300, since=time.time() - 30 * 86400)
+
+or from the command line:
+    python search_index.py raspberry pi 4 --max-price 300 --days 30
+
+Keyword searches are ranked with BM25, a match in the title weighing more
+than a match in the description. Searches without keywords return the most
+recently indexed ads. Case and accents are ignored, and a keyword ending
+with '*' matches any word starting with it.
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from utils import BASE_DIR, get_ad_key, parse_price
+
+# Weight of the title and of the description in the ranking
+BM25_WEIGHTS = (10.0, 1.0)
+# Default number of results of a search
+DEFAULT_LIMIT = 20
+
+
+def build_match_query(query: str) -> str:
+    """
+    Turns keywords into an FTS5 query matching the ads containing all of
+    them. The keywords are quoted, so the FTS5 operators and punctuation
+    typed by the user are searched as text. A trailing '*' is kept as a
+    prefix search.
+
+    Args:
+        query (str): the keywords, separated by spaces.
+
+    Returns:
+        str: the FTS5 query, or None if there are no keywords.
+    """
+    terms = []
+    for keyword in query.split():
+        prefix = keyword.endswith("*")
+        keyword = keyword.rstrip("*")
+        if not keyword:
+            continue
+        term = '"' + keyword.replace('"', '""') + '"'
+        terms.append(term + "*" if prefix else term)
+    return " ".join(terms) or None
+
+
+class SearchIndex():
+    """Class that indexes the data of the ads and searches it."""
+
+    def __init__(self, db_path: str = None) -> None:
+        """
+        Init a new index and create its tables, if they don't exist. The
+        index has its own connection, like the pipeline.
+
+        Args:
+            db_path (str): path of the database file. Defaults to
+            'database.db', in the same directory as the script.
+        """
+        self.conn = sqlite3.connect(db_path or os.path.join(BASE_DIR, "database.db"),
+                                    timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+        sql_create_table = """
+            CREATE TABLE IF NOT EXISTS ads_index (
+                ad_key      INTEGER     PRIMARY KEY,
+                url         TEXT        NOT NULL,
+                title       TEXT        NOT NULL,
+                description TEXT,
+                price_text  TEXT,
+                price       REAL,
+                currency    TEXT,
+                first_seen  INTEGER     NOT NULL,
+                updated_at  INTEGER     NOT NULL
+            );
+            """
+        # External content index: the text is stored once, in 'ads_index'
+        sql_create_fts = """
+            CREATE VIRTUAL TABLE IF NOT EXISTS ads_fts USING fts5(
+                title, description,
+                content='ads_index', content_rowid='ad_key',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+            """
+        sql_create_triggers = """
+            CREATE TRIGGER IF NOT EXISTS ads_index_insert AFTER INSERT ON ads_index BEGIN
+                INSERT INTO ads_fts (rowid, title, description)
+                VALUES (new.ad_key, new.title, new.description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS ads_index_delete AFTER DELETE ON ads_index BEGIN
+                INSERT INTO ads_fts (ads_fts, rowid, title, description)
+                VALUES ('delete', old.ad_key, old.title, old.description);
+            END;
+            CREATE TRIGGER IF NOT EXISTS ads_index_update
+            AFTER UPDATE OF title, description ON ads_index BEGIN
+                INSERT INTO ads_fts (ads_fts, rowid, title, description)
+                VALUES ('delete', old.ad_key, old.title, old.description);
+                INSERT INTO ads_fts (rowid, title, description)
+                VALUES (new.ad_key, new.title, new.description);
+            END;
+            """
+        with self._lock, self.conn:
+            self.conn.execute(sql_create_table)
+            self.conn.execute(sql_create_fts)
+            # ORDER BY rank lets FTS5 rank the matches itself, faster than
+            # calling bm25() from the query
+            self.conn.execute(
+                "INSERT INTO ads_fts (ads_fts, rank) VALUES ('rank', ?)",
+                (f"bm25({BM25_WEIGHTS[0]}, {BM25_WEIGHTS[1]})",))
+            self.conn.executescript(sql_create_triggers)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_ads_index_price ON ads_index (price)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_ads_index_first_seen ON ads_index (first_seen)")
+
+    def add(self, ads: list) -> int:
+        """
+        Indexes the data of ads, in a single transaction. An ad indexed
+        before is updated, and keeps the date it was first indexed.
+
+        Args:
+            ads (List[Dict]): the data of the ads, as returned by
+            OlxScraper.get_ad_data(). Ads without data are ignored.
+
+        Returns:
+            int: the number of ads indexed.
+        """
+        now = int(time.time())
+        rows = []
+        for ad_data in ads:
+            if not ad_data or not ad_data.get("url") or not ad_data.get("title"):
+                continue
+            price, currency = ad_data.get("price_value"), ad_data.get("currency")
+            if price is None:
+                price, parsed_currency = parse_price(ad_data.get("price"))
+                currency = currency or parsed_currency
+            rows.append((get_ad_key(ad_data["url"]), ad_data["url"], ad_data["title"],
+                         ad_data.get("description"), ad_data.get("price"),
+                         price, currency, now, now))
+        if not rows:
+            return 0
+        with self._lock, self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO ads_index (ad_key, url, title, description, price_text,
+                                       price, currency, first_seen, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (ad_key) DO UPDATE SET
+                    url = excluded.url, title = excluded.title,
+                    description = excluded.description,
+                    price_text = excluded.price_text, price = excluded.price,
+                    currency = excluded.currency, updated_at = excluded.updated_at
+                """, rows)
+        return len(rows)
+
+    def search(self, query: str = None, min_price: float = None,
+               max_price: float = None, currency: str = None,
+               since: float = None, until: float = None,
+               limit: int = DEFAULT_LIMIT) -> list:
+        """
+        Searches the indexed ads.
+
+        Args:
+            query (str): keywords which must all appear in the title or the
+            description. If empty, the most recently indexed ads are returned.
+            min_price (float): minimum price of the ads.
+            max_price (float): maximum price of the ads.
+            currency (str): ISO code of the currency of the ads, e.g. 'RON'.
+            since (float): only the ads first indexed at or after this time
+            (UNIX timestamp).
+            until (float): only the ads first indexed before this time.
+            limit (int): maximum number of results.
+
+        Returns:
+            List[Dict]: the 'url', 'title', 'price', 'price_value',
+            'currency' and 'first_seen' of the matching ads, best first.
+        """
+        conditions = []
+        parameters = []
+        for condition, value in (("a.price >= ?", min_price), ("a.price <= ?", max_price),
+                                 ("a.currency = ?", currency and currency.upper()),
+                                 ("a.first_seen >= ?", since), ("a.first_seen < ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        match_query = build_match_query(query) if query else None
+        columns = "a.url, a.title, a.price_text, a.price, a.currency, a.first_seen"
+        if match_query is not None:
+            where = " AND ".join(["ads_fts MATCH ?"] + conditions)
+            sql = f"""
+                SELECT {columns} FROM ads_fts JOIN ads_index a ON a.ad_key = ads_fts.rowid
+                WHERE {where} ORDER BY ads_fts.rank LIMIT ?
+                """
+            parameters.insert(0, match_query)
+        else:
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            sql = f"SELECT {columns} FROM ads_index a {where} " \
+                "ORDER BY a.first_seen DESC LIMIT ?"
+        parameters.append(limit)
+        with self._lock:
+            rows = self.conn.execute(sql, parameters).fetchall()
+        return [{"url": url, "title": title, "price": price_text, "price_value": price,
+                 "currency": currency, "first_seen": first_seen}
+                for url, title, price_text, price, currency, first_seen in rows]
+
+    def count(self) -> int:
+        """
+        Returns:
+            int: the number of indexed ads.
+        """
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM ads_index").fetchone()[0]
+
+    def optimize(self) -> None:
+        """
+        Merges the segments of the full-text index, which makes the searches
+        faster after many incremental inserts.
+
+        Returns:
+            None
+        """
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO ads_fts (ads_fts) VALUES ('optimize')")
+
+    def close(self) -> None:
+        """
+        Closes the connection of the index.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.conn.close()
+
+
+def parse_date(value: str) -> float:
+    """
+    Parses a date of the command line, e.g. '2024-05-31'.
+
+    Args:
+        value (str): the date, as YYYY-MM-DD.
+
+    Returns:
+        float: the UNIX timestamp of the start of the day, in local time.
+
+    Raises:
+        argparse.ArgumentTypeError: If the date is invalid.
+    """
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date '{value}', expected YYYY-MM-DD")
+
+
+def parse_args(args: list = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments.
+
+    Args:
+        args (list): the arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: the parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Search the ads collected by OLXRadar.")
+    parser.add_argument(
+        "keywords", nargs="*",
+        help="keywords which must all appear in the title or the description; "
+        "end a keyword with * for a prefix search")
+    parser.add_argument("--min-price", type=float, help="minimum price")
+    parser.add_argument("--max-price", type=float, help="maximum price")
+    parser.add_argument("--currency", help="currency of the prices, e.g. RON")
+    parser.add_argument(
+        "--days", type=float, help="only the ads found in the last DAYS days")
+    parser.add_argument(
+        "--since", type=parse_date, help="only the ads found since this date (YYYY-MM-DD)")
+    parser.add_argument(
+        "--until", type=parse_date, help="only the ads found before this date (YYYY-MM-DD)")
+    parser.add_argument(
+        "--limit", type=int, default=DEFAULT_LIMIT, help="maximum number of results")
+    parser.add_argument(
+        "--optimize", action="store_true", help="merge the segments of the index first")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    since = arguments.since
+    if arguments.days is not None:
+        since = max(since or 0, time.time() - arguments.days * 86400)
+    index = SearchIndex()
+    try:
+        if arguments.optimize:
+            index.optimize()
+        start = time.perf_counter()
+        results = index.search(
+            " ".join(arguments.keywords), min_price=arguments.min_price,
+            max_price=arguments.max_price, currency=arguments.currency,
+            since=since, until=arguments.until, limit=arguments.limit)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    except sqlite3.OperationalError as error:
+        print(f"Search failed: {error}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        index.close()
+    for ad in results:
+        found = datetime.fromtimestamp(ad["first_seen"]).strftime("%Y-%m-%d")
+        print(f"{found}  {ad['price'] or '-':>12}  {ad['title']}\n{' ' * 26}{ad['url']}")
+    print(f"{len(results)} ads ({elapsed_ms:.1f} ms)", file=sys.stderr)
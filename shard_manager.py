@@ -0,0 +1,177 @@
+"""
+Sharded crawling of large sets of monitored URLs. The URLs are spread over
+N shards with a consistent hash ring, so adding or removing a shard only
+moves about 1/N of the URLs, and each URL always goes to the same shard.
+
+A shard is either a long-lived worker process of a ShardPool, with its own
+async engine, HTTP client and database connections, so the parsing of the
+pages scales with the number of cores, or a separate process started with
+--shard-index. All the shards share the SQLite database, in WAL mode, and
+the file locks of the rate limiter, which don't work over a network
+filesystem: the shards must run on one host, with a local app directory.
+"""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Points of each shard on the ring. More points spread the URLs more evenly
+RING_REPLICAS = 100
+
+
+def _hash(value: str) -> int:
+    """
+    Returns the position of a value on the ring.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing():
+    """Consistent hash ring mapping keys to shards."""
+
+    def __init__(self, shards: int, replicas: int = RING_REPLICAS) -> None:
+        """
+        Init a new ring.
+
+        Args:
+            shards (int): the number of shards, numbered from 0.
+            replicas (int): the number of points of each shard on the ring.
+
+        Raises:
+            ValueError: If the number of shards is not positive.
+        """
+        if shards < 1:
+            raise ValueError("The number of shards must be at least 1.")
+        self.shards = shards
+        points = sorted((_hash(f"shard-{shard}-{replica}"), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self._positions = [position for position, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def get_shard(self, key: str) -> int:
+        """
+        Returns the shard of a key: the first shard point clockwise from
+        the position of the key.
+
+        Args:
+            key (str): the key, e.g. a monitored URL.
+
+        Returns:
+            int: the index of the shard.
+        """
+        index = bisect.bisect(self._positions, _hash(key)) % len(self._positions)
+        return self._shards[index]
+
+    def assign(self, keys: list) -> dict:
+        """
+        Groups keys by shard.
+
+        Args:
+            keys (list): the keys.
+
+        Returns:
+            Dict[int, List[str]]: the shards with at least one key, mapped
+            to their keys, in their original order.
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_shard(key), []).append(key)
+        return groups
+
+
+class ShardPool():
+    """
+    Long-lived worker processes, one per shard. The worker processes are
+    started with 'spawn', so they don't inherit the database connections and
+    the threads of the parent, and are kept between cycles.
+    """
+
+    def __init__(self, shards: int, initializer=None, initargs: tuple = ()) -> None:
+        """
+        Init a new pool. The worker processes start on first use.
+
+        Args:
+            shards (int): the number of worker processes.
+            initializer (callable): optional picklable function called with
+            'initargs' when a worker process starts.
+            initargs (tuple): the arguments of the initializer.
+        """
+        self.ring = HashRing(shards)
+        self.initializer = initializer
+        self.initargs = initargs
+        self._context = multiprocessing.get_context("spawn")
+        self._executors = [None] * shards
+
+    def _get_executor(self, shard: int) -> ProcessPoolExecutor:
+        """
+        Returns the executor of a shard, starting it if needed.
+        """
+        if self._executors[shard] is None:
+            self._executors[shard] = ProcessPoolExecutor(
+                max_workers=1, mp_context=self._context,
+                initializer=self.initializer, initargs=self.initargs)
+        return self._executors[shard]
+
+    def map(self, worker, keys: list, *args) -> list:
+        """
+        Runs a function on each shard with the keys of the shard. A shard
+        whose process dies is restarted on next use.
+
+        Args:
+            worker (callable): a picklable, module-level function receiving
+            the list of keys of a shard and *args.
+            keys (list): the keys to process, e.g. monitored URLs.
+            *args: other arguments of the function.
+
+        Returns:
+            list: the results of the shards. The results of the failed
+            shards are missing.
+        """
+        futures = {shard: self._get_executor(shard).submit(worker, shard_keys, *args)
+                   for shard, shard_keys in self.ring.assign(keys).items()}
+        results = []
+        for shard, future in futures.items():
+            try:
+                results.append(future.result())
+            except BrokenProcessPool as error:
+                logging.error(f"The worker process of shard {shard} died: {error}")
+                self._executors[shard].shutdown(wait=False)
+                self._executors[shard] = None
+            except Exception as error:
+                logging.error(f"Error in shard {shard}: {error}")
+        return results
+
+    def run(self, worker, keys: list, *args) -> dict:
+        """
+        Same as map(), for a function returning a dict: the results of the
+        shards are merged.
+
+        Args:
+            worker (callable): a picklable, module-level function receiving
+            the list of keys of a shard and *args, and returning a dict.
+            keys (list): the keys to process, e.g. monitored URLs.
+            *args: other arguments of the function.
+
+        Returns:
+            dict: the merged results of all the shards. The keys of a failed
+            shard are missing.
+        """
+        results = {}
+        for shard_results in self.map(worker, keys, *args):
+            results.update(shard_results)
+        return results
+
+    def close(self) -> None:
+        """
+        Stops the worker processes.
+
+        Returns:
+            None
+        """
+        for shard, executor in enumerate(self._executors):
+            if executor is not None:
+                executor.shutdown(wait=True)
+                self._executors[shard] = None
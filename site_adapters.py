@@ -0,0 +1,98 @@
+"""
+Per-site settings and rules used by the scraper. Each supported OLX site has
+an adapter holding its selectors, its pagination and URL-relevance rules and
+its request budget, so that one engine can crawl all the sites at once.
+"""
+from urllib.parse import urlparse
+from extractors import OLX_SELECTORS
+
+
+class SiteAdapter():
+    """Class describing how a site is crawled."""
+
+    def __init__(self, netloc: str, schema: str = "https",
+                 selectors: dict = None, page_param: str = "page",
+                 max_concurrency: int = 10, requests_per_second: float = 10) -> None:
+        """
+        Init a new site adapter.
+
+        Args:
+            netloc (str): the domain of the site, e.g. 'www.olx.ro'.
+            schema (str): the schema of the URLs of the site.
+            selectors (dict): the tags and CSS classes of the elements
+            holding the data. Defaults to the selectors of the OLX sites.
+            page_param (str): the query parameter holding the page number.
+            max_concurrency (int): maximum number of simultaneous requests
+            made to the site.
+            requests_per_second (float): maximum sustained request rate.
+        """
+        self.netloc = netloc
+        self.schema = schema
+        self.selectors = selectors or OLX_SELECTORS
+        self.page_param = page_param
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+
+    def get_page_url(self, target_url: str, page: int) -> str:
+        """
+        Returns the URL of a page of results.
+
+        Args:
+            target_url (str): URL of the search.
+            page (int): the number of the page.
+
+        Returns:
+            str: the URL of the page.
+        """
+        return f"{target_url}/?{self.page_param}={page}"
+
+    def is_relevant_url(self, url: str) -> bool:
+        """
+        Determines whether the URL of an ad is relevant for monitoring.
+
+        Args:
+            url (str): the URL of the ad.
+
+        Returns:
+            bool: True if the URL is relevant, False if not.
+
+        On the OLX sites, query segments such as "?reason=extended-region" show
+        that the ad was added to the results because there were not enough ads
+        available for the user's region.
+        """
+        return urlparse(url).query == ""
+
+
+# Domains of the supported OLX sites. They run the same front end, so their
+# adapters are identical on purpose: same selectors, pagination and URL
+# rules, and the default request budget. A site which diverges gets its own
+# SiteAdapter, passed to register_site_adapter()
+OLX_NETLOCS = ("www.olx.ro", "www.olx.pl", "www.olx.bg", "www.olx.pt", "www.olx.ua")
+
+SITE_ADAPTERS = {netloc: SiteAdapter(netloc) for netloc in OLX_NETLOCS}
+
+
+def register_site_adapter(adapter: SiteAdapter) -> None:
+    """
+    Adds a site to the ones supported by the scraper.
+
+    Args:
+        adapter (SiteAdapter): the adapter of the site.
+
+    Returns:
+        None
+    """
+    SITE_ADAPTERS[adapter.netloc] = adapter
+
+
+def get_site_adapter(url: str) -> SiteAdapter:
+    """
+    Returns the adapter of the site a URL belongs to.
+
+    Args:
+        url (str): the URL.
+
+    Returns:
+        SiteAdapter: the adapter, or None if the site is not supported.
+    """
+    return SITE_ADAPTERS.get(urlparse(url).netloc)
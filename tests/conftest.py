@@ -0,0 +1,68 @@
+"""
+Fixtures of the tests: the app runs against the local stand-in of OLX of
+the benchmark, with its database in a temporary directory.
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the state of the tests out of the app directory
+os.environ["RATE_LIMIT_SHARED"] = "0"
+os.environ["RATE_LIMIT_MAX"] = "1000"
+os.environ["HTTP_CACHE"] = "0"
+
+
+class RecordingDispatcher():
+    """Stand-in of NotificationDispatcher, which records the notifications."""
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.changes = []
+
+    def submit(self, target_url: str, new_ads: list, on_sent=None,
+               on_failed=None) -> None:
+        self.sent.append((target_url, new_ads))
+        if on_sent is not None:
+            on_sent()
+
+    def submit_changes(self, target_url: str, changes: list) -> None:
+        self.changes.append((target_url, changes))
+
+    def end_cycle(self, wait: bool = False) -> None:
+        pass
+
+    def get_notified_urls(self, target_url: str = None) -> list:
+        return [ad["url"] for url, new_ads in self.sent for ad in new_ads
+                if target_url is None or url == target_url]
+
+
+@pytest.fixture
+def olx():
+    """The stand-in of an OLX site, with a single page of results per search."""
+    from benchmark import OlxStandIn, StandInStats, start_server, register_standin_site
+    server = OlxStandIn(StandInStats(), pages=1)
+    start_server(server)
+    register_standin_site({"netloc": server.netloc})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The main module, with a fresh database and a recording dispatcher."""
+    import main
+    from database_manager import DatabaseManager
+    from pipeline_manager import Pipeline
+    db = DatabaseManager(str(tmp_path / "database.db"))
+    monkeypatch.setattr(main, "_db", db)
+    monkeypatch.setattr(main, "_pipeline", Pipeline(db.DB, retry_delay=0))
+    monkeypatch.setattr(main, "_dispatcher", RecordingDispatcher())
+    monkeypatch.setattr(main, "filters", {})
+    yield main
+    if main._scraper is not None:
+        main._scraper.close()
+        main._scraper = None
+    main.close_resources()
@@ -0,0 +1,36 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from benchmark import start_server
+from http_manager import HttpClient
+from rate_limiter import AdaptiveRateLimiter
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """Answers the first request with 429, the next ones with 200."""
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.requests += 1
+        self.send_response(429 if self.server.requests == 1 else 200)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def test_limiter_sees_every_throttling_answer():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    server.requests = 0
+    start_server(server)
+    host = f"127.0.0.1:{server.server_address[1]}"
+    limiter = AdaptiveRateLimiter(max_rate=100)
+    client = HttpClient(max_retries=3, limiter=limiter)
+    try:
+        response = client.get(f"http://{host}/", timeout=10)
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    assert response.status_code == 200
+    assert server.requests == 2
+    assert limiter.get_state(host)["rate"] < 100
@@ -0,0 +1,14 @@
+from metrics import Registry
+
+
+def test_worker_metrics_merge_into_parent():
+    worker, parent = Registry(), Registry()
+    worker.inc("pages_fetched", 3)
+    worker.observe("http.get", 0.02)
+    parent.inc("pages_fetched")
+    parent.merge(worker.drain())
+    assert worker.to_dict()["counters"] == {}
+    data = parent.to_dict()
+    assert data["counters"]["pages_fetched"] == 4
+    assert data["histograms"]["http.get"]["count"] == 1
+    assert data["histograms"]["http.get"]["buckets"]["0.025"] == 1
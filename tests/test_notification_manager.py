@@ -0,0 +1,46 @@
+import notification_manager
+from notification_manager import Messenger
+
+AD = {
+    "title": "Bicicleta de oras",
+    "price": "500 lei",
+    "description": "Bicicleta in stare buna",
+    "url": "https://www.olx.ro/d/oferta/bicicleta-IDnew1.html",
+    "repost_of": "https://www.olx.ro/d/oferta/bicicleta-IDold1.html"
+}
+
+
+class FakeResponse():
+
+    def raise_for_status(self) -> None:
+        pass
+
+    def json(self) -> dict:
+        return {"ok": True}
+
+
+class FakeClient():
+
+    def __init__(self) -> None:
+        self.texts = []
+
+    def post(self, url: str, json: dict = None, **kwargs) -> FakeResponse:
+        self.texts.append(json["text"])
+        return FakeResponse()
+
+
+def test_email_shows_repost():
+    _, body = Messenger.generate_email_content("https://www.olx.ro/oferte/q-bicicleta/", [AD])
+    assert f"{AD['url']}\nRepost of {AD['repost_of']}\n" in body
+    _, body = Messenger.generate_email_content(
+        "https://www.olx.ro/oferte/q-bicicleta/", [dict(AD, repost_of=None)])
+    assert "Repost of" not in body
+
+
+def test_telegram_shows_repost(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(notification_manager, "get_http_client", lambda: client)
+    subject, body = Messenger.generate_email_content(
+        "https://www.olx.ro/oferte/q-bicicleta/", [AD])
+    assert Messenger.send_telegram_message(subject, body)
+    assert any(f"Repost of {AD['repost_of']}" in text for text in client.texts)
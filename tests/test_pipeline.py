@@ -0,0 +1,76 @@
+from pipeline_manager import DISCOVERED, Pipeline
+
+
+def test_failed_fetch_is_notified_next_cycle(app, olx, monkeypatch):
+    target_url = f"{olx.base_url}/oferte/q-bench-1/"
+    scraper = app.get_scraper()
+    get = scraper._get
+    failed = []
+
+    def get_once_failing(url: str, headers: dict):
+        # The first ad page answers like a timeout or a 503
+        if "-ID" in url and not failed:
+            failed.append(url)
+            return None
+        return get(url, headers)
+
+    monkeypatch.setattr(scraper, "_get", get_once_failing)
+    app.run_cycle([target_url])
+    notified = app.get_dispatcher().get_notified_urls()
+    assert failed and failed[0] not in notified
+    assert app.get_db().filter_new(failed) == set(failed)
+
+    app.run_cycle([target_url])
+    assert app.get_dispatcher().get_notified_urls().count(failed[0]) == 1
+    assert app.get_db().filter_new(failed) == set()
+
+
+def test_failed_fetch_backs_off_then_gives_up(tmp_path):
+    pipeline = Pipeline(str(tmp_path / "pipeline.db"), retry_delay=60, max_attempts=2)
+    url = "https://www.olx.ro/d/oferta/ad-IDabc.html"
+    pipeline.discover("https://www.olx.ro/oferte/q-a/", {url: None})
+    assert pipeline.claim(DISCOVERED)
+    pipeline.mark_failed([url])
+    assert pipeline.claim(DISCOVERED) == []
+    pipeline.conn.execute("UPDATE pipeline SET retry_at = 0")
+    assert pipeline.claim(DISCOVERED)
+    pipeline.mark_failed([url])
+    assert pipeline.get_stats()["backlog"] == {"discovered": 0, "fetched": 0, "notified": 1}
+    pipeline.close()
+
+
+def test_ad_rejected_by_one_search_is_notified_by_another(app, olx):
+    from filter_engine import SearchFilter
+    # Both searches find the same ads
+    olx.overlap = 2
+    filtered_url = f"{olx.base_url}/oferte/q-bench-0/"
+    other_url = f"{olx.base_url}/oferte/q-bench-1/"
+    # Only decided from the description, so after the ad page is fetched
+    app.filters[filtered_url] = SearchFilter(include=["no-such-keyword"])
+
+    app.run_cycle([filtered_url])
+    dispatcher = app.get_dispatcher()
+    assert dispatcher.get_notified_urls() == []
+
+    app.run_cycle([other_url])
+    notified = dispatcher.get_notified_urls(other_url)
+    assert len(notified) == len(set(notified)) > 0
+
+    # The filtered search doesn't fetch nor notify its rejected ads again
+    app.run_cycle([filtered_url])
+    assert dispatcher.get_notified_urls(filtered_url) == []
+    assert app.get_pipeline().get_stats()["backlog"]["discovered"] == 0
+
+
+def test_shared_ad_rejected_by_one_search_in_the_same_cycle(app, olx):
+    from filter_engine import SearchFilter
+    olx.overlap = 2
+    filtered_url = f"{olx.base_url}/oferte/q-bench-0/"
+    other_url = f"{olx.base_url}/oferte/q-bench-1/"
+    app.filters[filtered_url] = SearchFilter(include=["no-such-keyword"])
+
+    app.run_cycle([filtered_url, other_url])
+    dispatcher = app.get_dispatcher()
+    assert dispatcher.get_notified_urls(filtered_url) == []
+    notified = dispatcher.get_notified_urls(other_url)
+    assert len(notified) == len(set(notified)) == 8
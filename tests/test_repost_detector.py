@@ -0,0 +1,16 @@
+from repost_detector import LSH_BANDS, RepostDetector
+from utils import get_ad_key
+
+URL = "https://www.olx.ro/d/oferta/bicicleta-IDabc12.html"
+
+
+def test_edited_ad_keeps_only_its_current_bands(tmp_path):
+    detector = RepostDetector(str(tmp_path / "database.db"))
+    detector.check([{"url": URL, "title": "Bicicleta de oras Pegas",
+                     "description": "Cadru de aluminiu, roti noi, frane revizuite"}])
+    detector.check([{"url": URL, "title": "Masina de spalat Arctic",
+                     "description": "Functioneaza perfect, 7 kg, clasa energetica A"}])
+    count, = detector.conn.execute(
+        "SELECT COUNT(*) FROM fingerprint_bands WHERE ad_key = ?", (get_ad_key(URL),)).fetchone()
+    detector.close()
+    assert count == LSH_BANDS
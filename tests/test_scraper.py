@@ -0,0 +1,20 @@
+import pytest
+from scraper_manager import OlxScraper
+
+
+def test_sync_scrape_uses_site_of_url(olx):
+    # The default site is www.olx.ro: the stand-in is another site
+    scraper = OlxScraper()
+    try:
+        ads_urls = scraper.scrape_ads_urls(f"{olx.base_url}/oferte/q-bench-1")
+        assert ads_urls
+        assert all(url.startswith(f"{olx.base_url}/") for url in ads_urls)
+        assert scraper.get_ad_data(sorted(ads_urls)[0])["title"]
+    finally:
+        scraper.close()
+
+
+def test_sync_scrape_rejects_unsupported_site():
+    scraper = OlxScraper()
+    with pytest.raises(ValueError):
+        scraper.scrape_ads_urls("https://www.example.com/oferte/q-bench-1")
@@ -1,10 +1,44 @@
 import os
 import re
+import hashlib
 import unicodedata
 import random
+from urllib.parse import urlparse
 
 # Absolute path of the project dir
 BASE_DIR = os.path.realpath(os.path.dirname(__file__))
+# Stable ID token ending the URLs of the OLX ads, e.g. '...-IDhS7kF.html'
+AD_ID_PATTERN = re.compile(r"-ID([0-9A-Za-z]+)\.html")
+BASE62_DIGITS = {digit: value for value, digit in enumerate(
+    "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")}
+# ID tokens up to this length fit in the 48 low bits of a key
+MAX_AD_ID_LENGTH = 8
+# Currencies shown on the OLX sites, by the symbol used in the prices
+CURRENCY_SYMBOLS = {
+    "lei": "RON", "ron": "RON", "zł": "PLN", "pln": "PLN", "лв": "BGN",
+    "грн": "UAH", "€": "EUR", "eur": "EUR", "$": "USD", "usd": "USD"
+}
+PRICE_PATTERN = re.compile(r"\d[\d\s.,]*")
+
+_env_loaded = False
+
+
+def load_env() -> None:
+    """
+    Loads the settings of the '.env' file of the project dir into the
+    environment, once. python-dotenv is only imported if the file exists.
+
+    Returns:
+        None
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
+    env_path = os.path.join(BASE_DIR, ".env")
+    if os.path.exists(env_path):
+        from dotenv import load_dotenv
+        load_dotenv(env_path)
 
 
 def get_header() -> dict:
@@ -93,3 +127,87 @@ def extract_search_term(url: str) -> str:
         query_segments = query.split("-")
         return " ".join(query_segments)
     return None
+
+
+def get_ad_key(url: str) -> int:
+    """
+    Returns the compact key identifying an ad. The slug of an OLX ad URL
+    changes when the seller edits the title, but the ID token at its end
+    doesn't, so the key is the token decoded as a base62 number, in the low
+    48 bits, combined with a 15-bit code of the site.
+
+    Args:
+        url (str): the URL of the ad.
+
+    Returns:
+        int: a positive 63-bit key. URLs without an ID token get a 63-bit
+        hash of the whole URL, as a negative number.
+    """
+    parsed_url = urlparse(url)
+    match = AD_ID_PATTERN.search(parsed_url.path)
+    if match and len(match.group(1)) <= MAX_AD_ID_LENGTH:
+        value = 0
+        for digit in match.group(1):
+            value = value * 62 + BASE62_DIGITS[digit]
+        site_code = int.from_bytes(hashlib.blake2b(
+            parsed_url.netloc.lower().encode("utf-8"), digest_size=2).digest(), "big") >> 1
+        return (site_code << 48) | value
+    digest = hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+    return -(int.from_bytes(digest, "big") >> 1) - 1
+
+
+def parse_price(text: str) -> tuple[float, str]:
+    """
+    Parses a price as displayed on the OLX sites, e.g. '2 350 lei',
+    '1.100 €' or '12,50 zł'.
+
+    Args:
+        text (str): the displayed price.
+
+    Returns:
+        Tuple[float, str]: the amount and the ISO code of the currency.
+        Each is None if not found, e.g. for 'Gratuit' or 'Schimb'.
+    """
+    if not text:
+        return None, None
+    currency = None
+    lowered = text.lower()
+    for symbol, code in CURRENCY_SYMBOLS.items():
+        if symbol in lowered:
+            currency = code
+            break
+    match = PRICE_PATTERN.search(text)
+    if match is None:
+        return None, currency
+    number = re.sub(r"\s", "", match.group()).rstrip(".,")
+    if "." in number and "," in number:
+        # The last separator is the decimal one
+        decimal = "." if number.rfind(".") > number.rfind(",") else ","
+        number = number.replace("," if decimal == "." else ".", "").replace(decimal, ".")
+    elif "," in number or "." in number:
+        separator = "," if "," in number else "."
+        parts = number.split(separator)
+        if len(parts) > 2 or len(parts[-1]) == 3:
+            # Thousands separators
+            number = "".join(parts)
+        else:
+            number = number.replace(separator, ".")
+    try:
+        return float(number), currency
+    except ValueError:
+        return None, currency
+
+
+def get_title_hash(title: str) -> int:
+    """
+    Returns a 64-bit hash of a title, insensitive to case, accents and spacing.
+
+    Args:
+        title (str): the title.
+
+    Returns:
+        int: the hash, as a signed 64-bit integer.
+    """
+    normalized = " ".join(normalize_text(title).lower().split())
+    digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)